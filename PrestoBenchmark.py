@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import shutil
+import random
+import argparse
+import tempfile
+import threading
+from PrestoEngine import SyncOptions, SyncScheduler, NativeBackend, TreeWalker, MB
+from PrestoIndex import MtimeIndex
+
+
+def createTree(root, files, size, perFolder=100):
+    """ `files` files of `size` random bytes, `perFolder` in each folder """
+    data = os.urandom(size)
+    for i in range(files):
+        folder = os.path.join(root, f'd{i // perFolder:04d}')
+        if i % perFolder == 0:
+            os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f'f{i:06d}.bin'), 'wb') as f:
+            f.write(data)
+
+
+def createDeepTree(root, files, fanOut=10, perFolder=100):
+    """ `files` empty files, `perFolder` in each leaf of a tree `fanOut` folders wide at every level """
+    leaves = max(1, files // perFolder)
+    depth = 1
+    while fanOut ** depth < leaves:
+        depth += 1
+    for leaf in range(leaves):
+        parts, n = [], leaf
+        for _ in range(depth):
+            parts.append(f'd{n % fanOut}')
+            n //= fanOut
+        folder = os.path.join(root, *parts)
+        os.makedirs(folder, exist_ok=True)
+        for i in range(min(perFolder, files - leaf * perFolder)):
+            open(os.path.join(folder, f'f{i:03d}.bin'), 'wb').close()
+
+
+def createFile(path, size):
+    block = os.urandom(MB)
+    with open(path, 'wb') as f:
+        for _ in range(size // MB):
+            f.write(block)
+
+
+def timeSync(src, dst, options):
+    """ seconds taken by a first sync of `src` into an empty `dst` """
+    target = os.path.join(dst, os.path.basename(src))
+    shutil.rmtree(target, ignore_errors=True)
+    backend = NativeBackend(options)
+    start = time.perf_counter()
+    backend.sync(src, dst)
+    elapsed = time.perf_counter() - start
+    if backend.errors:
+        raise OSError(backend.errors[0])
+    return elapsed
+
+
+def benchSmallFiles(args):
+    """ files per second of the small-file path and of one copy at a time """
+    work = tempfile.mkdtemp(prefix='presto-bench-')
+    src = os.path.join(work, 'source')
+    dst = args.dst or os.path.join(work, 'target')
+    try:
+        createTree(src, args.files, args.size)
+        os.makedirs(dst, exist_ok=True)
+        for name, smallFileSize in (('one at a time', 0), ('small-file path', args.size)):
+            elapsed = min(timeSync(src, dst, SyncOptions(bufSize=32 * MB, smallFileSize=smallFileSize))
+                          for _ in range(args.repeat))
+            print(f'{name:>16}: {args.files / elapsed:8.0f} files/s  ({elapsed:.2f} s for {args.files} files)')
+        shutil.rmtree(os.path.join(dst, os.path.basename(src)), ignore_errors=True)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def benchLargeFile(args):
+    """ throughput of one large file copied on one thread, double buffered and mapped """
+    work = tempfile.mkdtemp(prefix='presto-bench-')
+    src = os.path.join(work, 'source')
+    dst = args.dst or os.path.join(work, 'target')
+    size = args.size * MB
+    try:
+        os.makedirs(src)
+        createFile(os.path.join(src, 'large.bin'), size)
+        os.makedirs(dst, exist_ok=True)
+        for name, options in (('one thread', {'largeFileSize': None}),
+                              ('double buffered', {'isMmap': False}),
+                              ('mapped', {'isMmap': True})):
+            options = SyncOptions(bufSize=args.buf * MB, concurrentProcess=1, **options)
+            elapsed = min(timeSync(src, dst, options) for _ in range(args.repeat))
+            print(f'{name:>16}: {size / MB / elapsed:8.1f} MB/s  ({elapsed:.2f} s for {args.size} MB)')
+        shutil.rmtree(os.path.join(dst, os.path.basename(src)), ignore_errors=True)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def probeLatency(folder, stop, interval=0.02):
+    """ seconds taken by small synced writes in `folder`, the way an editor saving a file sees the disk """
+    latencies = []
+    path = os.path.join(folder, 'probe.bin')
+    data = os.urandom(4096)
+    with open(path, 'wb', buffering=0) as f:
+        while not stop.wait(interval):
+            start = time.perf_counter()
+            f.seek(0)
+            f.write(data)
+            os.fsync(f.fileno())
+            latencies.append(time.perf_counter() - start)
+    os.remove(path)
+    return latencies
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))] if values else 0
+
+
+def benchLowIo(args):
+    """ latency a foreground writer sees while nothing runs, during a normal sync and during a low io sync """
+    work = tempfile.mkdtemp(prefix='presto-bench-')
+    src = os.path.join(work, 'source')
+    dst = args.dst or os.path.join(work, 'target')
+    try:
+        os.makedirs(src)
+        for i in range(args.files):
+            createFile(os.path.join(src, f'f{i:03d}.bin'), args.size * MB)
+        os.makedirs(dst, exist_ok=True)
+        print(f'{"":>10}  {"p50 ms":>8} {"p99 ms":>8} {"max ms":>8} {"sync MB/s":>10}')
+        for name, options in (('idle', None),
+                              ('normal', SyncOptions(bufSize=args.buf * MB, verify=args.verify)),
+                              ('low io', SyncOptions(bufSize=args.buf * MB, verify=args.verify, isLowIo=True,
+                                                     lowIoRate=args.rate * MB))):
+            shutil.rmtree(os.path.join(dst, 'source'), ignore_errors=True)
+            stop = threading.Event()
+            result = {}
+            probe = threading.Thread(target=lambda: result.update(latencies=probeLatency(dst, stop)))
+            probe.start()
+            start = time.perf_counter()
+            if options:
+                if options.throttle:
+                    options.throttle.hashShare = args.hash_share
+                SyncScheduler(lambda: NativeBackend(options), 1).run([(1, src)], dst)
+            else:
+                time.sleep(args.idle)
+            elapsed = time.perf_counter() - start
+            stop.set()
+            probe.join()
+            latencies = result['latencies']
+            speed = f'{args.files * args.size / elapsed:10.1f}' if options else f'{"":>10}'
+            print(f'{name:>10}  {percentile(latencies, 0.5) * 1000:8.2f} {percentile(latencies, 0.99) * 1000:8.2f} '
+                  f'{max(latencies, default=0) * 1000:8.2f} {speed}')
+        shutil.rmtree(os.path.join(dst, 'source'), ignore_errors=True)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def injectLatency(seconds, folder=None):
+    """ make every folder listing wait `seconds`, the round trip of a network share or a slow stick,
+    and every stat of a path in `folder` as well if it is given """
+    scandir, stat = os.scandir, os.stat
+
+    def slowScandir(path='.'):
+        time.sleep(seconds)
+        return scandir(path)
+
+    def slowStat(path, *args, **kwargs):
+        if isinstance(path, str) and path.startswith(folder):
+            time.sleep(seconds)
+        return stat(path, *args, **kwargs)
+
+    os.scandir = slowScandir
+    if folder:
+        os.stat = slowStat
+
+    def restore():
+        os.scandir, os.stat = scandir, stat
+    return restore
+
+
+def benchWalk(args):
+    """ folders listed per second by one walker thread and by many, alone and while planning a sync """
+    work = tempfile.mkdtemp(prefix='presto-bench-')
+    src = os.path.join(work, 'source')
+    dst = os.path.join(work, 'target')
+    try:
+        createDeepTree(src, args.files)
+        os.makedirs(dst)
+
+        def listFolder(path):
+            files, children = 0, []
+            for entry in os.scandir(path):
+                if entry.is_dir(follow_symlinks=False):
+                    children.append(entry.path)
+                else:
+                    files += 1
+            return files, children
+
+        restore = injectLatency(args.latency / 1000)
+        try:
+            for workers in sorted({1, args.workers}):
+                start = time.perf_counter()
+                files = sum(result for _, result, error in TreeWalker(listFolder, workers).walk([src]) if not error)
+                walkTime = time.perf_counter() - start
+                start = time.perf_counter()
+                plan = NativeBackend(SyncOptions(walkWorkers=workers)).plan(src, dst)
+                planTime = time.perf_counter() - start
+                if files != args.files or len(plan.copies) != args.files:
+                    raise RuntimeError(f'{files} files walked and {len(plan.copies)} planned of {args.files}')
+                print(f'{workers:>3} workers: walk {files / walkTime:9.0f} files/s ({walkTime:.2f} s), '
+                      f'plan {files / planTime:9.0f} files/s ({planTime:.2f} s)')
+        finally:
+            restore()
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def benchRange(args):
+    """ planning a copy of the last days by walking the source and by querying its mtime index """
+    work = tempfile.mkdtemp(prefix='presto-bench-')
+    src = os.path.join(work, 'source')
+    dst = os.path.join(work, 'target')
+    try:
+        createDeepTree(src, args.files)
+        now = time.time()
+        for root, dirs, files in os.walk(src):
+            for name in files:
+                mtime = now - random.random() * args.span * 86400
+                os.utime(os.path.join(root, name), (mtime, mtime))
+        os.makedirs(dst)
+
+        def planRange(isIndexed):
+            options = SyncOptions(walkWorkers=args.workers)
+            options.parseCommandOption(f'/from_date=-{args.days}D')
+            if isIndexed:
+                options.index = lambda folder: MtimeIndex.shared(folder, os.path.join(work, 'index'))
+            start = time.perf_counter()
+            plan = NativeBackend(options).plan(src, dst)
+            return len(plan.copies), time.perf_counter() - start
+
+        restore = injectLatency(args.latency / 1000, src)
+        try:
+            for name, isIndexed in (('walk', False), ('index build', True), ('index', True)):
+                files, elapsed = planRange(isIndexed)
+                print(f'{name:>12}: {elapsed:8.3f} s, {files} of {args.files} files in the last {args.days} days')
+        finally:
+            restore()
+        index = MtimeIndex.shared(src, os.path.join(work, 'index'))
+        start = time.perf_counter()
+        files = len(index.query(now - args.days * 86400))
+        print(f'{"query":>12}: {(time.perf_counter() - start) * 1000:8.3f} ms, {files} files')
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Presto engine benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+    small = commands.add_parser('small', help='copy a tree of small files')
+    small.add_argument('--files', type=int, default=10000)
+    small.add_argument('--size', type=int, default=4096)
+    small.add_argument('--repeat', type=int, default=3)
+    small.add_argument('--dst', help='folder on the drive to measure, a temporary folder by default')
+    small.set_defaults(run=benchSmallFiles)
+    large = commands.add_parser('large', help='copy one large file')
+    large.add_argument('--size', type=int, default=1024, help='MB')
+    large.add_argument('--buf', type=int, default=256, help='buffer size in MB')
+    large.add_argument('--repeat', type=int, default=3)
+    large.add_argument('--dst', help='folder on the drive to measure, a temporary folder by default')
+    large.set_defaults(run=benchLargeFile)
+    lowIo = commands.add_parser('lowio', help='foreground write latency during a normal and a low io sync, '
+                                              'run under ionice or a cgroup io limit to compare with the os knobs')
+    lowIo.add_argument('--files', type=int, default=8)
+    lowIo.add_argument('--size', type=int, default=64, help='MB per file')
+    lowIo.add_argument('--buf', type=int, default=256, help='buffer size in MB')
+    lowIo.add_argument('--rate', type=int, default=10, help='MB/s of the low io sync')
+    lowIo.add_argument('--hash-share', type=float, default=0.25, help='part of a core the low io hashing may take')
+    lowIo.add_argument('--verify', choices=('xxHash', 'SHA-256'), help='hash and read back every file')
+    lowIo.add_argument('--idle', type=float, default=3, help='seconds the latency is measured without a sync')
+    lowIo.add_argument('--dst', help='folder on the drive to measure, a temporary folder by default')
+    lowIo.set_defaults(run=benchLowIo)
+    walk = commands.add_parser('walk', help='walk and plan a tree of empty files with a delay added to every listing')
+    walk.add_argument('--files', type=int, default=100000)
+    walk.add_argument('--latency', type=float, default=2, help='ms added to every folder listing')
+    walk.add_argument('--workers', type=int, default=16)
+    walk.set_defaults(run=benchWalk)
+    dateRange = commands.add_parser('range', help='plan a copy of the last days of a tree of empty files, '
+                                                  'walking it and from the mtime index')
+    dateRange.add_argument('--files', type=int, default=100000)
+    dateRange.add_argument('--days', type=int, default=7)
+    dateRange.add_argument('--span', type=int, default=365, help='days the mtimes of the files are spread over')
+    dateRange.add_argument('--latency', type=float, default=2, help='ms added to every listing and stat in the source')
+    dateRange.add_argument('--workers', type=int, default=16)
+    dateRange.set_defaults(run=benchRange)
+    args = parser.parse_args()
+    sys.exit(args.run(args))
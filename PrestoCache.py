@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from PrestoEngine import MB, RateLimiter, TreeWalker, createHash, hashFile, setBackgroundPriority
+
+
+GB = 1024 * MB
+CACHE_VERSION = 1
+CACHE_FOLDER = os.path.join(os.path.expanduser('~'), '.Presto', 'cache')
+INDEX_NAME = 'index.json'
+CACHE_HASH = 'xxHash'
+STALE_TIME = 24 * 3600  # temporary files older than this are left over from a crash
+WARM_INTERVAL = 600  # seconds between two passes of the cache warmer
+WARM_SHARE = 0.9  # part of the cache the warmer fills, the rest is left for the syncs
+WARM_FULL_WALK = 6  # every that many passes folders are listed again even if their mtime is unchanged
+WARM_WALK_WORKERS = 4  # folders the warmer lists at once, kept low as it runs beside the user's work
+IDLE_STEP = 5
+
+
+class CacheWriter:
+    """ Copy of a source file being written into the cache alongside a sync
+
+    Errors writing the cache never fail the sync, the entry is simply not kept.
+    """
+
+    def __init__(self, cache, src, size, mtime):
+        self.cache = cache
+        self.src = src
+        self.size = size
+        self.mtime = mtime
+        self.path = cache.entryPath(src)
+        self.tmpPath = f'{self.path}.{threading.get_ident()}.tmp'
+        self.hasher = createHash(CACHE_HASH)
+        self.written = 0
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.file = open(self.tmpPath, 'wb', buffering=0)
+        except OSError:
+            self.file = None
+
+    def write(self, data):
+        if self.file is None:
+            return
+        try:
+            self.file.write(data)
+            self.hasher.update(data)
+            self.written += len(data)
+        except OSError:
+            self.abort()
+
+    def commit(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        if self.written != self.size:
+            self.remove()
+            return
+        try:
+            os.replace(self.tmpPath, self.path)
+        except OSError:
+            self.remove()
+            return
+        self.cache.add(self.src, self.size, self.mtime, self.hasher.hexdigest())
+
+    def abort(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.remove()
+
+    def remove(self):
+        try:
+            os.remove(self.tmpPath)
+        except OSError:
+            pass
+
+
+class SourceCache:
+    """ Read-through cache of source files on the local disk
+
+    A sync reading a file from the share writes it into the cache at the same time, the
+    next sync of an unchanged file reads the local copy instead. Entries are checked
+    against the size and mtime of the source, and against their hash if `isHashChecked`.
+    The least recently used entries are evicted to stay under `maxSize` bytes.
+
+    index: key -> [source path, size, mtime, hash], least recently used first
+    """
+
+    instances = {}
+    instancesLock = threading.Lock()
+
+    def __init__(self, folder=CACHE_FOLDER, maxSize=20 * GB, isHashChecked=False):
+        self.folder = folder
+        self.maxSize = maxSize
+        self.isHashChecked = isHashChecked
+        self.index = OrderedDict()
+        self.totalSize = 0
+        self.isDirty = False
+        self.lock = threading.RLock()
+        self.load()
+        self.evict()
+
+    @classmethod
+    def shared(cls, folder=CACHE_FOLDER, maxSize=20 * GB, isHashChecked=False):
+        """ the cache of `folder` used by every sync of this process """
+        with cls.instancesLock:
+            cache = cls.instances.get(folder)
+            if cache is None:
+                cache = cls.instances[folder] = cls(folder, maxSize, isHashChecked)
+        cache.maxSize = maxSize
+        cache.isHashChecked = isHashChecked
+        cache.evict()
+        return cache
+
+    @property
+    def indexPath(self):
+        return os.path.join(self.folder, INDEX_NAME)
+
+    def key(self, src):
+        return hashlib.sha1(os.path.normcase(os.path.normpath(src)).encode('utf-8')).hexdigest()
+
+    def entryPath(self, src, key=None):
+        key = key or self.key(src)
+        return os.path.join(self.folder, key[:2], key)
+
+    def load(self):
+        """ read the index, entries missing from it are left over from a crash and removed """
+        try:
+            with open(self.indexPath, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data['version'] != CACHE_VERSION:
+                raise ValueError(data['version'])
+            self.index = OrderedDict((key, record) for key, record in data['entries'])
+        except (OSError, ValueError, KeyError, TypeError):
+            self.index = OrderedDict()
+        self.totalSize = sum(record[1] for record in self.index.values())
+        try:
+            folders = [entry.path for entry in os.scandir(self.folder) if entry.is_dir()]
+        except OSError:
+            return
+        for folder in folders:
+            for entry in os.scandir(folder):
+                if entry.name.endswith('.tmp') and time.time() - entry.stat().st_mtime < STALE_TIME:
+                    continue  # still being written by another sync
+                if entry.name not in self.index:
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+
+    def save(self):
+        with self.lock:
+            if not self.isDirty:
+                return
+            text = json.dumps({'version': CACHE_VERSION, 'entries': list(self.index.items())},
+                              ensure_ascii=False, separators=(',', ':'))
+            self.isDirty = False
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            with open(self.indexPath + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(self.indexPath + '.tmp', self.indexPath)
+        except OSError:
+            pass
+
+    def get(self, src, size, mtime, buffer=None):
+        """ path of the cached copy of `src` if it is still the same file, else None """
+        key = self.key(src)
+        with self.lock:
+            record = self.index.get(key)
+            if record is None:
+                return None
+            if record[1] != size or record[2] != mtime:
+                self.discard(key)
+                return None
+            self.index.move_to_end(key)
+            self.isDirty = True
+        path = self.entryPath(src, key)
+        try:
+            isValid = os.path.getsize(path) == size
+            if isValid and self.isHashChecked:
+                isValid = hashFile(path, CACHE_HASH, buffer or bytearray(MB)) == record[3]
+        except OSError:
+            isValid = False
+        if not isValid:
+            with self.lock:
+                self.discard(key)
+            return None
+        return path
+
+    def contains(self, src, size, mtime):
+        """ whether the index holds `src` as it is now, without checking the entry or marking it used """
+        with self.lock:
+            record = self.index.get(self.key(src))
+        return record is not None and record[1] == size and record[2] == mtime
+
+    def open(self, src, size, mtime):
+        """ writer filling the cache entry of `src`, None if the file could never fit """
+        if size > self.maxSize:
+            return None
+        return CacheWriter(self, src, size, mtime)
+
+    def add(self, src, size, mtime, hash):
+        key = self.key(src)
+        with self.lock:
+            if key in self.index:
+                self.totalSize -= self.index.pop(key)[1]
+            self.index[key] = [src, size, mtime, hash]
+            self.totalSize += size
+            self.isDirty = True
+            self.evict()
+
+    def evict(self):
+        """ drop the least recently used entries until the cache fits `maxSize` """
+        with self.lock:
+            while self.totalSize > self.maxSize and self.index:
+                self.discard(next(iter(self.index)))
+
+    def discard(self, key):
+        record = self.index.pop(key, None)
+        if record is None:
+            return
+        self.totalSize -= record[1]
+        self.isDirty = True
+        try:
+            os.remove(self.entryPath(record[0], key))
+        except OSError:
+            pass
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.index):
+                self.discard(key)
+            self.save()
+
+
+class CacheWarmer:
+    """ Fill the cache from the source folders while no sync is running
+
+    The folders are walked again every `interval` seconds. A folder whose mtime is unchanged
+    keeps its last listing, except on every WARM_FULL_WALK-th pass, as edits inside a file do
+    not touch the folder. The newest files are fetched first while they fit in WARM_SHARE of the
+    cache, at background priority and at most `rate` bytes per second. Files already in the
+    index are left alone, neither hashed again nor moved up the LRU order. `isIdle()` is polled
+    between files and chunks and the warmer waits while it returns False.
+    """
+
+    def __init__(self, cache: SourceCache, folders, options=None, rate=None, isIdle=None, interval=WARM_INTERVAL):
+        self.cache = cache
+        self.folders = [folder for folder in folders if folder]
+        self.options = options
+        self.limiter = RateLimiter(rate)
+        self.isIdle = isIdle or (lambda: True)
+        self.interval = interval
+        self.listings = {}  # folder -> (mtime_ns, [(name, isDir, size, mtime), ...])
+        self.passes = 0
+        self.chunkSize = MB
+        self.isRunning = True
+        self.wakeup = threading.Event()
+
+    def stop(self):
+        self.isRunning = False
+        self.wakeup.set()
+
+    def run(self):
+        setBackgroundPriority()
+        while self.isRunning:
+            self.warm()
+            self.cache.save()
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+    def waitIdle(self):
+        while self.isRunning and not self.isIdle():
+            self.wakeup.wait(IDLE_STEP)
+        return self.isRunning
+
+    def warm(self):
+        """ one pass over the source folders """
+        isFullWalk = self.passes % WARM_FULL_WALK == 0
+        self.passes += 1
+        files = []
+        for folder in self.folders:
+            self.walk(folder, files, isFullWalk)
+        files.sort(key=lambda file: file[2], reverse=True)
+        budget = self.cache.maxSize * WARM_SHARE
+        for path, size, mtime in files:
+            if size > budget:
+                continue  # an older, smaller file may still fit
+            budget -= size
+            if self.cache.contains(path, size, mtime):
+                continue
+            if not self.waitIdle():
+                return
+            self.fetch(path, size, mtime)
+
+    def walk(self, folder, files, isFullWalk):
+        def listFolder(path):
+            entries = self.list(path, isFullWalk)
+            return entries, [os.path.join(path, name) for name, isDir, _, _ in entries if isDir]
+
+        for path, entries, error in TreeWalker(listFolder, WARM_WALK_WORKERS).walk([folder]):
+            if not self.waitIdle():
+                break
+            if error is not None:
+                continue
+            for name, isDir, size, mtime in entries:
+                if not isDir and (self.options is None or self.options.isWanted(size, mtime)):
+                    files.append((os.path.join(path, name), size, mtime))
+
+    def list(self, path, isFullWalk):
+        mtimeNs = os.stat(path).st_mtime_ns
+        listing = self.listings.get(path)
+        if listing and listing[0] == mtimeNs and not isFullWalk:
+            return listing[1]
+        typeFilter = self.options.typeFilter if self.options else None
+        entries = []
+        for entry in os.scandir(path):
+            isDir = entry.is_dir(follow_symlinks=False)
+            if typeFilter and not typeFilter.isWanted(entry.name, isDir):
+                continue
+            stat = entry.stat(follow_symlinks=False)
+            entries.append((entry.name, isDir, stat.st_size, stat.st_mtime))
+        self.listings[path] = (mtimeNs, entries)
+        return entries
+
+    def fetch(self, path, size, mtime):
+        writer = self.cache.open(path, size, mtime)
+        if writer is None:
+            return
+        try:
+            with open(path, 'rb', buffering=0) as f:
+                while True:
+                    if not self.waitIdle():
+                        writer.abort()
+                        return
+                    chunk = f.read(self.chunkSize)
+                    if not chunk:
+                        break
+                    self.limiter.consume(len(chunk))
+                    writer.write(chunk)
+            stat = os.stat(path)
+        except OSError:
+            writer.abort()
+            return
+        if stat.st_size != size or stat.st_mtime != mtime:
+            # changed while it was read
+            writer.abort()
+            return
+        writer.commit()
+
+
+def getCacheSize(folder=CACHE_FOLDER):
+    """ bytes used by the cache in `folder`, counted on the disk """
+    size = 0
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+def clearCache(folder=CACHE_FOLDER):
+    """ remove every entry of the cache in `folder` """
+    cache = SourceCache.instances.get(folder) or SourceCache(folder)
+    cache.clear()
@@ -36,8 +36,21 @@ class Config(QConfig):
     ScanCycle = RangeConfigItem("MainWindow", "ScanCycle", 10, RangeValidator(1, 50))
     ConcurrentProcess = ConfigItem("MainWindow", "ConcurrentProcess", 3, RangeValidator(1, 5))
     BufSize = OptionsConfigItem("MainWindow", "BufSize", BufSize._256, OptionsValidator(BufSize), EnumSerializer(BufSize))
+    Engine = OptionsConfigItem("MainWindow", "Engine", "FastCopy", OptionsValidator(["FastCopy", "Native"]))
+    Verify = OptionsConfigItem("MainWindow", "Verify", "Off", OptionsValidator(["Off", "xxHash", "SHA-256"]))
+    FanOut = OptionsConfigItem("MainWindow", "FanOut", False, BoolValidator())
+    IsDelta = OptionsConfigItem("MainWindow", "IsDelta", False, BoolValidator())
+    IsAutoTune = OptionsConfigItem("MainWindow", "IsAutoTune", False, BoolValidator())
+    LowIoRate = RangeConfigItem("MainWindow", "LowIoRate", 10, RangeValidator(1, 100))
+    PackOrder = OptionsConfigItem("MainWindow", "PackOrder", "Off", OptionsValidator(["Off", "Priority", "Recent", "Small"]))
     dpiScale = OptionsConfigItem("MainWindow", "DpiScale", "Auto", OptionsValidator([1, 1.25, 1.5, 1.75, 2, "Auto"]), restart=True)
 
+    IsCache = OptionsConfigItem("Cache", "IsCache", False, BoolValidator())
+    CacheSize = RangeConfigItem("Cache", "CacheSize", 20, RangeValidator(1, 200))
+    IsCacheHash = OptionsConfigItem("Cache", "IsCacheHash", False, BoolValidator())
+    IsPrewarm = OptionsConfigItem("Cache", "IsPrewarm", False, BoolValidator())
+    PrewarmRate = RangeConfigItem("Cache", "PrewarmRate", 10, RangeValidator(1, 100))
+
     IsSkipEmptyDir = OptionsConfigItem("Filter", "IsSkipEmptyDir", False, BoolValidator())
     IsSizeFilter = OptionsConfigItem("Filter", "IsSizeFilter", False, BoolValidator())
     SizeFilterUnit = OptionsConfigItem("Filter", "SizeFilterUnit", "GB", OptionsValidator(["KB", "MB", "GB"]))
@@ -51,6 +64,7 @@ class Config(QConfig):
     IsApplication = OptionsConfigItem("Filter", "IsApplication", False, BoolValidator())
     IsZipFile = OptionsConfigItem("Filter", "IsZipFile", False, BoolValidator())
     IsCustom = OptionsConfigItem("Filter", "IsCustom", False, BoolValidator())
+    CustomTypes = ConfigItem("Filter", "CustomTypes", "")
 
 
 YEAR = "2025"
@@ -0,0 +1,2515 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import mmap
+import time
+import queue
+import shutil
+import fnmatch
+import hashlib
+import threading
+import subprocess
+from collections import deque
+from datetime import datetime, timedelta
+
+
+MB = 1024 * 1024
+MTIME_TOLERANCE = 2  # FAT32/exFAT store mtime with 2 s resolution
+USB_WRITERS = 2  # concurrent writers a flash drive handles without thrashing
+RECOPY_ATTEMPTS = 2  # times a file failing verification is copied again
+FANOUT_STEP = 0.01  # seconds the fan-out reader waits for a full drive queue
+DELTA_BLOCK = 256 * 1024  # block compared by delta writes
+DELTA_MIN_SIZE = 8 * MB  # smaller files are always copied whole
+SMALL_FILE_SIZE = 256 * 1024  # files up to this size are copied in one read and one write
+SMALL_FILE_WORKERS = 8  # threads overlapping the opens and creates of small files
+LARGE_FILE_SIZE = 32 * MB  # files from this size on are read and written on separate threads
+MAX_CHUNK_SIZE = 64 * MB
+TUNE_INTERVAL = 2.0  # seconds of copying the auto tuner measures before judging a step
+TUNE_GAIN = 0.05  # relative change of throughput the tuner tells apart from noise
+TUNE_CHUNK_STEP = 4 * MB  # additive increase of the chunk size
+SPEED_MIN_BYTES = 4 * MB  # less data than this says more about latency than about write speed
+LOW_IO_RATE = 10 * MB  # write bandwidth of a low io sync
+LOW_IO_HASH_SHARE = 0.25  # part of a core the hashing of a low io sync may take
+LOW_IO_LATENCY_FACTOR = 3  # a write this much slower than usual means another program is using the disk
+LOW_IO_LATENCY_FLOOR = 0.01  # seconds per MB, faster writes are never taken for contention
+LOW_IO_YIELD_MIN = 0.05  # first pause of a low io writer when the disk is busy, doubled while it stays busy
+LOW_IO_YIELD_MAX = 1.0
+WALK_WORKERS = 16  # folders listed at once, a walk of a share waits on round trips rather than on the disk
+PRESTO_PREFIX = '.presto_'  # manifest and journal beside the subjects, never pruned
+PART_SUFFIX = '.presto-part'  # files are written under this suffix and renamed when complete
+CHECKPOINT_SIZE = 64 * MB  # a large file copy is flushed and journaled every that many bytes
+IOPRIO_SET = {'x86_64': 251, 'aarch64': 30, 'i386': 289, 'i686': 289}  # ioprio_set syscall numbers on Linux
+PACK_RESERVE = 16 * MB  # left free on a packed drive for the folders, the manifest and the journal
+VERIFY_HASHES = ('xxHash', 'SHA-256')
+PACK_ORDERS = ('Priority', 'Recent', 'Small')
+FILE_TYPES = {
+    'Document': ('.pdf', '.doc', '.docx', '.ppt', '.pptx', '.txt'),
+    'Picture': ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.svg', '.webp'),
+    'Audio': ('.mp3', '.wav', '.flac', '.ape', '.acc', '.ogg', '.wma'),
+    'Video': ('.mp4', '.avi', '.mov', '.wmv', '.mkv'),
+    'Application': ('.exe', '.dll', '.msi', '.bat', '.cmd'),
+    'ZipFile': ('.zip', '.rar', '.7z', '.iso')
+}
+
+
+class SyncOptions:
+    """ Options shared by all sync backends """
+
+    def __init__(self, bufSize=256 * MB, concurrentProcess=3, commandOption='', isMirror=True,
+                 isSkipEmptyDir=False, maxSize=None, fromTime=None, toTime=None, isLowIo=False, verify=None,
+                 typeFilter=None, cache=None, isDelta=False, smallFileSize=SMALL_FILE_SIZE,
+                 largeFileSize=LARGE_FILE_SIZE, isMmap=True, isAutoTune=False, lowIoRate=LOW_IO_RATE,
+                 walkWorkers=WALK_WORKERS, isDelete=False, packOrder=None):
+        self.bufSize = bufSize
+        self.concurrentProcess = concurrentProcess
+        self.commandOption = commandOption
+        self.isMirror = isMirror
+        self.isDelete = isDelete  # remove what the new selection leaves out, outside a date range included
+        self.packOrder = packOrder if packOrder in PACK_ORDERS else None  # see packPlans, None cancels a sync that does not fit
+        self.isSkipEmptyDir = isSkipEmptyDir
+        self.maxSize = maxSize
+        self.fromTime = fromTime
+        self.toTime = toTime
+        self.isLowIo = isLowIo
+        self.lowIoRate = lowIoRate
+        self.throttle = LowIoThrottle(lowIoRate) if isLowIo else None  # shared by every worker
+        self.verify = verify if verify in VERIFY_HASHES else None
+        self.typeFilter = typeFilter
+        self.cache = cache  # PrestoCache.SourceCache the native copies read through, None to read the source
+        self.index = None  # PrestoIndex.MtimeIndex.shared, folder -> index date ranges are looked up in, None walks
+        self.isDelta = isDelta
+        self.smallFileSize = smallFileSize
+        self.largeFileSize = largeFileSize  # None copies every file on one thread
+        self.isMmap = isMmap  # map large sources on local disks instead of reading them
+        self.isAutoTune = isAutoTune
+        self.walkWorkers = walkWorkers  # threads listing folders while a tree is planned, 1 walks on the planning thread
+        self.tunedChunkSize = None  # set by the AutoTuner, overrides the derived chunk size
+
+    @property
+    def chunkSize(self):
+        """ size of a single read/write, derived from the configured buffer size unless tuned """
+        if self.tunedChunkSize:
+            return self.tunedChunkSize
+        return max(MB, min(self.bufSize // 8, MAX_CHUNK_SIZE))
+
+    @property
+    def largeChunkSize(self):
+        """ size of each of the two buffers of a large file copy, every worker holds its own pair """
+        return max(self.chunkSize, min(self.bufSize // (2 * max(1, self.concurrentProcess)), 128 * MB))
+
+    def parseCommandOption(self, commandOption):
+        """ read the date range and io flags out of a fcp style command option """
+        self.commandOption = commandOption
+        self.isLowIo = '/low_io' in commandOption
+        self.throttle = LowIoThrottle(self.lowIoRate) if self.isLowIo else None
+
+        match = re.search(r'/from_date=(-?)(\d+)(D?)', commandOption)
+        if match:
+            if match.group(1):
+                self.fromTime = time.time() - int(match.group(2)) * 86400
+            else:
+                self.fromTime = datetime.strptime(match.group(2), '%Y%m%d').timestamp()
+
+        match = re.search(r'/to_date=(\d+)', commandOption)
+        if match:
+            self.toTime = (datetime.strptime(match.group(1), '%Y%m%d') + timedelta(days=1)).timestamp()
+
+        if self.fromTime is not None or self.toTime is not None:
+            self.isMirror = False
+
+    def isWanted(self, size, mtime):
+        if self.maxSize is not None and size > self.maxSize:
+            return False
+        if self.fromTime is not None and mtime < self.fromTime:
+            return False
+        if self.toTime is not None and mtime >= self.toTime:
+            return False
+        return True
+
+
+class TypeFilter:
+    """ File name filter compiled once per sync
+
+    `patterns` are fcp style wildcards, `*.ext` patterns go into a set of suffixes and the
+    rest into a single regular expression. A pattern ending with a backslash names folders and
+    is matched against the name of every folder on the way down, as fcp.exe does. Excluded
+    folders are not walked at all. With folder patterns in an include filter only the matching
+    folders are walked, and with no file patterns every file in them is taken.
+    """
+
+    def __init__(self, patterns, isInclude=False):
+        self.patterns = [p.strip() for p in patterns if p.strip()]
+        self.isInclude = isInclude
+        suffixes, files, dirs = set(), [], []
+        for pattern in self.patterns:
+            pattern = pattern.lower().replace('/', '\\')
+            if pattern.endswith('\\'):
+                dirs.append(fnmatch.translate(pattern.rstrip('\\')))
+            elif re.fullmatch(r'\*\.[^.*?\[\]]+', pattern):
+                suffixes.add(pattern[1:])
+            else:
+                files.append(fnmatch.translate(pattern))
+        self.suffixes = frozenset(suffixes)
+        self.isAnyFile = not (suffixes or files)
+        self.fileRegex = re.compile('|'.join(files)) if files else None
+        self.dirRegex = re.compile('|'.join(dirs)) if dirs else None
+
+    @classmethod
+    def create(cls, types, custom='', isInclude=False):
+        """ filter for the categories of FILE_TYPES in `types` and the `;` separated `custom` patterns """
+        patterns = ['*' + suffix for name in types for suffix in FILE_TYPES[name]]
+        patterns += custom.replace(',', ';').split(';')
+        typeFilter = cls(patterns, isInclude)
+        return typeFilter if typeFilter.patterns else None
+
+    @property
+    def key(self):
+        """ identifies the filter, listings recorded under another filter cannot be reused """
+        return ('+' if self.isInclude else '-') + ';'.join(sorted(p.lower() for p in self.patterns))
+
+    def isWanted(self, name, isDir=False):
+        name = name.lower()
+        if isDir:
+            if self.dirRegex is None:
+                return True
+            return bool(self.dirRegex.match(name)) == self.isInclude
+        if self.isInclude and self.isAnyFile:
+            return True
+        isMatch = os.path.splitext(name)[1] in self.suffixes or bool(self.fileRegex and self.fileRegex.match(name))
+        return isMatch == self.isInclude
+
+    def fcpOption(self):
+        return f'/{"include" if self.isInclude else "exclude"}="{";".join(self.patterns)}"'
+
+
+class IoLimiter:
+    """ Bound the number of concurrent reads or writes, unlimited if `limit` is None
+
+    The limit may change while the limiter is in use. The time spent inside is summed up,
+    which gives the tuner the latency of the device. While paused, threads wait on entry, so
+    a copy parks between two chunks with its files open and its buffers filled.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.isPaused = False
+        self.active = 0
+        self.operations = 0
+        self.busyTime = 0.0
+        self.local = threading.local()
+        self.condition = threading.Condition()
+
+    def setLimit(self, limit):
+        with self.condition:
+            self.limit = limit
+            self.condition.notify_all()
+
+    def stats(self):
+        """ (operations, seconds spent inside) so far """
+        with self.condition:
+            return self.operations, self.busyTime
+
+    def pause(self):
+        with self.condition:
+            self.isPaused = True
+
+    def resume(self):
+        with self.condition:
+            self.isPaused = False
+            self.condition.notify_all()
+
+    def __enter__(self):
+        with self.condition:
+            while self.isPaused or (self.limit and self.active >= self.limit):
+                self.condition.wait()
+            self.active += 1
+        self.local.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        elapsed = time.monotonic() - self.local.start
+        with self.condition:
+            self.active -= 1
+            self.operations += 1
+            self.busyTime += elapsed
+            self.condition.notify()
+
+
+class RateLimiter:
+    """ Token bucket holding the transfer rate at `rate` bytes per second, unlimited if it is None """
+
+    def __init__(self, rate=None, burst=1.0):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = 0.0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, nbytes):
+        """ take `nbytes` from the bucket, sleeping until they are available """
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate * self.burst, self.tokens + (now - self.last) * self.rate) - nbytes
+            self.last = now
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+
+class LowIoThrottle:
+    """ Keep a low io sync out of the way of whatever the user is doing
+
+    Writes are held to `rate` bytes per second by a token bucket shared by all workers.
+    Hashing may take `hashShare` of a core, the hashing thread sleeps off the rest of its
+    time. The time each write takes per MB is compared with its running average; a write
+    LOW_IO_LATENCY_FACTOR times slower means other programs are waiting for the disk, and
+    the writer pauses, twice as long each time in a row.
+    """
+
+    def __init__(self, rate=LOW_IO_RATE, hashShare=LOW_IO_HASH_SHARE):
+        self.limiter = RateLimiter(rate)
+        self.hashShare = hashShare
+        self.latency = None  # running average, seconds per MB
+        self.pause = 0.0
+        self.yields = 0
+        self.lock = threading.Lock()
+
+    def pace(self, nbytes, seconds):
+        """ account for a write of `nbytes` that took `seconds` """
+        self.limiter.consume(nbytes)
+        latency = seconds * MB / max(nbytes, MB)
+        with self.lock:
+            if self.latency is None:
+                self.latency = latency
+            isBusy = latency > max(LOW_IO_LATENCY_FLOOR, LOW_IO_LATENCY_FACTOR * self.latency)
+            self.latency += 0.05 * (latency - self.latency)
+            if isBusy:
+                self.pause = min(LOW_IO_YIELD_MAX, max(LOW_IO_YIELD_MIN, self.pause * 2))
+                self.yields += 1
+            else:
+                self.pause = 0.0
+            pause = self.pause
+        if pause:
+            time.sleep(pause)
+
+    def hashed(self, seconds):
+        """ account for `seconds` of cpu time spent hashing """
+        if 0 < self.hashShare < 1:
+            time.sleep(seconds * (1 / self.hashShare - 1))
+
+
+class ThrottledHasher:
+    """ Hasher whose cpu time is paced by a LowIoThrottle """
+
+    def __init__(self, hasher, throttle: LowIoThrottle):
+        self.hasher = hasher
+        self.throttle = throttle
+
+    def update(self, data):
+        start = time.thread_time()
+        self.hasher.update(data)
+        self.throttle.hashed(time.thread_time() - start)
+
+    def __getattr__(self, name):
+        return getattr(self.hasher, name)
+
+
+def throttleHasher(hasher, throttle):
+    return ThrottledHasher(hasher, throttle) if throttle and hasher else hasher
+
+
+def setIdleIoPriority():
+    """ put the calling thread in the idle io class of Linux, it only gets the disk when nobody else wants it """
+    number = IOPRIO_SET.get(os.uname().machine) if hasattr(os, 'uname') else None
+    if number is None:
+        return False
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+    # IOPRIO_WHO_PROCESS with a thread id, IOPRIO_CLASS_IDLE in the top bits of the priority
+    return libc.syscall(number, 1, threading.get_native_id(), 3 << 13) == 0
+
+
+def setBackgroundPriority():
+    """ lower the cpu and io priority of the calling thread, returns whether it worked """
+    try:
+        if os.name == 'nt':
+            import ctypes
+            kernel32 = ctypes.windll.kernel32
+            # THREAD_MODE_BACKGROUND_BEGIN lowers the io and memory priority as well
+            return bool(kernel32.SetThreadPriority(kernel32.GetCurrentThread(), 0x00010000))
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        # without an explicit io class the io priority of a thread follows its nice value
+        setIdleIoPriority()
+        return True
+    except (OSError, AttributeError):
+        return False
+
+
+class VerifyError(OSError):
+    """ Copied file does not match its source """
+
+
+def createHash(name):
+    """ hash object for `name`, xxHash falls back to BLAKE2 when the xxhash package is missing """
+    if name == 'SHA-256':
+        return hashlib.sha256()
+    try:
+        import xxhash
+        return xxhash.xxh3_64()
+    except (ImportError, AttributeError):
+        return hashlib.blake2b(digest_size=8)
+
+
+class BlockHasher:
+    """ Hashes of the consecutive DELTA_BLOCK blocks of a stream, the signature used by delta writes """
+
+    def __init__(self):
+        self.sums = []
+        self.hasher = None
+        self.filled = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        start = 0
+        while start < len(view):
+            if self.hasher is None:
+                self.hasher = hashlib.blake2b(digest_size=8)
+                self.filled = 0
+            n = min(len(view) - start, DELTA_BLOCK - self.filled)
+            self.hasher.update(view[start:start + n])
+            self.filled += n
+            start += n
+            if self.filled == DELTA_BLOCK:
+                self.sums.append(self.hasher.hexdigest())
+                self.hasher = None
+
+    def digest(self):
+        if self.hasher is not None:
+            self.sums.append(self.hasher.hexdigest())
+            self.hasher = None
+        return self.sums
+
+
+def signatureKey(sums):
+    """ short key of the block hashes `sums`, journaled to tie a delta write to the signature it compares with """
+    return hashlib.blake2b('\n'.join(sums).encode(), digest_size=8).hexdigest()
+
+
+def setFileTime(f, mtime):
+    """ set the mtime through the open file `f`, saving the open of os.utime, returns whether it worked """
+    try:
+        if os.utime in os.supports_fd:
+            os.utime(f.fileno(), (mtime, mtime))
+            return True
+        if os.name == 'nt':
+            import ctypes
+            import msvcrt
+            from ctypes import wintypes
+            ticks = int((mtime + 11644473600) * 10000000)
+            fileTime = wintypes.FILETIME(ticks & 0xFFFFFFFF, ticks >> 32)
+            handle = wintypes.HANDLE(msvcrt.get_osfhandle(f.fileno()))
+            return bool(ctypes.windll.kernel32.SetFileTime(handle, None, ctypes.byref(fileTime), ctypes.byref(fileTime)))
+    except (OSError, ValueError, AttributeError):
+        pass
+    return False
+
+
+def partPath(path):
+    return path + PART_SUFFIX
+
+
+def removeFile(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def preallocate(f, size):
+    """ give the new file `f` its final size up front, so the drive can hand out contiguous clusters """
+    if not size:
+        return
+    try:
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(f.fileno(), 0, size)
+        else:
+            f.truncate(size)
+    except OSError:
+        pass
+
+
+def isLocalPath(path):
+    """ whether `path` is on a local fixed disk, only such files are mapped into memory """
+    path = os.path.abspath(path)
+    if path.startswith('\\\\') or path.startswith('//'):
+        return False
+    if os.name == 'nt':
+        try:
+            import ctypes
+            return ctypes.windll.kernel32.GetDriveTypeW(os.path.splitdrive(path)[0] + '\\') == 3  # DRIVE_FIXED
+        except (OSError, AttributeError):
+            return False
+    return True
+
+
+def readFull(f, view):
+    """ fill `view` from `f` unless the end of the file comes first, returns the bytes read """
+    total = 0
+    while total < len(view):
+        n = f.readinto(view[total:])
+        if not n:
+            break
+        total += n
+    return total
+
+
+class UncachedFile:
+    """ File opened on Windows with FILE_FLAG_NO_BUFFERING, its reads go to the drive and not the file cache
+
+    The buffer given to `readinto` must be page aligned and a whole number of sectors long,
+    see alignedBuffer.
+    """
+
+    def __init__(self, path):
+        import ctypes
+        from ctypes import wintypes
+        self.kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+        self.kernel32.CreateFileW.restype = wintypes.HANDLE
+        # GENERIC_READ, FILE_SHARE_READ | FILE_SHARE_WRITE, OPEN_EXISTING,
+        # FILE_FLAG_NO_BUFFERING | FILE_FLAG_SEQUENTIAL_SCAN
+        self.handle = self.kernel32.CreateFileW(path, 0x80000000, 0x3, None, 3, 0x20000000 | 0x08000000, None)
+        if self.handle is None or self.handle == wintypes.HANDLE(-1).value:
+            error = ctypes.get_last_error()
+            raise OSError(None, ctypes.FormatError(error), path, error)
+        self.read = wintypes.DWORD()
+
+    def readinto(self, buffer):
+        import ctypes
+        view = (ctypes.c_char * len(buffer)).from_buffer(buffer)
+        if not self.kernel32.ReadFile(ctypes.c_void_p(self.handle), view, len(buffer), ctypes.byref(self.read), None):
+            raise ctypes.WinError(ctypes.get_last_error())
+        return self.read.value
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        import ctypes
+        self.kernel32.CloseHandle(ctypes.c_void_p(self.handle))
+
+
+def alignedBuffer(size):
+    """ page aligned buffer of at least `size` bytes, rounded up to whole pages, as UncachedFile needs """
+    return mmap.mmap(-1, -(-size // mmap.PAGESIZE) * mmap.PAGESIZE)
+
+
+def openUncached(path):
+    """ open `path` for reading past the system file cache, so a read back comes from the drive """
+    if os.name == 'nt':
+        return UncachedFile(path)
+    f = open(path, 'rb', buffering=0)
+    if hasattr(os, 'posix_fadvise'):
+        # drops the clean pages, the written ones must have been flushed by the copy
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    return f
+
+
+def hashFile(path, name, buffer, limiter=None, throttle=None, isUncached=False):
+    """ hash the content of `path`, as it is on the disk and not in the file cache if `isUncached`
+
+    An uncached read needs a `buffer` from alignedBuffer.
+    """
+    hasher = throttleHasher(createHash(name), throttle)
+    view = memoryview(buffer)
+    with openUncached(path) if isUncached else open(path, 'rb', buffering=0) as f:
+        while True:
+            with limiter or IoLimiter():
+                n = f.readinto(buffer)
+            if not n:
+                break
+            hasher.update(view[:n])
+    return hasher.hexdigest()
+
+
+class Verifier:
+    """ Re-read copied files on worker threads that trail behind the copies
+
+    The hash of the source is taken from the copy buffer, so the source is read only once.
+    `join` waits for the queued files and returns the (item, expected, actual) that differ.
+    """
+
+    def __init__(self, name, chunkSize, limiter=None, workers=1, throttle=None):
+        self.name = name
+        self.chunkSize = chunkSize
+        self.limiter = limiter
+        self.workers = workers
+        self.throttle = throttle
+        self.queue = queue.Queue()
+        self.threads = []
+        self.mismatches = []
+        self.lock = threading.Lock()
+
+    def submit(self, path, digest, item):
+        with self.lock:
+            # the small file workers submit concurrently, only one of them starts the threads
+            if not self.threads:
+                self.threads = [threading.Thread(target=self.work, daemon=True) for _ in range(self.workers)]
+                for thread in self.threads:
+                    thread.start()
+        self.queue.put((path, digest, item))
+
+    def work(self):
+        if self.throttle:
+            setBackgroundPriority()
+        buffer = alignedBuffer(self.chunkSize)
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            path, digest, item = job
+            try:
+                actual = hashFile(path, self.name, buffer, self.limiter, self.throttle, True)
+            except OSError:
+                actual = None
+            if actual != digest:
+                with self.lock:
+                    self.mismatches.append((item, digest, actual))
+
+    def join(self):
+        with self.lock:
+            threads, self.threads = self.threads, []
+        for _ in threads:
+            self.queue.put(None)
+        for thread in threads:
+            thread.join()
+        with self.lock:
+            mismatches, self.mismatches = self.mismatches, []
+        return mismatches
+
+
+class TreeWalker:
+    """ Walk folder trees on several threads, streaming each folder out as soon as it is listed
+
+    `list(item)` lists one folder and returns (result, subfolder items). Every worker keeps a
+    deque of folders. It pushes the subfolders it finds and takes the last one back, so its
+    walk stays depth first where the listings are still cached. A worker with an empty deque
+    steals the oldest folder, the root of the largest untouched subtree, from the fullest deque.
+    `walk` yields (item, result, error) in the order the folders are listed.
+    """
+
+    def __init__(self, list, workers=WALK_WORKERS):
+        self.list = list
+        self.workers = max(1, workers)
+        self.isRunning = True
+        self.condition = threading.Condition()
+
+    def stop(self):
+        with self.condition:
+            self.isRunning = False
+            self.condition.notify_all()
+
+    def walk(self, roots):
+        roots = list(roots)
+        deques = [deque() for _ in range(self.workers)]
+        for i, root in enumerate(roots):
+            deques[i % self.workers].append(root)
+        pending = [len(roots)]  # folders queued or being listed
+        results = queue.Queue()
+
+        def take(own):
+            with self.condition:
+                while self.isRunning and pending[0]:
+                    if own:
+                        return own.pop()
+                    victim = max(deques, key=len)
+                    if victim:
+                        return victim.popleft()
+                    self.condition.wait()
+                return None
+
+        def work(own):
+            try:
+                while True:
+                    item = take(own)
+                    if item is None:
+                        break
+                    try:
+                        result, children = self.list(item)
+                        error = None
+                    except OSError as e:
+                        result, children, error = None, [], e
+                    with self.condition:
+                        own.extend(children)
+                        pending[0] += len(children) - 1
+                        if children or not pending[0]:
+                            self.condition.notify_all()
+                    results.put((item, result, error))
+            finally:
+                results.put(None)
+
+        threads = [threading.Thread(target=work, args=(own, ), daemon=True) for own in deques]
+        for thread in threads:
+            thread.start()
+        finished = 0
+        try:
+            while finished < len(threads):
+                record = results.get()
+                if record is None:
+                    finished += 1
+                else:
+                    yield record
+        finally:
+            # the consumer may leave early
+            self.stop()
+            for thread in threads:
+                thread.join()
+
+
+class Prefetcher:
+    """ Run a TreeWalker ahead of a consumer visiting the folders in an order of its own
+
+    `get(key)` waits until the walker has listed that folder, and returns (result, error), or
+    None once the walker has finished or stopped without listing it.
+    """
+
+    def __init__(self, walker: TreeWalker, roots, key):
+        self.walker = walker
+        self.key = key
+        self.results = {}
+        self.isDone = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, args=(list(roots), ), daemon=True)
+        self.thread.start()
+
+    def run(self, roots):
+        try:
+            for item, result, error in self.walker.walk(roots):
+                with self.condition:
+                    self.results[self.key(item)] = (result, error)
+                    self.condition.notify_all()
+        finally:
+            with self.condition:
+                self.isDone = True
+                self.condition.notify_all()
+
+    def get(self, key):
+        with self.condition:
+            while key not in self.results and not self.isDone:
+                self.condition.wait()
+            return self.results.pop(key, None)
+
+    def stop(self):
+        self.walker.stop()
+        self.thread.join()
+
+
+class ProgressEvent:
+    """ Snapshot of the progress of a sync """
+
+    def __init__(self, bytesDone, bytesTotal, filesDone, filesTotal, currentFile, throughput, eta):
+        self.bytesDone = bytesDone
+        self.bytesTotal = bytesTotal
+        self.filesDone = filesDone
+        self.filesTotal = filesTotal
+        self.currentFile = currentFile
+        self.throughput = throughput
+        self.eta = eta
+
+    @property
+    def percent(self):
+        if self.bytesTotal <= 0:
+            return 0
+        return min(100, int(self.bytesDone * 100 / self.bytesTotal))
+
+
+class ProgressTracker:
+    """ Collect byte counts from the copy workers and report them at most every `interval` seconds
+
+    Throughput is measured over the last `window` seconds, so the ETA follows the current
+    speed without jumping on every chunk.
+    """
+
+    def __init__(self, callback, interval=0.2, window=5.0):
+        self.callback = callback
+        self.interval = interval
+        self.window = window
+        self.bytesDone = 0
+        self.bytesTotal = 0
+        self.filesDone = 0
+        self.filesTotal = 0
+        self.currentFile = ''
+        self.samples = deque()
+        self.lastEmit = 0
+        self.lock = threading.Lock()
+
+    def addTotal(self, nbytes, files):
+        with self.lock:
+            self.bytesTotal += nbytes
+            self.filesTotal += files
+        self.emit(True)
+
+    def advance(self, nbytes):
+        with self.lock:
+            self.bytesDone += nbytes
+        self.emit()
+
+    def fileStarted(self, path):
+        self.currentFile = path
+        self.emit()
+
+    def fileFinished(self, count=1):
+        with self.lock:
+            self.filesDone += count
+        self.emit()
+
+    def throughput(self, now):
+        self.samples.append((now, self.bytesDone))
+        while len(self.samples) > 2 and now - self.samples[0][0] > self.window:
+            self.samples.popleft()
+        elapsed = now - self.samples[0][0]
+        if elapsed <= 0:
+            return 0
+        return (self.bytesDone - self.samples[0][1]) / elapsed
+
+    def snapshot(self):
+        with self.lock:
+            now = time.monotonic()
+            throughput = self.throughput(now)
+            remaining = max(0, self.bytesTotal - self.bytesDone)
+            eta = remaining / throughput if throughput > 0 else None
+            return ProgressEvent(self.bytesDone, self.bytesTotal, self.filesDone, self.filesTotal,
+                                 self.currentFile, throughput, eta)
+
+    def emit(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.lastEmit < self.interval:
+            return
+        self.lastEmit = now
+        self.callback(self.snapshot())
+
+
+class SyncPlan:
+    """ Work found by walking one subject folder, nothing is written until it is applied
+
+    copies:  (src, dst, rel, size, mtime) of the files to copy
+    deletes: (path, isDir, rel, size) of the destination entries to remove
+    folders: destination folders to create
+    marks:   (rel, names) folder listings recorded in the manifest afterwards
+    skipped: copies left out by packPlans as the drive has no room for them
+    replaced: rel -> size of the version on the drive of the files copied over
+    """
+
+    def __init__(self, source, dst):
+        self.source = source
+        self.dst = dst
+        self.subject = os.path.basename(source)
+        self.target = os.path.join(dst, self.subject)
+        self.copies = []
+        self.deletes = []
+        self.folders = []
+        self.marks = []
+        self.skipped = []
+        self.replaced = {}
+        self.bytesFreed = 0
+        self.isComplete = True
+        self.isTrusted = True
+
+    @property
+    def bytesTotal(self):
+        return sum(copy[3] for copy in self.copies)
+
+    @property
+    def filesTotal(self):
+        return len(self.copies)
+
+
+class PlanSummary:
+    """ Totals of the plans of every subject, checked against the free space of the drive """
+
+    @classmethod
+    def fromDict(cls, data):
+        summary = cls.__new__(cls)
+        summary.__dict__.update(data)
+        return summary
+
+    def __init__(self, plans, freeSpace):
+        plans = list(plans)
+        self.bytesTotal = sum(plan.bytesTotal for plan in plans)
+        self.filesTotal = sum(plan.filesTotal for plan in plans)
+        self.deletesTotal = sum(len(plan.deletes) for plan in plans)
+        self.bytesFreed = sum(plan.bytesFreed for plan in plans)
+        self.freeSpace = freeSpace
+        self.bytesShort = max(0, self.bytesTotal - self.bytesFreed - freeSpace)
+        self.skipped = sorted(copy[2] for plan in plans for copy in plan.skipped)
+        self.bytesSkipped = sum(copy[3] for plan in plans for copy in plan.skipped)
+
+    @property
+    def isFitting(self):
+        return self.bytesShort == 0
+
+
+def packPlans(plans, freeSpace, order):
+    """ leave out the copies the drive has no room for, `plans` come in subject priority order
+
+    The deletes of every plan count as free space. The space is then handed out subject by
+    subject, within a subject in plan order ('Priority'), newest first ('Recent') or smallest
+    first ('Small'). A file that does not fit is left out and the next ones are still tried.
+    The copies kept are written in that order, the others move to `plan.skipped`.
+    """
+    # the version on the drive of a file copied over is freed only if the copy is kept
+    space = freeSpace - PACK_RESERVE + sum(plan.bytesFreed - sum(plan.replaced.values()) for plan in plans)
+    for plan in plans:
+        copies = plan.copies
+        if order == 'Recent':
+            copies = sorted(copies, key=lambda copy: copy[4], reverse=True)
+        elif order == 'Small':
+            copies = sorted(copies, key=lambda copy: copy[3])
+        plan.copies = []
+        for copy in copies:
+            if copy[3] <= space:
+                # the new version is complete before the old one goes
+                space -= copy[3] - plan.replaced.get(copy[2], 0)
+                plan.copies.append(copy)
+            else:
+                plan.skipped.append(copy)
+                plan.bytesFreed -= plan.replaced.get(copy[2], 0)
+        if plan.skipped:
+            plan.isComplete = False
+
+
+def orderPlans(plans, tasks):
+    """ (task, plan) in the order the plans are applied, `tasks` are the (task, folder) pairs synced
+
+    Packed plans go in subject priority, the order of `tasks`, so what matters most is on the
+    drive first. Otherwise the largest go first and keep the workers busy to the end.
+    """
+    if any(plan.skipped for plan in plans.values()):
+        return [(task, plans[task]) for task, _ in tasks if task in plans]
+    return sorted(plans.items(), key=lambda item: item[1].bytesTotal, reverse=True)
+
+
+def openCached(cache, src, size, mtime, buffer=None):
+    """ (path to read, cache entry to fill or None), the path is the cached copy of `src` if it is valid """
+    if cache is None or size is None:
+        return src, None
+    path = cache.get(src, size, mtime, buffer)
+    if path:
+        return path, None
+    return src, cache.open(src, size, mtime)
+
+
+def getFreeSpace(path):
+    """ free bytes on the volume holding `path`, the nearest existing parent is used """
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    try:
+        return shutil.disk_usage(path).free
+    except OSError:
+        return 0
+
+
+class DeletePass:
+    """ Planned deletes of every subject, removed by their own workers while the copies run
+
+    The entries freeing the most space go first. A copy calls `reserve(size)` before writing and
+    goes ahead as soon as the free space of the drive, with the bytes freed so far, covers it.
+    Entries in the way of the plan, a folder replaced by a file or the other way round, or a
+    part file started over, are left to `SyncBackend.prepare`.
+    """
+
+    def __init__(self, plans, freeSpace):
+        self.queue = []
+        for plan in plans:
+            # paths written by the plan, what stands there goes before the folders are made
+            targets = {copy[1] for copy in plan.copies}
+            for folder in plan.folders:
+                while folder not in targets and len(folder) > len(plan.target):
+                    targets.add(folder)
+                    folder = os.path.dirname(folder)
+            self.queue += [delete for delete in plan.deletes if delete[2] is not None and delete[0] not in targets]
+        self.queue.sort(key=lambda delete: delete[3], reverse=True)
+        self.paths = {delete[0] for delete in self.queue}
+        self.available = freeSpace
+        self.failed = set()  # folders left incomplete by a failed delete
+        self.isDone = not self.queue
+        self.condition = threading.Condition()
+
+    def remove(self, backend, path, isDir, rel, size):
+        with backend.writeLimiter:
+            isRemoved = backend.removePath(path, isDir, rel)
+        with self.condition:
+            if isRemoved:
+                self.available += size
+            else:
+                self.failed.add(rel.rpartition('/')[0])
+            self.condition.notify_all()
+
+    def close(self):
+        """ every delete is done or the sync stopped, nothing waits any more """
+        with self.condition:
+            self.isDone = True
+            self.condition.notify_all()
+
+    def reserve(self, size):
+        with self.condition:
+            while not self.isDone and size > self.available:
+                self.condition.wait()
+            self.available -= size
+
+    def join(self):
+        with self.condition:
+            while not self.isDone:
+                self.condition.wait()
+
+
+class SyncBackend:
+    """ Sync backend base class """
+
+    name = ''
+
+    def __init__(self, options: SyncOptions):
+        self.options = options
+        self.isRunning = True
+        self.errors = []
+        self.mismatches = []
+        self.manifest = None
+        self.progress = None
+        self.readLimiter = IoLimiter()
+        self.writeLimiter = IoLimiter()
+        self.deletePass = None  # DeletePass running beside the copies, set by the SyncScheduler
+        self.measured = {'sequential': [0, 0.0], 'smallFile': [0, 0.0]}  # bytes written, seconds taken
+
+    def setManifest(self, manifest):
+        """ keep `manifest` in step with the changes made by this backend """
+        self.manifest = manifest
+
+    @property
+    def journal(self):
+        return self.manifest.journal if self.manifest else None
+
+    def write(self, f, data):
+        """ write `data` to the drive within the write limit, paced in low io mode """
+        with self.writeLimiter:
+            start = time.perf_counter()
+            f.write(data)
+            elapsed = time.perf_counter() - start
+        if self.options.throttle:
+            self.options.throttle.pace(len(data), elapsed)
+
+    def reserve(self, size):
+        """ wait until the drive has room for `size` more bytes, or until nothing is left to delete """
+        if self.deletePass:
+            self.deletePass.reserve(size)
+
+    def removePath(self, path, isDir, rel=None):
+        try:
+            if isDir:
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self.errors.append((path, e))
+            return False
+        if self.manifest and rel is not None:
+            self.manifest.remove(rel)
+        return True
+
+    def enterWorker(self):
+        """ called first on every thread the backend starts """
+        if self.options.isLowIo:
+            setBackgroundPriority()
+
+    def setProgress(self, progress: ProgressTracker):
+        self.progress = progress
+
+    def isAvailable(self):
+        return True
+
+    def stop(self):
+        self.isRunning = False
+        # parked workers have to see the stop
+        self.resume()
+
+    def pause(self):
+        """ hold the copies at the next chunk, nothing is lost or repeated by `resume` """
+        self.readLimiter.pause()
+        self.writeLimiter.pause()
+
+    def resume(self):
+        self.readLimiter.resume()
+        self.writeLimiter.resume()
+
+    def plan(self, src, dst) -> SyncPlan:
+        """ find what syncing folder `src` into folder `dst` would change, without writing anything """
+        raise NotImplementedError
+
+    def planStrays(self, dst, subjects):
+        """ deletes (path, isDir, rel, size) of the entries of `dst` outside `subjects`, if options.isDelete """
+        return []
+
+    def apply(self, plan: SyncPlan):
+        """ carry out a plan made by `plan` """
+        raise NotImplementedError
+
+    def sync(self, src, dst):
+        """ sync folder `src` into folder `dst`, the result is `dst/basename(src)` """
+        plan = self.plan(src, dst)
+        if self.progress:
+            self.progress.addTotal(plan.bytesTotal, plan.filesTotal)
+        self.apply(plan)
+
+
+class FastCopyBackend(SyncBackend):
+    """ Backend running FastCopy (fcp.exe) """
+
+    name = 'FastCopy'
+
+    def __init__(self, options: SyncOptions, executable='fcp.exe'):
+        super().__init__(options)
+        self.executable = executable
+        self.process = None
+        self.planner = None
+
+    def isAvailable(self):
+        return os.path.exists(self.executable)
+
+    def stop(self):
+        super().stop()
+        if self.planner:
+            self.planner.stop()
+        if self.process:
+            try:
+                self.process.terminate()
+            except:
+                pass
+
+    def pause(self):
+        super().pause()
+        self.suspend(True)
+
+    def resume(self):
+        super().resume()
+        self.suspend(False)
+
+    def suspend(self, isSuspended):
+        """ suspend or resume fcp.exe and the processes it started """
+        if not self.process:
+            return
+        try:
+            import psutil
+            process = psutil.Process(self.process.pid)
+            for child in [process] + process.children(recursive=True):
+                if isSuspended:
+                    child.suspend()
+                else:
+                    child.resume()
+        except Exception:
+            pass
+
+    def run(self, args):
+        if not self.isRunning:
+            return
+        self.process = subprocess.Popen(args, shell=True)
+        self.process.wait()
+
+    def plan(self, src, dst):
+        # fcp.exe has no dry run that reports sizes, the walk of the native backend stands in for it
+        self.planner = NativeBackend(self.options)
+        self.planner.setManifest(self.manifest)
+        if not self.isRunning:
+            self.planner.stop()
+        plan = self.planner.plan(src, dst)
+        self.errors.extend(self.planner.errors)
+        return plan
+
+    def planStrays(self, dst, subjects):
+        planner = NativeBackend(self.options)
+        planner.setManifest(self.manifest)
+        return planner.planStrays(dst, subjects)
+
+    def apply(self, plan):
+        # fcp.exe reports nothing back, the subject advances in one step when it is done
+        self.reserve(plan.bytesTotal)
+        if self.progress:
+            self.progress.fileStarted(plan.subject)
+        buf = self.options.bufSize // MB
+        extra = ' /verify' if self.options.verify else ''
+        if self.options.typeFilter:
+            extra += ' ' + self.options.typeFilter.fcpOption()
+        self.run(f'{self.executable} /cmd=sync /log=FALSE /no_confirm_stop /error_stop=FALSE /bufsize={buf}{extra} '
+                 f'/force_start={self.options.concurrentProcess} {self.options.commandOption} "'
+                 + plan.source.replace('/', '\\') + f'" /to="{plan.dst}"')
+        if self.progress:
+            self.progress.advance(plan.bytesTotal)
+            self.progress.fileFinished(plan.filesTotal)
+        if self.manifest:
+            self.manifest.invalidate(plan.subject)
+
+
+class NativeBackend(SyncBackend):
+    """ Cross-platform backend implemented with the standard library """
+
+    name = 'Native'
+
+    def __init__(self, options: SyncOptions):
+        super().__init__(options)
+        self.buffer = None
+        self.largeBuffers = []
+        self.prefetcher = None
+
+    def stop(self):
+        super().stop()
+        prefetcher = self.prefetcher
+        if prefetcher:
+            prefetcher.walker.stop()
+
+    def getBuffer(self):
+        if self.buffer is None or len(self.buffer) != self.options.chunkSize:
+            self.buffer = bytearray(self.options.chunkSize)
+        return self.buffer
+
+    def getLargeBuffers(self):
+        """ the two buffers of large file copies, allocated once per backend """
+        if not self.largeBuffers or len(self.largeBuffers[0]) != self.options.largeChunkSize:
+            self.largeBuffers = [bytearray(self.options.largeChunkSize) for _ in range(2)]
+        return self.largeBuffers
+
+    def isSame(self, size, mtime, dstSize, dstMtime):
+        return size == dstSize and abs(mtime - dstMtime) <= MTIME_TOLERANCE
+
+    def copyFile(self, src, dst, mtime, hasher=None, size=None, blocks=None):
+        """ copy `src` into a part file, moved over `dst` once it is complete """
+        buffer = self.getBuffer()
+        view = memoryview(buffer)
+        src, entry = openCached(self.options.cache, src, size, mtime, buffer)
+        part = partPath(dst)
+        isTimeSet = False
+        try:
+            with open(src, 'rb', buffering=0) as fsrc, open(part, 'wb', buffering=0) as fdst:
+                while self.isRunning:
+                    with self.readLimiter:
+                        n = fsrc.readinto(buffer)
+                    if not n:
+                        break
+                    if hasher:
+                        hasher.update(view[:n])
+                    if blocks:
+                        blocks.update(view[:n])
+                    if entry:
+                        entry.write(view[:n])
+                    self.write(fdst, view[:n])
+                    if self.progress:
+                        self.progress.advance(n)
+                if hasher and self.isRunning:
+                    # the verifier has to read back what reached the drive
+                    os.fsync(fdst.fileno())
+                if self.isRunning:
+                    isTimeSet = setFileTime(fdst, mtime)
+            if self.isRunning:
+                if not isTimeSet:
+                    os.utime(part, (mtime, mtime))
+                os.replace(part, dst)
+        except OSError:
+            if entry:
+                entry.abort()
+            removeFile(part)
+            raise
+        if not self.isRunning:
+            if entry:
+                entry.abort()
+            removeFile(part)
+            return False
+        if entry:
+            entry.commit()
+        return True
+
+    def copyLarge(self, src, dst, mtime, hasher=None, size=None, blocks=None, rel=None):
+        """ copy a large file, a reader thread fills one buffer while this thread writes the other
+
+        Sources on a local disk (the source cache included) are mapped instead of read.
+        The part file is flushed and its length journaled every CHECKPOINT_SIZE bytes, a copy
+        cut short keeps it and the next one continues from the last checkpoint.
+        """
+        journal = self.journal if rel else None
+        part = partPath(dst)
+        offset = journal.getPart(rel, size, mtime, part) if journal else 0
+        src, entry = openCached(self.options.cache, src, size, mtime)
+        if entry and offset:
+            # the cache only takes whole files
+            entry.abort()
+            entry = None
+        checkpoint = offset
+        isTimeSet = False
+        try:
+            with open(src, 'rb', buffering=0) as fsrc, open(part, 'r+b' if offset else 'wb', buffering=0) as fdst:
+                if offset:
+                    self.skipTo(fsrc, offset, hasher, blocks)
+                    fdst.seek(offset)
+                    if self.progress:
+                        self.progress.advance(offset)
+                else:
+                    preallocate(fdst, size)
+                if self.options.isMmap and isLocalPath(src):
+                    chunks = self.mapChunks(fsrc, offset)
+                else:
+                    chunks = self.readChunks(fsrc)
+                written = offset
+                try:
+                    for chunk in chunks:
+                        if not self.isRunning:
+                            break
+                        if hasher:
+                            hasher.update(chunk)
+                        if blocks:
+                            blocks.update(chunk)
+                        if entry:
+                            entry.write(chunk)
+                        self.write(fdst, chunk)
+                        written += len(chunk)
+                        if self.progress:
+                            self.progress.advance(len(chunk))
+                        if journal and written - checkpoint >= CHECKPOINT_SIZE and written < size:
+                            os.fsync(fdst.fileno())
+                            journal.checkpoint(rel, size, mtime, written)
+                            checkpoint = written
+                finally:
+                    chunk = None
+                    chunks.close()
+                if self.isRunning:
+                    if written != size:
+                        # the source changed since it was planned
+                        fdst.truncate(written)
+                    if hasher:
+                        os.fsync(fdst.fileno())
+                    isTimeSet = setFileTime(fdst, mtime)
+            if self.isRunning:
+                if not isTimeSet:
+                    os.utime(part, (mtime, mtime))
+                os.replace(part, dst)
+        except OSError:
+            if entry:
+                entry.abort()
+            if not checkpoint:
+                removeFile(part)
+            raise
+        if not self.isRunning:
+            if entry:
+                entry.abort()
+            if not checkpoint:
+                removeFile(part)
+            return False
+        if entry:
+            entry.commit()
+        return True
+
+    def skipTo(self, f, offset, hasher=None, blocks=None):
+        """ move `f` to `offset`, the hashes of a resumed copy are taken over the part already written """
+        if not hasher and not blocks:
+            f.seek(offset)
+            return
+        buffer = self.getBuffer()
+        view = memoryview(buffer)
+        remaining = offset
+        while remaining:
+            with self.readLimiter:
+                n = f.readinto(view[:min(remaining, len(buffer))])
+            if not n:
+                raise OSError(f'{f.name} is shorter than its part file')
+            if hasher:
+                hasher.update(view[:n])
+            if blocks:
+                blocks.update(view[:n])
+            remaining -= n
+
+    def readChunks(self, f):
+        """ yield the content of `f` in the large buffers, the next one is read while the last is in use """
+        buffers = self.getLargeBuffers()
+        free, full = queue.Queue(), queue.Queue()
+        for i in range(len(buffers)):
+            free.put(i)
+        errors = []
+
+        def read():
+            self.enterWorker()
+            try:
+                while self.isRunning:
+                    i = free.get()
+                    if i is None:
+                        break
+                    with self.readLimiter:
+                        n = readFull(f, memoryview(buffers[i]))
+                    if not n:
+                        break
+                    full.put((i, n))
+            except OSError as e:
+                errors.append(e)
+            finally:
+                full.put((None, 0))
+
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+        try:
+            while True:
+                i, n = full.get()
+                if i is None:
+                    break
+                yield memoryview(buffers[i])[:n]
+                free.put(i)
+        finally:
+            # the writer may stop early, the reader is waiting for a buffer then
+            free.put(None)
+            reader.join()
+        if errors:
+            raise errors[0]
+
+    def mapChunks(self, f, offset=0):
+        """ yield the content of `f` from `offset` on through a memory map, the system reads ahead of the writes """
+        size = os.fstat(f.fileno()).st_size
+        if size <= offset:
+            return
+        chunkSize = self.options.largeChunkSize
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                for start in range(offset, size, chunkSize):
+                    chunk = view[start:start + chunkSize]
+                    try:
+                        yield chunk
+                    finally:
+                        # the map cannot be closed while a view of it is alive
+                        chunk.release()
+            finally:
+                view.release()
+
+    def getSignature(self, dst, rel):
+        """ block hashes of the file `dst`, taken from the manifest if it is unchanged since they were recorded """
+        stat = os.stat(dst)
+        record = self.manifest.getSignature(rel) if self.manifest else None
+        if record and record[0] == stat.st_size and abs(record[1] - stat.st_mtime) <= MTIME_TOLERANCE \
+                and record[2] == DELTA_BLOCK:
+            return record[3]
+        buffer = self.getBuffer()
+        blocks = BlockHasher()
+        with open(dst, 'rb', buffering=0) as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            while self.isRunning:
+                with self.writeLimiter:
+                    n = f.readinto(buffer)
+                if not n:
+                    break
+                blocks.update(memoryview(buffer)[:n])
+        return blocks.digest()
+
+    def deltaFile(self, src, dst, rel, size, mtime, hasher=None, blocks=None):
+        """ write only the blocks of the existing file `dst` that differ from `src`
+
+        Blocks are compared at the same offsets. Content shifted by an insertion is rewritten
+        from the insertion on, as a copy elsewhere on the drive would cost the same writes.
+
+        `dst` is changed in place and not through a part file, so the update is not crash
+        atomic. The blocks before the point reached are new and the ones after it old. That
+        point is flushed and journaled every CHECKPOINT_SIZE bytes with the key of the old
+        signature, which stays in the manifest, and the next sync goes on from there.
+        """
+        journal = self.journal
+        record = self.manifest.getSignature(rel) if self.manifest else None
+        resumeAt = None
+        if journal and record and record[2] == DELTA_BLOCK:
+            resumeAt = journal.getDelta(rel, size, mtime, signatureKey(record[3]))
+        if resumeAt is not None:
+            # past the checkpoint a block is still old or already written from this source
+            sums = record[3]
+        else:
+            resumeAt = 0
+            sums = self.getSignature(dst, rel)
+            if not self.isRunning:
+                return False
+            if self.manifest:
+                stat = os.stat(dst)
+                self.manifest.setSignature(rel, stat.st_size, stat.st_mtime, DELTA_BLOCK, sums)
+        key = signatureKey(sums)
+        if journal:
+            journal.checkpointDelta(rel, size, mtime, resumeAt, key)
+        checkpoint = resumeAt
+        buffer = self.getBuffer()
+        view = memoryview(buffer)[:max(DELTA_BLOCK, len(buffer) // DELTA_BLOCK * DELTA_BLOCK)]
+        src, entry = openCached(self.options.cache, src, size, mtime, buffer)
+        offset = 0
+        try:
+            with open(src, 'rb', buffering=0) as fsrc, open(dst, 'r+b', buffering=0) as fdst:
+                while self.isRunning:
+                    with self.readLimiter:
+                        n = readFull(fsrc, view)
+                    if not n:
+                        break
+                    if hasher:
+                        hasher.update(view[:n])
+                    if entry:
+                        entry.write(view[:n])
+                    for start in range(0, n, DELTA_BLOCK):
+                        block = view[start:min(n, start + DELTA_BLOCK)]
+                        digest = hashlib.blake2b(block, digest_size=8).hexdigest()
+                        index = (offset + start) // DELTA_BLOCK
+                        if blocks:
+                            blocks.sums.append(digest)
+                        if offset + start >= resumeAt and (index >= len(sums) or sums[index] != digest):
+                            fdst.seek(offset + start)
+                            self.write(fdst, block)
+                    offset += n
+                    if self.progress:
+                        self.progress.advance(n)
+                    if journal and offset - checkpoint >= CHECKPOINT_SIZE and offset < size:
+                        os.fsync(fdst.fileno())
+                        journal.checkpointDelta(rel, size, mtime, offset, key)
+                        checkpoint = offset
+                if self.isRunning:
+                    fdst.truncate(offset)
+                    if hasher:
+                        os.fsync(fdst.fileno())
+        except OSError:
+            if entry:
+                entry.abort()
+            raise
+        if not self.isRunning:
+            # the mtime of `dst` still differs from the source, the next sync goes on from the checkpoint
+            if entry:
+                entry.abort()
+            return False
+        if entry:
+            entry.commit()
+        os.utime(dst, (mtime, mtime))
+        return True
+
+    def scanDir(self, path):
+        """ name -> (isDir, size, mtime) of the entries inside `path` """
+        entries = {}
+        typeFilter = self.options.typeFilter
+        for entry in os.scandir(path):
+            isDir = entry.is_dir(follow_symlinks=False)
+            name = entry.name[:-len(PART_SUFFIX)] if entry.name.endswith(PART_SUFFIX) else entry.name
+            if typeFilter and not typeFilter.isWanted(name, isDir):
+                continue
+            stat = entry.stat(follow_symlinks=False)
+            entries[entry.name] = (isDir, stat.st_size, stat.st_mtime)
+        return entries
+
+    def listTarget(self, dst, rel):
+        """ entries of the destination folder, taken from the manifest when it is unchanged """
+        targets = self.manifest.listTarget(rel) if self.manifest else None
+        if targets is not None:
+            return targets
+        try:
+            return self.scanDir(dst)
+        except (FileNotFoundError, NotADirectoryError):
+            # a file in place of the folder is removed by the plan of the parent folder
+            return {}
+
+    def listFolder(self, item):
+        """ source and target entries of the folder `item` (src, dst, rel), for the TreeWalker """
+        src, dst, rel = item
+        sources = self.scanDir(src)
+        targets = self.listTarget(dst, rel)
+        children = [(os.path.join(src, name), os.path.join(dst, name), rel + '/' + name)
+                    for name, entry in sources.items() if entry[0]]
+        return (sources, targets), children
+
+    def getListing(self, src, dst, rel):
+        record = self.prefetcher.get(rel) if self.prefetcher else None
+        if record is None:
+            return self.listFolder((src, dst, rel))[0]
+        result, error = record
+        if error is not None:
+            raise error
+        return result
+
+    def planTree(self, plan, src, dst, rel):
+        """ find the work needed to bring `dst` in line with `src`, returns whether `dst` will exist """
+        try:
+            sources, targets = self.getListing(src, dst, rel)
+        except OSError as e:
+            self.errors.append((src, e))
+            plan.isComplete = False
+            return os.path.isdir(dst)
+
+        parts = {name[:-len(PART_SUFFIX)]: targets.pop(name) for name in list(targets) if name.endswith(PART_SUFFIX)}
+        isDirNeeded = bool(targets) or os.path.isdir(dst)
+        if not isDirNeeded and not self.options.isSkipEmptyDir:
+            plan.folders.append(dst)
+            isDirNeeded = True
+
+        for name, (isDir, size, mtime) in sources.items():
+            if not self.isRunning:
+                plan.isComplete = False
+                return isDirNeeded
+            path = os.path.join(src, name)
+            target = os.path.join(dst, name)
+            childRel = rel + '/' + name
+            if isDir:
+                known = targets.get(name)
+                if known and not known[0]:
+                    # a file on the drive where the source now has a folder
+                    targets.pop(name)
+                    plan.deletes.append((target, False, childRel, known[1]))
+                    plan.bytesFreed += known[1]
+                if self.planTree(plan, path, target, childRel):
+                    targets[name] = (True, 0, 0)
+                    isDirNeeded = True
+                continue
+
+            known = targets.get(name)
+            if not self.options.isWanted(size, mtime):
+                if self.options.isDelete and known:
+                    # left out of the new selection
+                    targets.pop(name)
+                    size = self.treeSize(target, childRel) if known[0] else known[1]
+                    plan.deletes.append((target, known[0], childRel, size))
+                    plan.bytesFreed += size
+                continue
+            if known and not known[0] and self.isSame(size, mtime, known[1], known[2]):
+                if self.manifest and self.manifest.get(childRel) is None:
+                    self.manifest.update(childRel, known[1], known[2])
+                continue
+
+            if not isDirNeeded:
+                plan.folders.append(dst)
+                isDirNeeded = True
+            if known and known[0]:
+                freed = self.treeSize(target, childRel)
+                plan.deletes.append((target, True, childRel, freed))
+                plan.bytesFreed += freed
+            elif known:
+                plan.bytesFreed += known[1]
+                plan.replaced[childRel] = known[1]
+            plan.copies.append((path, target, childRel, size, mtime))
+            targets[name] = (False, size, mtime)
+
+        for name, (_, size, _) in parts.items():
+            # part files left by an interrupted sync are kept while the journal can continue them
+            source = sources.get(name)
+            journal = self.journal
+            if not (source and journal and journal.isResumable(rel + '/' + name, source[1], source[2])):
+                plan.deletes.append((partPath(os.path.join(dst, name)), False, None, size))
+                plan.bytesFreed += size
+
+        if self.options.isMirror or self.options.isDelete:
+            for name in [n for n in targets if n not in sources]:
+                isDir, size, _ = targets.pop(name)
+                path, childRel = os.path.join(dst, name), rel + '/' + name
+                size = self.treeSize(path, childRel) if isDir else size
+                plan.deletes.append((path, isDir, childRel, size))
+                plan.bytesFreed += size
+
+        if isDirNeeded:
+            plan.marks.append((rel, list(targets)))
+        return isDirNeeded
+
+    def treeSize(self, path, rel):
+        """ bytes held by the destination folder `path` """
+        if self.manifest and self.manifest.isTrusted(rel) and rel in self.manifest.dirs:
+            return self.manifest.totalSize(rel)
+
+        def listSizes(folder):
+            size, children = 0, []
+            for entry in os.scandir(folder):
+                if entry.is_dir(follow_symlinks=False):
+                    children.append(entry.path)
+                else:
+                    size += entry.stat(follow_symlinks=False).st_size
+            return size, children
+
+        walker = TreeWalker(listSizes, self.options.walkWorkers)
+        return sum(size for _, size, error in walker.walk([path]) if error is None)
+
+    def planRange(self, plan, index):
+        """ plan a date range copy from the mtime index of the source instead of walking it
+
+        Only the files in the range are compared with the drive. The destination is not walked,
+        so nothing is recorded as scanned and no folder listing is marked. The part files are
+        found through the journal instead, and the ones it cannot continue are deleted.
+        """
+        for path, error in index.refresh(self.options.walkWorkers, lambda: self.isRunning):
+            self.errors.append((path, error))
+            plan.isComplete = False
+        if not self.isRunning:
+            plan.isComplete = False
+            return
+        typeFilter = self.options.typeFilter
+        folders = set()
+        if not self.options.isSkipEmptyDir:
+            # the folders are created as a walk would, empty ones included
+            for rel in index.folders:
+                parts = rel.split('/') if rel else []
+                if not typeFilter or all(typeFilter.isWanted(part, True) for part in parts):
+                    folders.add(os.path.join(plan.target, *parts))
+            plan.folders += sorted(folder for folder in folders if not os.path.isdir(folder))
+        for mtime, rel, size in index.query(self.options.fromTime, self.options.toTime):
+            parts = rel.split('/')
+            if not self.options.isWanted(size, mtime):
+                continue
+            if typeFilter and not (typeFilter.isWanted(parts[-1])
+                                   and all(typeFilter.isWanted(part, True) for part in parts[:-1])):
+                continue
+            path, target = os.path.join(plan.source, *parts), os.path.join(plan.target, *parts)
+            childRel = plan.subject + '/' + rel
+            try:
+                stat = os.stat(target)
+                known = (os.path.isdir(target), stat.st_size, stat.st_mtime)
+            except OSError:
+                known = None
+            if known and not known[0] and self.isSame(size, mtime, known[1], known[2]):
+                if self.manifest and self.manifest.get(childRel) is None:
+                    self.manifest.update(childRel, known[1], known[2])
+                continue
+            folder = os.path.dirname(target)
+            if folder not in folders and not os.path.isdir(folder):
+                plan.folders.append(folder)
+            folders.add(folder)
+            if known and known[0]:
+                freed = self.treeSize(target, childRel)
+                plan.deletes.append((target, True, childRel, freed))
+                plan.bytesFreed += freed
+            elif known:
+                plan.bytesFreed += known[1]
+                plan.replaced[childRel] = known[1]
+            plan.copies.append((path, target, childRel, size, mtime))
+        journal = self.journal
+        for childRel, (size, mtime, _) in list(journal.parts.items()) if journal else ():
+            if not childRel.startswith(plan.subject + '/'):
+                continue
+            rel = childRel[len(plan.subject) + 1:]
+            if index.get(rel) == [size, mtime]:
+                continue
+            part = partPath(os.path.join(plan.target, *rel.split('/')))
+            try:
+                partSize = os.path.getsize(part)
+            except OSError:
+                continue
+            plan.deletes.append((part, False, None, partSize))
+            plan.bytesFreed += partSize
+        plan.isComplete = False
+        index.save()
+
+    def plan(self, src, dst):
+        src = os.path.normpath(src)
+        plan = SyncPlan(src, dst)
+        if self.manifest:
+            plan.isTrusted = self.manifest.isTrusted(plan.subject)
+        isRange = self.options.fromTime is not None or self.options.toTime is not None
+        if self.options.index and isRange and not self.options.isDelete:
+            # pruning still needs a walk of the drive, see planTree
+            self.planRange(plan, self.options.index(src))
+            return plan
+        if self.options.walkWorkers > 1:
+            self.prefetcher = Prefetcher(TreeWalker(self.listFolder, self.options.walkWorkers),
+                                         [(src, plan.target, plan.subject)], lambda item: item[2])
+        try:
+            self.planTree(plan, src, plan.target, plan.subject)
+        finally:
+            if self.prefetcher:
+                self.prefetcher.stop()
+                self.prefetcher = None
+        return plan
+
+    def planStrays(self, dst, subjects):
+        if not self.options.isDelete:
+            return []
+        deletes = []
+        try:
+            entries = list(os.scandir(dst))
+        except OSError:
+            return deletes
+        for entry in entries:
+            if entry.name in subjects or entry.name.startswith(PRESTO_PREFIX):
+                continue
+            try:
+                isDir = entry.is_dir(follow_symlinks=False)
+                size = self.treeSize(entry.path, entry.name) if isDir else entry.stat(follow_symlinks=False).st_size
+            except OSError as e:
+                self.errors.append((entry.path, e))
+                continue
+            deletes.append((entry.path, isDir, entry.name, size))
+        return deletes
+
+    def prepare(self, plan: SyncPlan, failed):
+        """ remove the planned deletes, largest first, and create the folders, returns False once stopped """
+        for path, isDir, rel, size in sorted(plan.deletes, key=lambda delete: delete[3], reverse=True):
+            if not self.isRunning:
+                return False
+            if self.deletePass and path in self.deletePass.paths:
+                continue
+            if not self.removePath(path, isDir, rel) and rel is not None:
+                failed.add(rel.rpartition('/')[0])
+
+        for folder in plan.folders:
+            try:
+                os.makedirs(folder, exist_ok=True)
+            except OSError as e:
+                self.errors.append((folder, e))
+        return True
+
+    def finish(self, plan: SyncPlan, failed, errorCount):
+        """ record the folders of a fully applied plan in the manifest, except those in `failed` """
+        if self.manifest and self.isRunning:
+            # folders missing a skipped file are listed again next time
+            failed = failed | {copy[2].rpartition('/')[0] for copy in plan.skipped}
+            for rel, names in plan.marks:
+                if rel not in failed:
+                    self.manifest.markDir(rel, names)
+            if not plan.isTrusted and plan.isComplete and len(self.errors) == errorCount:
+                self.manifest.markScanned(plan.subject)
+
+    def apply(self, plan: SyncPlan):
+        errorCount = len(self.errors)
+        failed = set()
+        if not self.prepare(plan, failed):
+            return
+
+        verifier = None
+        if self.options.verify:
+            verifier = Verifier(self.options.verify, self.options.chunkSize, self.writeLimiter,
+                                throttle=self.options.throttle)
+        small = [copy for copy in plan.copies if copy[3] <= self.options.smallFileSize]
+        if len(small) > 1:
+            self.reserve(sum(copy[3] for copy in small))
+            start = time.perf_counter()
+            smallFailed = self.copySmall(small, verifier)
+            self.measure('smallFile', sum(copy[3] for copy in small) - sum(copy[3] for copy in smallFailed),
+                         time.perf_counter() - start)
+            for copy in smallFailed:
+                failed.add(copy[2].rpartition('/')[0])
+        else:
+            small = []
+        for copy in plan.copies:
+            if not self.isRunning:
+                break
+            if copy[3] <= self.options.smallFileSize and small:
+                continue
+            self.reserve(copy[3])
+            if not self.copyEntry(copy, verifier):
+                failed.add(copy[2].rpartition('/')[0])
+        if verifier:
+            for copy in self.verify(verifier):
+                failed.add(copy[2].rpartition('/')[0])
+        if self.deletePass:
+            self.deletePass.join()
+            failed |= self.deletePass.failed
+        self.finish(plan, failed, errorCount)
+
+    def copyEntry(self, copy, verifier=None):
+        src, dst, rel, size, mtime = copy
+        if self.progress:
+            self.progress.fileStarted(rel)
+        hasher = throttleHasher(createHash(verifier.name) if verifier else None, self.options.throttle)
+        blocks = BlockHasher() if self.options.isDelta and size >= DELTA_MIN_SIZE else None
+        blocks = throttleHasher(blocks, self.options.throttle)
+        try:
+            if blocks and os.path.isfile(dst):
+                isCopied = self.deltaFile(src, dst, rel, size, mtime, hasher, blocks)
+            elif self.options.largeFileSize is not None and size >= self.options.largeFileSize:
+                start = time.perf_counter()
+                isCopied = self.copyLarge(src, dst, mtime, hasher, size, blocks, rel)
+                if isCopied:
+                    self.measure('sequential', size, time.perf_counter() - start)
+            else:
+                isCopied = self.copyFile(src, dst, mtime, hasher, size, blocks)
+            if isCopied:
+                digest = hasher.hexdigest() if hasher else None
+                if self.manifest:
+                    self.manifest.update(rel, size, mtime, digest)
+                    self.journal.finish(rel, size, mtime, digest)
+                    if blocks:
+                        self.manifest.setSignature(rel, size, mtime, DELTA_BLOCK, blocks.digest())
+                if verifier:
+                    verifier.submit(dst, digest, copy)
+        except OSError as e:
+            self.errors.append((src, e))
+            return False
+        finally:
+            if self.progress:
+                self.progress.fileFinished()
+        return True
+
+    def measure(self, name, nbytes, seconds):
+        self.measured[name][0] += nbytes
+        self.measured[name][1] += seconds
+
+    def copySmall(self, copies, verifier=None):
+        """ copy small files on several threads so that their opens and creates overlap, returns the failed ones
+
+        Each file is read in one call and written in one call, and its mtime is set through the
+        open handle. The file is held in memory in between, which SMALL_FILE_SIZE bounds.
+        """
+        items = iter(copies)
+        lock = threading.Lock()
+        failed = []
+
+        def work():
+            self.enterWorker()
+            while self.isRunning:
+                with lock:
+                    item = next(items, None)
+                if item is None:
+                    break
+                if not self.copySmallEntry(item, verifier):
+                    failed.append(item)
+
+        threads = [threading.Thread(target=work, daemon=True) for _ in range(min(SMALL_FILE_WORKERS, len(copies)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return failed
+
+    def copySmallEntry(self, copy, verifier=None):
+        src, dst, rel, size, mtime = copy
+        if self.progress:
+            self.progress.fileStarted(rel)
+        try:
+            path, entry = openCached(self.options.cache, src, size, mtime)
+            with open(path, 'rb', buffering=0) as f:
+                with self.readLimiter:
+                    data = f.read()
+            if entry:
+                entry.write(data)
+                entry.commit()
+            digest = None
+            part = partPath(dst)
+            try:
+                with open(part, 'wb', buffering=0) as f:
+                    self.write(f, data)
+                    if verifier:
+                        hasher = throttleHasher(createHash(verifier.name), self.options.throttle)
+                        hasher.update(data)
+                        digest = hasher.hexdigest()
+                        os.fsync(f.fileno())
+                    isTimeSet = setFileTime(f, mtime)
+                if not isTimeSet:
+                    os.utime(part, (mtime, mtime))
+                os.replace(part, dst)
+            except OSError:
+                removeFile(part)
+                raise
+            if self.progress:
+                self.progress.advance(len(data))
+            if self.manifest:
+                self.manifest.update(rel, size, mtime, digest)
+                self.journal.finish(rel, size, mtime, digest)
+            if verifier:
+                verifier.submit(dst, digest, copy)
+        except OSError as e:
+            self.errors.append((src, e))
+            return False
+        finally:
+            if self.progress:
+                self.progress.fileFinished()
+        return True
+
+    def verify(self, verifier):
+        """ copy the files failing verification again, returns the copies that still fail """
+        mismatches = verifier.join()
+        for _ in range(RECOPY_ATTEMPTS):
+            if not mismatches or not self.isRunning:
+                break
+            if self.progress:
+                self.progress.addTotal(sum(item[3] for item, _, _ in mismatches), len(mismatches))
+            for item, _, _ in mismatches:
+                # copied whole, the blocks on the drive cannot be trusted for a delta
+                self.removePath(item[1], False)
+                self.copyEntry(item, verifier)
+            mismatches = verifier.join()
+
+        for (src, dst, rel, size, mtime), expected, actual in mismatches:
+            # a bad copy keeps the size and mtime of the source, remove it so the next sync copies it again
+            self.removePath(dst, False, rel)
+            self.mismatches.append((rel, expected, actual))
+            self.errors.append((src, VerifyError(f'{rel}: {expected} != {actual}')))
+        return [item for item, _, _ in mismatches]
+
+
+class AutoTuner:
+    """ Adjust the chunk size and the number of concurrent writes of a running sync, AIMD style
+
+    Every `interval` seconds the throughput and the mean write latency of the drive are
+    measured and compared with the previous interval. A step that raised the throughput by
+    TUNE_GAIN is followed by another one on the same knob (additive increase). A loss of
+    throughput, or a write latency twice the first one measured without a gain, halves the
+    knob (multiplicative decrease). A plateau moves on to the other knob. The settings of the
+    best interval are kept in `best`.
+    """
+
+    def __init__(self, options: SyncOptions, maxSlots, slots=None, chunkSize=None, interval=TUNE_INTERVAL):
+        self.options = options
+        self.maxSlots = max(1, maxSlots)
+        self.slots = min(self.maxSlots, slots or USB_WRITERS)
+        self.chunkSize = min(MAX_CHUNK_SIZE, max(MB, chunkSize or options.chunkSize))
+        self.interval = interval
+        self.knob = 'slots'
+        self.lastRate = None
+        self.best = None  # {'chunkSize', 'writeSlots', 'throughput'}
+        self.baseLatency = None
+        self.limiter = None
+        self.progress = None
+        self.thread = None
+        self.wakeup = threading.Event()
+
+    def start(self, limiter: IoLimiter, progress: ProgressTracker):
+        self.limiter = limiter
+        self.progress = progress
+        self.wakeup.clear()
+        self.apply()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def apply(self):
+        self.options.tunedChunkSize = self.chunkSize
+        self.limiter.setLimit(self.slots)
+
+    def run(self):
+        lastTime = time.monotonic()
+        lastBytes = self.progress.bytesDone
+        lastOperations, lastBusy = self.limiter.stats()
+        while not self.wakeup.wait(self.interval):
+            now = time.monotonic()
+            done = self.progress.bytesDone
+            operations, busy = self.limiter.stats()
+            rate = (done - lastBytes) / max(now - lastTime, 1e-6)
+            latency = (busy - lastBusy) / (operations - lastOperations) if operations > lastOperations else None
+            lastTime, lastBytes, lastOperations, lastBusy = now, done, operations, busy
+            if rate > 0:
+                self.step(rate, latency)
+
+    def step(self, rate, latency):
+        """ judge the last step from the throughput and latency it gave, then take the next one """
+        if self.baseLatency is None:
+            self.baseLatency = latency
+        if self.best is None or rate > self.best['throughput']:
+            self.best = {'chunkSize': self.chunkSize, 'writeSlots': self.slots, 'throughput': rate}
+        lastRate, self.lastRate = self.lastRate, rate
+        if lastRate is None or rate > lastRate * (1 + TUNE_GAIN):
+            self.increase()
+        elif rate < lastRate * (1 - TUNE_GAIN):
+            self.decrease()
+        elif latency and self.baseLatency and latency > 2 * self.baseLatency:
+            self.decrease()
+        else:
+            self.knob = 'chunkSize' if self.knob == 'slots' else 'slots'
+            self.increase()
+        self.apply()
+
+    def increase(self):
+        if self.knob == 'slots':
+            self.slots = min(self.maxSlots, self.slots + 1)
+        else:
+            self.chunkSize = min(MAX_CHUNK_SIZE, self.chunkSize + TUNE_CHUNK_STEP)
+
+    def decrease(self):
+        self.lastRate = None  # the next interval is slower by design, it only sets the new baseline
+        if self.knob == 'slots':
+            self.slots = max(1, self.slots // 2)
+        else:
+            self.chunkSize = max(MB, self.chunkSize // 2)
+
+
+class SyncScheduler:
+    """ Sync several subject folders at once
+
+    Every subject is planned first, then subjects are queued by planned size, largest first,
+    and each worker takes the next one when it is free, so the load is balanced by bytes
+    rather than by subject count.
+    Reads from the source and writes to the drive are limited separately. An AutoTuner set
+    as `tuner` adjusts the write limit and the chunk size while the plans are applied.
+    `pause` parks every worker at its next chunk until `resume`.
+    """
+
+    def __init__(self, backendFactory, workers, readSlots=None, writeSlots=None, progress=None):
+        self.backendFactory = backendFactory
+        self.workers = max(1, workers)
+        self.progress = progress
+        self.readLimiter = IoLimiter(readSlots or self.workers)
+        self.writeLimiter = IoLimiter(writeSlots or min(self.workers, USB_WRITERS))
+        self.taskFinished = None
+        self.planReady = None
+        self.tuner = None
+        self.deletePass = None
+        self.isRunning = True
+        self.isPaused = False
+        self.backends = []
+        self.errors = []
+        self.mismatches = []
+        self.measured = {'sequential': [0, 0.0], 'smallFile': [0, 0.0]}
+        self.lock = threading.Lock()
+
+    def plan(self, tasks, dst, manifest=None):
+        """ walk every (task, folder) pair of `tasks`, returns task -> SyncPlan
+
+        The entries of `dst` outside the subjects are pruned by the plan of the first task when
+        the backends delete what the new selection leaves out.
+        """
+        plans = {}
+        strays = []
+        tasks = list(tasks)
+
+        def planTask(backend, task, src):
+            if task is None:
+                strays.extend(backend.planStrays(dst, src))
+            else:
+                plans[task] = backend.plan(src, dst)
+
+        subjects = {os.path.basename(os.path.normpath(src)) for _, src in tasks}
+        self.dispatch(tasks + [(None, subjects)], planTask, manifest)
+        if strays and plans:
+            plan = plans[min(plans)]
+            plan.deletes += strays
+            plan.bytesFreed += sum(delete[3] for delete in strays)
+        return plans
+
+    def run(self, tasks, dst, manifest=None):
+        """ sync every (task, folder) pair of `tasks` into `dst`, `taskFinished(task)` is called after each
+
+        All subjects are planned before anything is written. `planReady(plans)` is then called
+        and the sync is abandoned if it returns False. The deletes of every plan then run on
+        their own workers beside the copies, see DeletePass.
+        """
+        tasks = list(tasks)
+        plans = self.plan(tasks, dst, manifest)
+        if not self.isRunning or (self.planReady and not self.planReady(plans)):
+            return plans
+        if self.progress:
+            self.progress.addTotal(sum(plan.bytesTotal for plan in plans.values()),
+                                   sum(plan.filesTotal for plan in plans.values()))
+
+        def applyTask(backend, task, plan):
+            backend.apply(plan)
+            if self.isRunning and self.taskFinished:
+                self.taskFinished(task)
+
+        self.deletePass = DeletePass(plans.values(), getFreeSpace(dst))
+        deleting = threading.Thread(target=self.delete, args=(manifest, ), daemon=True)
+        deleting.start()
+        queue = orderPlans(plans, tasks)
+        if self.tuner and self.progress:
+            self.tuner.start(self.writeLimiter, self.progress)
+        try:
+            self.dispatch(queue, applyTask, manifest)
+        finally:
+            if self.tuner:
+                self.tuner.stop()
+            deleting.join()
+        return plans
+
+    def delete(self, manifest):
+        try:
+            self.dispatch(list(self.deletePass.queue), self.deletePass.remove, manifest)
+        finally:
+            self.deletePass.close()
+
+    def dispatch(self, queue, job, manifest):
+        """ run `job(backend, *item)` for each item of `queue` on the worker threads """
+        threads = [threading.Thread(target=self.work, args=(queue, job, manifest), daemon=True)
+                   for _ in range(min(self.workers, len(queue)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def work(self, queue, job, manifest):
+        backend = self.backendFactory()
+        backend.enterWorker()
+        backend.setManifest(manifest)
+        backend.setProgress(self.progress)
+        backend.readLimiter = self.readLimiter
+        backend.writeLimiter = self.writeLimiter
+        backend.deletePass = self.deletePass
+        with self.lock:
+            self.backends.append(backend)
+            if not self.isRunning:
+                backend.stop()
+            elif self.isPaused:
+                backend.pause()
+
+        while self.isRunning:
+            with self.lock:
+                if not queue:
+                    break
+                item = queue.pop(0)
+            job(backend, *item)
+
+        with self.lock:
+            self.errors.extend(backend.errors)
+            self.mismatches.extend(backend.mismatches)
+            for name, (nbytes, seconds) in backend.measured.items():
+                self.measured[name][0] += nbytes
+                self.measured[name][1] += seconds
+
+    def speeds(self):
+        """ write speeds measured by the workers, name -> bytes per second of a single worker or None """
+        return {name: nbytes / seconds if nbytes >= SPEED_MIN_BYTES and seconds > 0 else None
+                for name, (nbytes, seconds) in self.measured.items()}
+
+    def stop(self):
+        with self.lock:
+            self.isRunning = False
+            self.isPaused = False
+            for backend in self.backends:
+                backend.stop()
+
+    def pause(self):
+        with self.lock:
+            self.isPaused = True
+            for backend in self.backends:
+                backend.pause()
+
+    def resume(self):
+        with self.lock:
+            self.isPaused = False
+            for backend in self.backends:
+                backend.resume()
+
+
+class DriveWriter:
+    """ One destination drive of a fan-out sync
+
+    The drive is planned and prepared on its own, then its copies are handed to the
+    FanOutScheduler, which reads each source file once for every drive wanting it. Chunks
+    arrive through a bounded queue, so a drive falling behind holds back the reader only
+    until another drive runs dry; the files it missed that way are copied by the writer
+    itself at the end.
+    """
+
+    def __init__(self, options: SyncOptions, dst, tasks, manifest=None, progress=None):
+        self.options = options
+        self.dst = dst
+        self.tasks = list(tasks)
+        self.manifest = manifest
+        self.progress = progress
+        self.backend = NativeBackend(options)
+        self.backend.setManifest(manifest)
+        self.backend.setProgress(progress)
+        self.queue = queue.Queue(max(2, options.bufSize // options.chunkSize))
+        self.fanOut = None
+        self.plans = {}
+        self.remaining = 0
+        self.isDrained = False
+        self.copies = []
+        self.written = set()
+        self.deferred = []
+        self.failed = set()
+        self.verifier = None
+        self.isJoining = False  # joined the fan-out and not registered or left yet
+        self.taskFinished = None
+        self.planReady = None
+
+    @property
+    def isRunning(self):
+        return self.backend.isRunning
+
+    @property
+    def errors(self):
+        return self.backend.errors
+
+    @property
+    def mismatches(self):
+        return self.backend.mismatches
+
+    def stop(self):
+        self.backend.stop()
+
+    def pause(self):
+        self.backend.pause()
+
+    def resume(self):
+        self.backend.resume()
+
+    def run(self):
+        """ plan, prepare and write the drive, returns when it is done """
+        try:
+            self.sync()
+        except BaseException:
+            self.stop()  # the reader drops a drive that is no longer running
+            raise
+        finally:
+            # the reader waits for a joined drive until it registers or leaves
+            self.fanOut.leave(self)
+
+    def sync(self):
+        self.backend.enterWorker()
+        planner = SyncScheduler(lambda: NativeBackend(self.options), self.options.concurrentProcess)
+        if not self.isRunning:
+            planner.stop()
+        self.plans = planner.plan(self.tasks, self.dst, self.manifest)
+        self.errors.extend(planner.errors)
+        if not self.isRunning or (self.planReady and not self.planReady(self.plans)):
+            return
+        if self.progress:
+            self.progress.addTotal(sum(plan.bytesTotal for plan in self.plans.values()),
+                                   sum(plan.filesTotal for plan in self.plans.values()))
+
+        errorCount = len(self.errors)
+        plans = [plan for _, plan in orderPlans(self.plans, self.tasks)]
+        for plan in plans:
+            if not self.backend.prepare(plan, self.failed):
+                break
+        if self.options.verify:
+            self.verifier = Verifier(self.options.verify, self.options.chunkSize, self.backend.writeLimiter,
+                                     throttle=self.options.throttle)
+        self.copies = [copy for plan in plans for copy in plan.copies]
+        self.fanOut.register(self, self.copies)
+        self.write()
+
+        # files the reader dropped this drive for, or never sent to it
+        self.deferred = [copy for copy in self.copies if copy[2] not in self.written]
+        for copy in self.deferred:
+            if not self.isRunning:
+                break
+            if not self.backend.copyEntry(copy, self.verifier):
+                self.failed.add(copy[2].rpartition('/')[0])
+        if self.verifier:
+            for copy in self.backend.verify(self.verifier):
+                self.failed.add(copy[2].rpartition('/')[0])
+        if not self.isRunning:
+            return
+        for task, plan in self.plans.items():
+            self.backend.finish(plan, self.failed, errorCount)
+            if self.taskFinished:
+                self.taskFinished(task)
+
+    def write(self):
+        """ write the chunks queued by the reader until it has nothing more for this drive """
+        current = None  # [copy, file, bytes written]
+        while self.isRunning:
+            try:
+                kind, copy, data = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                if self.isDrained:
+                    break
+                continue
+            if kind == 'open':
+                if current:
+                    self.discard(current)
+                current = self.open(copy)
+            elif current is None or current[0] is not copy:
+                continue
+            elif kind == 'data':
+                try:
+                    self.backend.write(current[1], data)
+                    current[2] += len(data)
+                    if self.progress:
+                        self.progress.advance(len(data))
+                except OSError as e:
+                    self.close(current, e)
+                    current = None
+            else:
+                self.close(current, digests=data)
+                current = None
+        if current:
+            self.discard(current)
+
+    def open(self, copy):
+        if self.progress:
+            self.progress.fileStarted(copy[2])
+        try:
+            f = open(partPath(copy[1]), 'wb', buffering=0)
+            if copy[3] >= LARGE_FILE_SIZE:
+                preallocate(f, copy[3])
+            return [copy, f, 0]
+        except OSError as e:
+            self.errors.append((copy[0], e))
+            self.failed.add(copy[2].rpartition('/')[0])
+            self.written.add(copy[2])
+            if self.progress:
+                self.progress.fileFinished()
+            return None
+
+    def discard(self, current):
+        """ the reader dropped this drive in the middle of a file, it is copied again at the end """
+        copy, f, written = current
+        f.close()
+        removeFile(partPath(copy[1]))
+        if self.progress:
+            self.progress.advance(-written)
+
+    def close(self, current, error=None, digests=None):
+        src, dst, rel, size, mtime = copy = current[0]
+        try:
+            if error is None:
+                if current[2] != size:
+                    current[1].truncate(current[2])
+                if self.verifier:
+                    os.fsync(current[1].fileno())
+                current[1].close()
+                os.utime(partPath(dst), (mtime, mtime))
+                os.replace(partPath(dst), dst)
+                digest = digests.get(self.options.verify) if self.verifier else None
+                if self.manifest:
+                    self.manifest.update(rel, size, mtime, digest)
+                    self.manifest.journal.finish(rel, size, mtime, digest)
+                if self.verifier:
+                    self.verifier.submit(dst, digest, copy)
+        except OSError as e:
+            error = e
+        if error is not None:
+            current[1].close()
+            removeFile(partPath(dst))
+            self.errors.append((src, error))
+            self.failed.add(rel.rpartition('/')[0])
+        self.written.add(rel)
+        if self.progress:
+            self.progress.fileFinished()
+
+
+class FanOutScheduler:
+    """ Read each source file once and write it to every drive syncing the same source
+
+    Drives join while the scheduler is running, their files already read are read once
+    more at the end for them. The reader stops when no drive is left waiting for a file.
+    """
+
+    def __init__(self, chunkSize, cache=None):
+        self.chunkSize = chunkSize
+        self.cache = cache
+        self.pending = {}  # source path -> [(writer, copy), ...]
+        self.order = deque()
+        self.joining = 0
+        self.isClosed = False
+        self.reader = None
+        self.condition = threading.Condition()
+
+    def join(self, writer: DriveWriter):
+        """ add a drive, False once the reader has finished """
+        with self.condition:
+            if self.isClosed:
+                return False
+            writer.fanOut = self
+            writer.isJoining = True
+            self.joining += 1
+            if self.reader is None:
+                self.reader = threading.Thread(target=self.read, daemon=True)
+                self.reader.start()
+        return True
+
+    def leave(self, writer: DriveWriter):
+        """ the drive is done, or gave up, the files it has not been sent yet are dropped """
+        with self.condition:
+            if writer.isJoining:
+                writer.isJoining = False
+                self.joining -= 1
+            for src in [src for src, targets in self.pending.items() if any(w is writer for w, _ in targets)]:
+                self.pending[src] = [target for target in self.pending[src] if target[0] is not writer]
+                if not self.pending[src]:
+                    del self.pending[src]
+                    self.order.remove(src)
+            writer.isDrained = True
+            self.condition.notify_all()
+
+    def register(self, writer: DriveWriter, copies):
+        with self.condition:
+            writer.isJoining = False
+            self.joining -= 1
+            writer.remaining = len(copies)
+            writer.isDrained = not copies
+            for copy in copies:
+                if copy[0] not in self.pending:
+                    self.pending[copy[0]] = []
+                    self.order.append(copy[0])
+                self.pending[copy[0]].append((writer, copy))
+            self.condition.notify_all()
+
+    def read(self):
+        while True:
+            with self.condition:
+                while not self.order and self.joining:
+                    self.condition.wait()
+                if not self.order:
+                    self.isClosed = True
+                    return
+                src = self.order.popleft()
+                targets = self.pending.pop(src)
+            self.readFile(src, [target for target in targets if target[0].isRunning])
+            with self.condition:
+                for writer, _ in targets:
+                    writer.remaining -= 1
+                    if writer.remaining == 0:
+                        writer.isDrained = True
+
+    def readFile(self, src, targets):
+        """ send the chunks of `src` to the queue of every target, the targets dropped on the way defer it """
+        names = {writer.options.verify for writer, _ in targets if writer.options.verify}
+        hashers = {name: createHash(name) for name in names}
+        self.send(targets, 'open', None)
+        if not targets:
+            return
+        _, _, _, size, mtime = targets[0][1]
+        path, entry = openCached(self.cache, src, size, mtime)
+        try:
+            with open(path, 'rb', buffering=0) as f:
+                while targets:
+                    chunk = f.read(self.chunkSize)
+                    if not chunk:
+                        break
+                    for hasher in hashers.values():
+                        hasher.update(chunk)
+                    if entry:
+                        entry.write(chunk)
+                    self.send(targets, 'data', chunk)
+        except OSError:
+            # the drives copy the file on their own and report the error
+            if entry:
+                entry.abort()
+            return
+        if entry:
+            if targets:
+                entry.commit()
+            else:
+                entry.abort()
+        self.send(targets, 'close', {name: hasher.hexdigest() for name, hasher in hashers.items()})
+
+    def send(self, targets, kind, data):
+        """ queue an item for each target, a target whose queue stays full while another drive has
+        written everything it was given is dropped from `targets` """
+        waiting = list(targets)
+        while waiting:
+            for target in list(waiting):
+                writer, copy = target
+                if not writer.isRunning:
+                    waiting.remove(target)
+                    targets.remove(target)
+                    continue
+                try:
+                    writer.queue.put_nowait((kind, copy, data))
+                    waiting.remove(target)
+                except queue.Full:
+                    pass
+            if not waiting:
+                break
+            if any(target[0].queue.empty() for target in targets if target not in waiting):
+                for target in waiting:
+                    targets.remove(target)
+                break
+            time.sleep(FANOUT_STEP)
+
+
+BACKENDS = {
+    FastCopyBackend.name: FastCopyBackend,
+    NativeBackend.name: NativeBackend
+}
+
+
+def createBackend(name, options: SyncOptions):
+    """ create the backend called `name`, fall back to the native backend if it is unavailable """
+    backend = BACKENDS.get(name, NativeBackend)(options)
+    if not backend.isAvailable():
+        backend = NativeBackend(options)
+    return backend
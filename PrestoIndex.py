@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import heapq
+import bisect
+import hashlib
+import threading
+from PrestoEngine import TreeWalker, WALK_WORKERS
+
+
+INDEX_VERSION = 2
+INDEX_FOLDER = os.path.join(os.path.expanduser('~'), '.Presto', 'index')
+
+
+class MtimeIndex:
+    """ Files below one source folder sorted by mtime, kept on the local disk between syncs
+
+    folders: relative path -> [{name: [size, mtime]}, [names of the subfolders]]
+    entries: (mtime, relative path, size) of every file, sorted, rebuilt from `folders` on load
+
+    `refresh` lists every folder again with a TreeWalker, one scandir each, whose entries carry
+    the sizes and mtimes, so edits inside a file are seen without a stat per file. Only the
+    files that changed are merged into `entries`, and a date range is then a binary search in
+    it. The drive is not walked at all, which is what a range copy saves over planTree.
+    """
+
+    instances = {}
+    instancesLock = threading.Lock()
+
+    def __init__(self, folder, indexFolder=INDEX_FOLDER):
+        self.folder = os.path.normpath(folder)
+        key = hashlib.sha1(os.path.normcase(self.folder).encode('utf-8')).hexdigest()
+        self.path = os.path.join(indexFolder, key + '.json')
+        self.folders = {}
+        self.entries = []
+        self.isDirty = False
+        self.lock = threading.RLock()
+        self.load()
+
+    @classmethod
+    def shared(cls, folder, indexFolder=INDEX_FOLDER):
+        """ the index of `folder` used by every sync of this process """
+        key = (os.path.normcase(os.path.normpath(folder)), indexFolder)
+        with cls.instancesLock:
+            index = cls.instances.get(key)
+            if index is None:
+                index = cls.instances[key] = cls(folder, indexFolder)
+            return index
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data['version'] != INDEX_VERSION or os.path.normcase(data['folder']) != os.path.normcase(self.folder):
+                raise ValueError(data['version'])
+            self.folders = data['folders']
+        except (OSError, ValueError, KeyError, TypeError):
+            self.folders = {}
+        self.entries = sorted((mtime, joinRel(rel, name), size)
+                              for rel, (files, _) in self.folders.items() for name, (size, mtime) in files.items())
+
+    def save(self):
+        with self.lock:
+            if not self.isDirty:
+                return
+            text = json.dumps({'version': INDEX_VERSION, 'folder': self.folder, 'folders': self.folders}, ensure_ascii=False, separators=(',', ':'))
+            self.isDirty = False
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError:
+            pass
+
+    def get(self, rel):
+        """ [size, mtime] of the file `rel` when it was last listed, None if it was not there """
+        with self.lock:
+            folder = self.folders.get(os.path.dirname(rel))
+            return folder[0].get(os.path.basename(rel)) if folder else None
+
+    def list(self, item):
+        """ (files, subfolders) of the folder `item` (path, rel) """
+        path, rel = item
+        files, dirs = {}, []
+        for entry in os.scandir(path):
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.name)
+            else:
+                stat = entry.stat(follow_symlinks=False)
+                files[entry.name] = [stat.st_size, stat.st_mtime]
+        return (files, dirs), [(os.path.join(path, name), joinRel(rel, name)) for name in dirs]
+
+    def refresh(self, workers=WALK_WORKERS, isRunning=None):
+        """ bring the index in line with the folder, returns the (path, error) of the folders not listed """
+        with self.lock:
+            seen, added, removed, errors = set(), [], set(), []
+            walker = TreeWalker(self.list, workers)
+            for (path, rel), listing, error in walker.walk([(self.folder, '')]):
+                if isRunning and not isRunning():
+                    break
+                seen.add(rel)
+                if error is not None:
+                    # keep what was known below a folder that cannot be listed now
+                    errors.append((path, error))
+                    seen.update(key for key in self.folders if key.startswith(rel + '/') or not rel)
+                    continue
+                files, dirs = listing
+                record = self.folders.get(rel)
+                if record == [files, dirs]:
+                    continue
+                old = record[0] if record else {}
+                removed.update((mtime, joinRel(rel, name), size) for name, (size, mtime) in old.items()
+                               if files.get(name) != [size, mtime])
+                added += [(mtime, joinRel(rel, name), size) for name, (size, mtime) in files.items()
+                          if old.get(name) != [size, mtime]]
+                self.folders[rel] = [files, dirs]
+                self.isDirty = True
+            else:
+                for rel in [key for key in self.folders if key not in seen]:
+                    removed.update((mtime, joinRel(rel, name), size)
+                                   for name, (size, mtime) in self.folders.pop(rel)[0].items())
+                    self.isDirty = True
+            if removed:
+                self.entries = [entry for entry in self.entries if entry not in removed]
+            if added:
+                self.entries = list(heapq.merge(self.entries, sorted(added)))
+            return errors
+
+    def query(self, fromTime=None, toTime=None):
+        """ (mtime, rel, size) of the files with fromTime <= mtime < toTime, oldest first """
+        with self.lock:
+            start = 0 if fromTime is None else bisect.bisect_left(self.entries, (fromTime, ))
+            end = len(self.entries) if toTime is None else bisect.bisect_left(self.entries, (toTime, ))
+            return self.entries[start:end]
+
+
+def joinRel(rel, name):
+    return rel + '/' + name if rel else name
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+from datetime import datetime
+from PrestoEngine import SyncOptions, TypeFilter, MB, PACK_ORDERS
+from PrestoCache import SourceCache, GB
+from PrestoIndex import MtimeIndex
+
+
+JOB_VERSION = 1
+JOB_FOLDER = os.path.join(os.path.expanduser('~'), '.Presto', 'jobs')  # last job of each drive, kept for replay
+MODES = {1: 'sync', 2: 'syncLow', 3: 'copyLately', 4: 'copyDate'}
+SUBJECTS = ('yuwen', 'shuxue', 'yingyu', 'wuli', 'huaxue', 'shengwu', 'zhengzhi', 'lishi', 'dili', 'jishu', 'ziliao')
+TYPE_ITEMS = {'Document': 'IsDocument', 'Picture': 'IsPicture', 'Audio': 'IsAudio', 'Video': 'IsVideo',
+              'Application': 'IsApplication', 'ZipFile': 'IsZipFile'}
+
+
+class JobError(Exception):
+    """ Job description is missing, from another version or invalid """
+
+
+def checkType(value, type, name):
+    if not isinstance(value, type) or (type is int and isinstance(value, bool)):
+        raise JobError(f'{name}: {value!r}')
+    return value
+
+
+def checkDate(value, name):
+    if value is None:
+        return None
+    try:
+        datetime.strptime(checkType(value, str, name), '%Y%m%d')
+    except ValueError:
+        raise JobError(f'{name}: {value!r}')
+    return value
+
+
+class Job:
+    """ Everything a sync of one drive needs, serialized as versioned JSON
+
+    subjects: task id (1 - 11, see SUBJECTS) -> source folder of the subject
+    mode:     1 sync, 2 sync with low io, 3 copy the files of the last `days` days,
+              4 copy the files between `fromDate` and `toDate` (YYYYMMDD, both included)
+    isFanOut: share the reads of the source with the other drives syncing it at the same time
+    cacheSize: bytes of the local source cache the native engine reads through, None without cache
+    isDelta:  update large files on the drive by writing only their changed blocks
+    isAutoTune: let the native engine tune the chunk size and the concurrent writes for the drive
+    lowIoRate: MB per second the native engine writes at in mode 2
+    packOrder: 'Off' cancels a sync that does not fit the drive, 'Priority', 'Recent' or 'Small'
+               fill the drive in subject order, with the newest or the smallest files first,
+               and leave out the rest
+    """
+
+    def __init__(self, drive, source, subjects, mode=1, isDelete=False, days=None, fromDate=None, toDate=None,
+                 bufSize=256, concurrentProcess=3, engine='FastCopy', verify='Off', isSkipEmptyDir=False,
+                 maxSize=None, typeFilter=None, isFanOut=False, cacheSize=None, isCacheHash=False,
+                 isDelta=False, isAutoTune=False, lowIoRate=10, packOrder='Off'):
+        self.drive = drive
+        self.source = source
+        self.subjects = subjects
+        self.mode = mode
+        self.isDelete = isDelete
+        self.days = days
+        self.fromDate = fromDate
+        self.toDate = toDate
+        self.bufSize = bufSize
+        self.concurrentProcess = concurrentProcess
+        self.engine = engine
+        self.verify = verify
+        self.isSkipEmptyDir = isSkipEmptyDir
+        self.maxSize = maxSize
+        self.typeFilter = typeFilter
+        self.isFanOut = isFanOut
+        self.cacheSize = cacheSize
+        self.isCacheHash = isCacheHash
+        self.isDelta = isDelta
+        self.isAutoTune = isAutoTune
+        self.lowIoRate = lowIoRate
+        self.packOrder = packOrder
+        self.validate()
+
+    def validate(self):
+        checkType(self.drive, str, 'drive')
+        if len(self.drive) != 2 or not self.drive[0].isalpha() or self.drive[1] != ':':
+            raise JobError(f'drive: {self.drive!r}')
+        checkType(self.source, str, 'source')
+        checkType(self.subjects, dict, 'subjects')
+        for task, folder in self.subjects.items():
+            if not isinstance(task, int) or not 1 <= task <= len(SUBJECTS):
+                raise JobError(f'subjects: {task!r}')
+            checkType(folder, str, f'subjects.{SUBJECTS[task - 1]}')
+        if self.mode not in MODES:
+            raise JobError(f'mode: {self.mode!r}')
+        checkType(self.isDelete, bool, 'isDelete')
+        if self.mode == 3 and (not isinstance(self.days, int) or self.days < 0):
+            raise JobError(f'days: {self.days!r}')
+        checkDate(self.fromDate, 'fromDate')
+        checkDate(self.toDate, 'toDate')
+        if self.mode == 4 and (self.fromDate is None or self.toDate is None):
+            raise JobError('mode 4 needs fromDate and toDate')
+        checkType(self.bufSize, int, 'bufSize')
+        if not 1 <= checkType(self.concurrentProcess, int, 'concurrentProcess') <= 5:
+            raise JobError(f'concurrentProcess: {self.concurrentProcess!r}')
+        checkType(self.engine, str, 'engine')
+        checkType(self.verify, str, 'verify')
+        checkType(self.isSkipEmptyDir, bool, 'isSkipEmptyDir')
+        if self.maxSize is not None:
+            checkType(self.maxSize, int, 'maxSize')
+        if self.typeFilter is not None:
+            checkType(self.typeFilter.get('patterns'), list, 'typeFilter.patterns')
+            checkType(self.typeFilter.get('isInclude'), bool, 'typeFilter.isInclude')
+        checkType(self.isFanOut, bool, 'isFanOut')
+        if self.cacheSize is not None:
+            checkType(self.cacheSize, int, 'cacheSize')
+        checkType(self.isCacheHash, bool, 'isCacheHash')
+        checkType(self.isDelta, bool, 'isDelta')
+        checkType(self.isAutoTune, bool, 'isAutoTune')
+        if checkType(self.lowIoRate, int, 'lowIoRate') < 1:
+            raise JobError(f'lowIoRate: {self.lowIoRate!r}')
+        if checkType(self.packOrder, str, 'packOrder') not in ('Off', ) + PACK_ORDERS:
+            raise JobError(f'packOrder: {self.packOrder!r}')
+
+    @property
+    def destFolder(self):
+        return self.drive + '\\' + os.path.basename(os.path.normpath(self.source)) + '\\'
+
+    @property
+    def commandOption(self):
+        """ fcp options for the mode and the filters of the job """
+        option = {1: '/speed=full', 2: '/low_io', 3: f'/from_date=-{self.days}D',
+                  4: f'/from_date={self.fromDate} /to_date={self.toDate}'}[self.mode]
+        option += ' /skip_empty_dir' if self.isSkipEmptyDir else ' /skip_empty_dir=FALSE'
+        if self.maxSize is not None:
+            option += f' /max_size={self.maxSize}'
+        return option
+
+    def createOptions(self) -> SyncOptions:
+        options = SyncOptions(bufSize=self.bufSize * MB, concurrentProcess=self.concurrentProcess,
+                              isSkipEmptyDir=self.isSkipEmptyDir, maxSize=self.maxSize, verify=self.verify,
+                              isDelta=self.isDelta, isAutoTune=self.isAutoTune, lowIoRate=self.lowIoRate * MB,
+                              isDelete=self.isDelete, packOrder=self.packOrder)
+        if self.typeFilter:
+            options.typeFilter = TypeFilter(self.typeFilter['patterns'], self.typeFilter['isInclude'])
+        if self.cacheSize:
+            options.cache = SourceCache.shared(maxSize=self.cacheSize, isHashChecked=self.isCacheHash)
+        if self.mode in (3, 4):
+            options.index = MtimeIndex.shared
+        options.parseCommandOption(self.commandOption)
+        return options
+
+    def toDict(self):
+        return {'version': JOB_VERSION, 'drive': self.drive, 'source': self.source,
+                'subjects': [{'id': task, 'name': SUBJECTS[task - 1], 'folder': folder}
+                             for task, folder in sorted(self.subjects.items())],
+                'mode': self.mode, 'isDelete': self.isDelete, 'days': self.days,
+                'fromDate': self.fromDate, 'toDate': self.toDate, 'bufSize': self.bufSize,
+                'concurrentProcess': self.concurrentProcess, 'engine': self.engine, 'verify': self.verify,
+                'isSkipEmptyDir': self.isSkipEmptyDir, 'maxSize': self.maxSize, 'typeFilter': self.typeFilter,
+                'isFanOut': self.isFanOut, 'cacheSize': self.cacheSize, 'isCacheHash': self.isCacheHash,
+                'isDelta': self.isDelta, 'isAutoTune': self.isAutoTune, 'lowIoRate': self.lowIoRate,
+                'packOrder': self.packOrder}
+
+    @classmethod
+    def fromDict(cls, data):
+        try:
+            if data['version'] != JOB_VERSION:
+                raise JobError(f'version: {data["version"]!r}')
+            subjects = {subject['id']: subject['folder'] for subject in data['subjects']}
+            return cls(data['drive'], data['source'], subjects, data['mode'], data['isDelete'], data.get('days'),
+                       data.get('fromDate'), data.get('toDate'), data['bufSize'], data['concurrentProcess'],
+                       data['engine'], data['verify'], data['isSkipEmptyDir'], data.get('maxSize'),
+                       data.get('typeFilter'), data.get('isFanOut', False), data.get('cacheSize'),
+                       data.get('isCacheHash', False), data.get('isDelta', False), data.get('isAutoTune', False),
+                       data.get('lowIoRate', 10), data.get('packOrder', 'Off'))
+        except (KeyError, TypeError, AttributeError) as e:
+            raise JobError(f'missing or malformed {e}')
+
+    def dumps(self):
+        return json.dumps(self.toDict(), ensure_ascii=False, indent=2)
+
+    def dump(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.dumps())
+
+    @classmethod
+    def loads(cls, text):
+        try:
+            return cls.fromDict(json.loads(text))
+        except ValueError as e:
+            raise JobError(str(e))
+
+    @classmethod
+    def load(cls, path):
+        """ read a job from the file `path`, or from the standard input if it is '-' """
+        try:
+            if path == '-':
+                return cls.loads(sys.stdin.buffer.read().decode('utf-8'))
+            with open(path, 'r', encoding='utf-8') as f:
+                return cls.loads(f.read())
+        except (OSError, UnicodeDecodeError) as e:
+            raise JobError(str(e))
+
+    @classmethod
+    def fromConfig(cls, cfg, drive, tasks, mode=1, isDelete=False, days=None, fromDate=None, toDate=None):
+        """ job for `tasks` on `drive` with the settings currently in `cfg` """
+        maxSize = None
+        if cfg.IsSizeFilter.value:
+            maxSize = cfg.SizeFilterValue.value * {'KB': 1024, 'MB': MB, 'GB': 1024 * MB}[cfg.SizeFilterUnit.value]
+        typeFilter = None
+        if cfg.IsTypeFilter.value:
+            types = [name for name, item in TYPE_ITEMS.items() if getattr(cfg, item).value]
+            custom = cfg.CustomTypes.value if cfg.IsCustom.value else ''
+            compiled = TypeFilter.create(types, custom)
+            if compiled:
+                typeFilter = {'patterns': compiled.patterns, 'isInclude': cfg.TypeFilterMode.value == 'Include'}
+        return cls(drive, os.path.normpath(cfg.sourceFolder.value),
+                   {task: getattr(cfg, SUBJECTS[task - 1] + 'Folder').value for task in tasks},
+                   mode, isDelete, days, fromDate, toDate, int(str(cfg.BufSize.value)[9:]),
+                   cfg.ConcurrentProcess.value, cfg.Engine.value, cfg.Verify.value, cfg.IsSkipEmptyDir.value,
+                   maxSize, typeFilter, cfg.FanOut.value, cfg.CacheSize.value * GB if cfg.IsCache.value else None,
+                   cfg.IsCacheHash.value, cfg.IsDelta.value, cfg.IsAutoTune.value, cfg.LowIoRate.value,
+                   cfg.PackOrder.value)
+
+    @classmethod
+    def fromArgv(cls, argv, cfg):
+        """ job from the positional arguments used before job files: drive, 11 subject flags, mode,
+        isDelete and the fcp date options """
+        try:
+            tasks = [i - 1 for i in range(2, 13) if argv[i] == '1']
+            mode = int(argv[13])
+            option = argv[15]
+        except (IndexError, ValueError):
+            raise JobError('usage: PrestoMain --job <file|->')
+        days = fromDate = toDate = None
+        for key, value in (part.split('=', 1) for part in option.split() if '=' in part):
+            if key == '/from_date' and value.startswith('-'):
+                days = int(value[1:].rstrip('D'))
+            elif key == '/from_date':
+                fromDate = value
+            elif key == '/to_date':
+                toDate = value
+        return cls.fromConfig(cfg, argv[1][0] + ':', tasks, mode, argv[14] != 'False', days, fromDate, toDate)
+
+
+if __name__ == '__main__':
+    # run job files without a window, for batches of drives and for replaying a job when measuring:
+    # python PrestoJob.py <job.json> [<job.json> ...]
+    import time
+    from PrestoManifest import Manifest
+    from PrestoService import SyncClient, SyncJob
+
+    for path in sys.argv[1:]:
+        job = Job.load(path)
+        start = time.monotonic()
+        result = {}
+        request = {'type': 'sync', 'job': job.toDict()}
+        client = SyncClient.connect()
+        if client:
+            events = client.submit(request)
+        else:
+            events = []
+            SyncJob(request, Manifest.load(job.destFolder, job.source), lambda *event: events.append(event)).run()
+        for event, data in events:
+            result[event] = data
+        progress = result.get('progress') or {}
+        print(f"{path}: {progress.get('filesDone', 0)} files, {progress.get('bytesDone', 0)} bytes "
+              f"in {time.monotonic() - start:.2f} s, finished: {result.get('finished')}, shortage: {result.get('shortage')}")
+        for rel in (result.get('packed') or {}).get('skipped', []):
+            print(f'  left out: {rel}')
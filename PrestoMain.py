@@ -2,12 +2,17 @@
 
 import os
 import sys
+import time
 import subprocess
 import darkdetect
 import PrestoResource
 from psutil import Process
 from random import randint
 from PrestoConfig import cfg
+from PrestoEngine import ProgressEvent, PlanSummary
+from PrestoJob import Job, JobError
+from PrestoService import SyncClient, SyncJob
+from PrestoManifest import Manifest
 from winotify import Notification, audio
 from win32api import GetVolumeInformation
 from PyQt5.QtGui import QIcon, QColor, QPainter
@@ -299,6 +304,28 @@ class EjectUsbInfoBar(QFrame):
         painter.drawRoundedRect(rect, 6, 6)
 
 
+def formatSize(size):
+    kbSize = float(size / 1024)
+    if kbSize >= 1024*1024:
+        return str(round(kbSize/1024/1024, 1)) + ' GB'
+    elif kbSize >= 1024:
+        return str(round(kbSize/1024, 1)) + ' MB'
+    else:
+        return str(int(kbSize)) + ' KB'
+
+
+def formatTime(seconds):
+    if seconds is None:
+        return '--'
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f'{seconds // 3600} 小时 {seconds % 3600 // 60} 分'
+    elif seconds >= 60:
+        return f'{seconds // 60} 分 {seconds % 60} 秒'
+    else:
+        return f'{seconds} 秒'
+
+
 class UiDetailDialog:
     def __init__(self, *args, **kwargs):
         pass
@@ -309,7 +336,7 @@ class UiDetailDialog:
         self.tableView.setBorderVisible(True)
         self.tableView.setBorderRadius(8)
         self.tableView.setWordWrap(False)
-        self.tableView.setRowCount(6)
+        self.tableView.setRowCount(10)
         self.tableView.setColumnCount(2)
         self.tableView.verticalHeader().hide()
         self.tableView.setEnabled(False)
@@ -326,6 +353,14 @@ class UiDetailDialog:
         self.tableView.setItem(4, 1, QTableWidgetItem(buf + ' MB'))
         self.tableView.setItem(5, 0, QTableWidgetItem('并行进程数'))
         self.tableView.setItem(5, 1, QTableWidgetItem(str(concurrentProcess)))
+        self.tableView.setItem(6, 0, QTableWidgetItem('当前文件'))
+        self.tableView.setItem(6, 1, QTableWidgetItem('--'))
+        self.tableView.setItem(7, 0, QTableWidgetItem('已完成'))
+        self.tableView.setItem(7, 1, QTableWidgetItem('--'))
+        self.tableView.setItem(8, 0, QTableWidgetItem('速度'))
+        self.tableView.setItem(8, 1, QTableWidgetItem('--'))
+        self.tableView.setItem(9, 0, QTableWidgetItem('剩余时间'))
+        self.tableView.setItem(9, 1, QTableWidgetItem('--'))
 
         self.tableView.resizeColumnsToContents()
         self.titleLabel.setVisible(False)
@@ -391,6 +426,13 @@ class DetailDialog(FramelessDialog, UiDetailDialog):
     def setTitleBarVisible(self, isVisible: bool):
         self.windowTitleLabel.setVisible(isVisible)
 
+    def setProgress(self, event):
+        self.tableView.item(6, 1).setText(event.currentFile or '--')
+        self.tableView.item(7, 1).setText(f'{formatSize(event.bytesDone)} / {formatSize(event.bytesTotal)}, '
+                                          f'{event.filesDone} / {event.filesTotal} 个文件')
+        self.tableView.item(8, 1).setText(formatSize(event.throughput) + '/s')
+        self.tableView.item(9, 1).setText(formatTime(event.eta))
+
 
 class UiErrorDialog:
 
@@ -491,103 +533,136 @@ class ErrorDialog(FramelessDialog, UiErrorDialog):
         self.setFixedSize(self.size())
 
 
-class DeleteThread(QThread):
-    deleteFinished = pyqtSignal(bool)
+class JobThread(QThread):
+    """ Run a request in the sync service of PrestoScan, or in this process when it is not running """
 
     def __init__(self, parent=None):
         super().__init__(parent=parent)
         self.isRunning = True
-        self.process = None
+        self.isPaused = False
+        self.client = None
+        self.job = None
 
     def stop(self):
         self.isRunning = False
-
-    def run(self):
-        if self.isRunning:
-            args = "fcp.exe /cmd=delete " + f"/bufsize={buf} /log=FALSE " + f'/force_start={concurrentProcess} "{destFolder}"'
-            if os.path.exists('fcp.exe'):
-                self.process = subprocess.Popen(args, shell=True)
-                self.process.wait()
-            else:
-                w = ErrorDialog("错误", "核心文件缺失，请尝试重新安装。Presto 将退出。")
-                w.yesButton.setText("确定")
-                if w.exec():
-                    sys.exit()
-
-            self.deleteFinished.emit(True)
-            return
+        if self.client:
+            self.client.stop()
+        if self.job:
+            self.job.stop()
+
+    def pause(self, isPaused=True):
+        """ park the job inside the engine, it goes on from the same chunk when resumed """
+        self.isPaused = isPaused
+        if self.client:
+            self.client.pause(isPaused)
+        if self.job:
+            self.job.pause(isPaused)
+
+    def createRequest(self, type, tasks=()):
+        return {'type': type, 'job': job.toDict(), 'tasks': list(tasks)}
+
+    def submit(self, request):
+        self.client = SyncClient.connect()
+        if self.client:
+            if self.isPaused:
+                self.client.pause()  # held back by the client until the request is sent
+            isFinished = False
+            for event, data in self.client.submit(request):
+                self.onEvent(event, data)
+                isFinished = isFinished or event == 'finished'
+            self.client = None
+            if not isFinished and self.isRunning:
+                self.onEvent('error', "与同步服务的连接已断开")
         else:
-            self.process.terminate()
-            return
+            try:
+                self.job = SyncJob(request, Manifest.load(destFolder, sourceFolder), self.onEvent)
+                if self.isPaused:
+                    self.job.pause()
+                if not self.isRunning:
+                    self.job.stop()
+                self.job.run()
+            except Exception as e:
+                self.onEvent('error', str(e) or type(e).__name__)
+            self.job = None
+
+    def onEvent(self, event, data):
+        pass
 
 
-class SyncThread(QThread):
+class SyncThread(JobThread):
     valueChange = pyqtSignal(int)
+    progressChange = pyqtSignal(object)
+    spaceShortage = pyqtSignal(object)
+    spacePacked = pyqtSignal(object)
+    syncFailed = pyqtSignal(str)
 
     def __init__(self, parent=None):
         super().__init__(parent=parent)
-        self.is_paused = bool(0)
         self.progress_value = int(0)
-        self.isRunning = True
-        self.process = None
-
-    def stop(self):
-        self.isRunning = False
+        self.lastEvent = None
+        self.mismatches = []
 
-    def run(self):
-        global currentTask
-        while self.isRunning:
-            if taskList or currentTask:
-                if currentTask == 0:
-                    currentTask = taskList.pop(0)
-
-                if currentTask == 1:
-                    currentFolder = cfg.yuwenFolder.value
-                elif currentTask == 2:
-                    currentFolder = cfg.shuxueFolder.value
-                elif currentTask == 3:
-                    currentFolder = cfg.yingyuFolder.value
-                elif currentTask == 4:
-                    currentFolder = cfg.wuliFolder.value
-                elif currentTask == 5:
-                    currentFolder = cfg.huaxueFolder.value
-                elif currentTask == 6:
-                    currentFolder = cfg.shengwuFolder.value
-                elif currentTask == 7:
-                    currentFolder = cfg.zhengzhiFolder.value
-                elif currentTask == 8:
-                    currentFolder = cfg.lishiFolder.value
-                elif currentTask == 9:
-                    currentFolder = cfg.diliFolder.value
-                elif currentTask == 10:
-                    currentFolder = cfg.jishuFolder.value
-                elif currentTask == 11:
-                    currentFolder = cfg.ziliaoFolder.value
-
-                args = f'fcp.exe /cmd=sync /log=FALSE /no_confirm_stop /error_stop=FALSE /bufsize={buf} /force_start={concurrentProcess} {commandOption} "' + currentFolder.replace('/', '\\') + f'" /to="{destFolder}"'
-                if os.path.exists('fcp.exe'):
-                    self.process = subprocess.Popen(args, shell=True)
-                    self.process.wait()
-                else:
-                    w = ErrorDialog("错误", "核心文件缺失，请尝试重新安装。Presto 将退出。")
-                    w.yesButton.setText("确定")
-                    if w.exec():
-                        sys.exit()
+    def writeReport(self, mismatches):
+        try:
+            os.makedirs('./Log', exist_ok=True)
+            with open(time.strftime('./Log/Verify_%Y%m%d_%H%M%S.log'), 'w', encoding='utf-8') as f:
+                f.write(f'{drive}\\  {cfg.Verify.value}\n')
+                for rel, expected, actual in mismatches:
+                    f.write(f'{rel}\t{expected}\t{actual}\n')
+        except OSError:
+            pass
 
-                self.progress_value = int((taskNum - len(taskList)) / taskNum * 100)
-                self.valueChange.emit(self.progress_value)
+    def writeSkipped(self, summary):
+        try:
+            os.makedirs('./Log', exist_ok=True)
+            with open(time.strftime('./Log/Skipped_%Y%m%d_%H%M%S.log'), 'w', encoding='utf-8') as f:
+                f.write(f'{drive}\\  {cfg.PackOrder.value}  {summary.bytesSkipped}\n')
+                for rel in summary.skipped:
+                    f.write(f'{rel}\n')
+        except OSError:
+            pass
 
-                if taskList:
-                    currentTask = taskList.pop(0)
-                else:
-                    currentTask = 0
-            else:
+    def onProgress(self, event):
+        if event.bytesTotal > 0:
+            value = event.percent
+        elif taskNum:
+            value = int((taskNum - len(taskList)) / taskNum * 100)
+        else:
+            # nothing selected, nothing to copy
+            value = 100
+        # a resumed sync plans only what is left, never let the bar run backwards
+        self.progress_value = max(self.progress_value, value)
+        self.lastEvent = event
+        self.valueChange.emit(self.progress_value)
+        self.progressChange.emit(event)
+
+    def onEvent(self, event, data):
+        if event == 'progress':
+            self.onProgress(ProgressEvent(**data))
+        elif event == 'taskFinished':
+            if data in taskList:
+                taskList.remove(data)
+        elif event == 'shortage':
+            self.isRunning = False
+            self.spaceShortage.emit(PlanSummary.fromDict(data))
+        elif event == 'packed':
+            summary = PlanSummary.fromDict(data)
+            self.writeSkipped(summary)
+            self.spacePacked.emit(summary)
+        elif event == 'error':
+            self.isRunning = False
+            self.syncFailed.emit(data)
+        elif event == 'finished':
+            if data['mismatches']:
+                self.mismatches.extend(data['mismatches'])
+                self.writeReport(data['mismatches'])
+            if self.isRunning and not data['isStopped']:
                 self.progress_value = -1
                 self.valueChange.emit(self.progress_value)
-                return
-        else:
-            self.process.terminate()
-            return
+
+    def run(self):
+        if self.isRunning:
+            self.submit(self.createRequest('sync', taskList))
 
 
 class EjectThread(QThread):
@@ -651,10 +726,10 @@ class MainWindow(MicaWindow):
         self.titleBar.closeBtn.clicked.connect(self.onCancelBtn)
 
         self.isPrepare = True
+        self.detailDialog = None
         self.isProgress = True
         self.isPaused = False
         self.syncThreadRunning = False
-        self.deleteThreadRunning = False
         self.ejectThreadRunning = False
 
         self.mainLayout = QVBoxLayout(self)
@@ -709,17 +784,12 @@ class MainWindow(MicaWindow):
         self.mainLayout.addStretch(1)
         self.mainLayout.addLayout(self.bottomLayout)
 
-        self.deleteThread = DeleteThread()
         self.syncThread = SyncThread()
         self.ejectThread = EjectThread()
-        if isDelete:
-            self.statusLabel.setText("正在删除原有文件")
-            self.setupDeleteThread()
-            self.startDeleteThread()
-        else:
-            self.statusLabel.setText("准备中")
-            self.setupSyncThread()
-            self.startSyncThread()
+        # with isDelete the plan of the sync removes what the new selection leaves out
+        self.statusLabel.setText("准备中")
+        self.setupSyncThread()
+        self.startSyncThread()
 
         self.taskbarButton = QWinTaskbarButton(self)
         self.taskbarProgress = self.taskbarButton.progress()
@@ -753,26 +823,12 @@ class MainWindow(MicaWindow):
         super().mouseMoveEvent(event)
         self.update()
 
-    def setupDeleteThread(self):
-        self.deleteThread.deleteFinished.connect(self.deleteThreadFinished)
-        self.deleteThreadRunning = True
-
-    def startDeleteThread(self):
-        if self.deleteThreadRunning:
-            self.deleteThread.start()
-        else:
-            self.setupDeleteThread()
-            self.deleteThread.start()
-
-    def deleteThreadFinished(self):
-        self.deleteThread.quit()
-        self.deleteThreadRunning = False
-        self.setupSyncThread()
-        self.startSyncThread()
-        self.statusLabel.setText("准备中")
-
     def setupSyncThread(self):
         self.syncThread.valueChange.connect(self.setSyncValue)
+        self.syncThread.progressChange.connect(self.setSyncDetail)
+        self.syncThread.spaceShortage.connect(self.onSpaceShortage)
+        self.syncThread.spacePacked.connect(self.onSpacePacked)
+        self.syncThread.syncFailed.connect(self.onSyncFailed)
         self.syncThreadRunning = True
 
     def startSyncThread(self):
@@ -817,6 +873,8 @@ class MainWindow(MicaWindow):
         self.pauseBtn.deleteLater()
 
         self.statusLabel.setText({1:"同步完成", 2:"同步完成", 3:"复制完成", 4:"复制完成"}[mode])
+        if self.syncThread.mismatches:
+            self.statusLabel.setText(self.statusLabel.text() + f"，{len(self.syncThread.mismatches)} 个文件校验失败")
         self.detailLabel.setText(self.driveName)
         self.finishBtn.setVisible(True)
         self.viewBtn.setVisible(True)
@@ -827,8 +885,10 @@ class MainWindow(MicaWindow):
 
         self.timer.start(1000)
 
-    def setSyncValue(self):
-        if self.syncThread.progress_value == -1:
+    def setSyncValue(self, value):
+        if not self.syncThreadRunning:
+            return
+        if value == -1:
             self.syncThread.terminate()
             self.syncThreadRunning = False
             self.taskbarProgress.setVisible(False)
@@ -855,13 +915,54 @@ class MainWindow(MicaWindow):
                 self.isPrepare = False
                 self.taskbarProgress.setRange(0, 100)
 
-            self.taskbarProgress.setValue(self.syncThread.progress_value)
-            self.progressBar.setValue(self.syncThread.progress_value)
-            self.progressLabel.setText(str(self.syncThread.progress_value) + '%')
+            self.taskbarProgress.setValue(value)
+            self.progressBar.setValue(value)
+            self.progressLabel.setText(str(value) + '%')
             self.bottomLayout.addWidget(self.progressBar)
             self.bottomLayout.addWidget(self.spaceLabel)
             self.bottomLayout.addWidget(self.progressLabel)
 
+    def setSyncDetail(self, event):
+        if not self.syncThreadRunning or self.isPaused:
+            return
+        if event.throughput > 0:
+            self.detailLabel.setText(f'{self.displayText}  {formatSize(event.throughput)}/s，剩余 {formatTime(event.eta)}')
+        if self.detailDialog:
+            self.detailDialog.setProgress(event)
+
+    def onSpaceShortage(self, summary):
+        self.syncThreadRunning = False
+        self.inProgressBar.pause()
+        self.taskbarProgress.stop()
+        self.statusLabel.setText("空间不足")
+        w = ErrorDialog("空间不足", f"需要复制 {formatSize(summary.bytesTotal)}（{summary.filesTotal} 个文件），"
+                                  f"U 盘仍缺少 {formatSize(summary.bytesShort)} 可用空间。同步已取消，Presto 将退出。", self)
+        w.yesButton.setText("确定")
+        w.exec()
+        self.Quit()
+
+    def onSyncFailed(self, message):
+        self.syncThreadRunning = False
+        self.inProgressBar.pause()
+        self.taskbarProgress.stop()
+        self.statusLabel.setText("同步失败")
+        w = ErrorDialog("同步失败", f"{message}。Presto 将退出。", self)
+        w.yesButton.setText("确定")
+        w.exec()
+        self.Quit()
+
+    def onSpacePacked(self, summary):
+        w = InfoBar(icon=InfoBarIcon.WARNING,
+                    title='空间不足',
+                    content=f'{len(summary.skipped)} 个文件（{formatSize(summary.bytesSkipped)}）放不下，'
+                            f'已跳过，详见 Log 文件夹',
+                    orient=Qt.Horizontal,
+                    isClosable=True,
+                    position=InfoBarPosition.BOTTOM,
+                    duration=-1,
+                    parent=self)
+        w.show()
+
     def setupEjectThread(self):
         self.ejectThread.ejectFinished.connect(self.ejectThreadFinished)
         self.ejectThreadRunning = True
@@ -900,14 +1001,12 @@ class MainWindow(MicaWindow):
         self.inProgressBar.pause()
         self.taskbarProgress.stop()
 
-        self.deleteThread.stop()
         self.syncThread.stop()
-        self.deleteThreadRunning = False
         self.syncThreadRunning = False
-        self.deleteThread.quit()
         self.syncThread.quit()
 
         self.killSubprocess()
+        self.syncThread.wait(3000)
         sys.exit()
 
     def getDriveName(self):
@@ -938,10 +1037,12 @@ class MainWindow(MicaWindow):
             sys.exit()
 
     def onShowDetailBtn(self):
-        w = DetailDialog('Presto 选项', self.displayText, self.subject, self)
-        w.setTitleBarVisible(False)
-        if w.exec():
-            pass
+        self.detailDialog = DetailDialog('Presto 选项', self.displayText, self.subject, self)
+        self.detailDialog.setTitleBarVisible(False)
+        if self.syncThread.lastEvent:
+            self.detailDialog.setProgress(self.syncThread.lastEvent)
+        self.detailDialog.exec()
+        self.detailDialog = None
 
     def onPauseBtn(self):
         if self.isPaused:
@@ -950,40 +1051,24 @@ class MainWindow(MicaWindow):
             self.pauseBtn.setIcon(FIF.PAUSE)
             self.isPaused = False
             self.statusLabel.setText("准备中")
-            if self.deleteThreadRunning:
-                self.statusLabel.setText("正在删除原有文件")
-                self.inProgressBar.setPaused(False)
-                self.progressBar.setPaused(False)
-                self.taskbarProgress.setPaused(False)
-                self.setupDeleteThread()
-                self.startDeleteThread()
-            elif self.syncThreadRunning:
+            if self.syncThreadRunning:
                 self.statusLabel.setText("正在同步")
                 self.inProgressBar.setPaused(False)
                 self.progressBar.setPaused(False)
                 self.taskbarProgress.setPaused(False)
-                self.setupSyncThread()
-                self.startSyncThread()
+                self.syncThread.pause(False)
         else:
             """pause"""
             self.pauseBtn.setText("继续")
             self.pauseBtn.setIcon(FIF.PLAY)
             self.isPaused = True
             self.statusLabel.setText("已暂停")
-            if self.deleteThreadRunning:
+            if self.syncThreadRunning:
                 self.inProgressBar.setPaused(True)
                 self.progressBar.setPaused(True)
                 self.taskbarProgress.setPaused(True)
-                self.deleteThread.isRunning = False
-                self.deleteThread.terminate()
-                self.killSubprocess()
-            elif self.syncThreadRunning:
-                self.inProgressBar.setPaused(True)
-                self.progressBar.setPaused(True)
-                self.taskbarProgress.setPaused(True)
-                self.syncThread.isRunning = True
-                self.syncThread.terminate()
-                self.killSubprocess()
+                self.syncThread.pause()
+                self.detailLabel.setText(self.displayText)
 
     def Quit(self):
         self.close()
@@ -1024,6 +1109,8 @@ if __name__ == '__main__':
 
     """
     args
+    --job <file|->      job description (see PrestoJob), '-' reads it from the standard input
+    or the positional arguments of older versions:
     1           drive
     2 - 12      subjects
     13          mode{1:"sync(default)", 2:"sync(low)", 3:"copy(lately)", 4:"copy(from_date)"}
@@ -1031,31 +1118,24 @@ if __name__ == '__main__':
     15          commandOption
     """
 
+    jobError = None
     try:
-        drive = sys.argv[1][0] + ':'
-        taskList = []
-        for i in range(2, 13):
-            if sys.argv[i] == '1':
-                taskList.append(i - 1)
-        taskNum = len(taskList)
-        buf = str(cfg.BufSize.value)[9:]
-        concurrentProcess = cfg.ConcurrentProcess.value
-        sourceFolder = os.path.normpath(cfg.sourceFolder.value)
-        destFolder = drive + '\\' + os.path.basename(sourceFolder) + '\\'
-        mode = int(sys.argv[13])
-        isDelete = False if sys.argv[14] == 'False' else True
-
-        commandOption = sys.argv[15]
-        if cfg.IsSkipEmptyDir.value:
-            commandOption = commandOption + " /skip_empty_dir"
+        if len(sys.argv) == 3 and sys.argv[1] == '--job':
+            job = Job.load(sys.argv[2])
         else:
-            commandOption = commandOption + " /skip_empty_dir=FALSE"
-        if cfg.IsSizeFilter.value:
-            commandOption = commandOption + f' /max_size="{cfg.SizeFilterValue.value}{cfg.SizeFilterUnit.value[0]}"'
-
-        currentTask = 0
-    except:
-        sys.exit()
+            job = Job.fromArgv(sys.argv, cfg)
+        drive = job.drive
+        taskList = sorted(job.subjects)
+        taskNum = len(taskList)
+        buf = str(job.bufSize)
+        concurrentProcess = job.concurrentProcess
+        sourceFolder = os.path.normpath(job.source)
+        destFolder = job.destFolder
+        mode = job.mode
+        isDelete = job.isDelete
+        commandOption = job.commandOption
+    except JobError as e:
+        jobError = str(e)
 
     QApplication.setHighDpiScaleFactorRoundingPolicy(Qt.HighDpiScaleFactorRoundingPolicy.PassThrough)
     QApplication.setAttribute(Qt.AA_EnableHighDpiScaling)
@@ -1065,6 +1145,11 @@ if __name__ == '__main__':
     else:
         setTheme(Theme.LIGHT)
     app = QApplication(sys.argv)
+    if jobError:
+        w = ErrorDialog("错误", f"任务描述无效：{jobError}。Presto 将退出。")
+        w.yesButton.setText("确定")
+        w.exec()
+        sys.exit()
     w = MainWindow()
     w.show()
     app.exec()
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import json
+import hashlib
+import threading
+
+
+MANIFEST_VERSION = 2
+MANIFEST_NAME = '.presto_manifest.json'
+JOURNAL_NAME = '.presto_journal'
+MIRROR_FOLDER = os.path.join(os.path.expanduser('~'), '.Presto', 'manifest')
+TRUST_PERIOD = 24 * 3600  # a full walk is forced once the last one is older than this
+
+
+class ManifestError(Exception):
+    """ Manifest is missing, from another version or corrupted """
+
+
+def getVolumeInfo(path):
+    """ (id, label, file system) of the volume holding `path`, the id is the serial number when available """
+    try:
+        from win32api import GetVolumeInformation
+        label, serial, _, _, fileSystem = GetVolumeInformation(os.path.splitdrive(os.path.abspath(path))[0] + '\\')
+        return str(serial), label, fileSystem
+    except:
+        pass
+    try:
+        return str(os.stat(path).st_dev), '', ''
+    except OSError:
+        return '', '', ''
+
+
+def getVolumeId(path):
+    """ identify the volume holding `path`, the serial number is used when available """
+    return getVolumeInfo(path)[0]
+
+
+class Journal:
+    """ Write-ahead log of the sync of a destination folder, kept on the drive beside the manifest
+
+    Each line is a JSON record [op, rel, size, mtime, value]:
+    'part' gives the length of a part file flushed to the drive so far, 'delta' the length of
+    a file updated in place by a delta write, 'done' a file moved into place and its hash.
+    A sync cut short by a stop, a crash or a pulled drive leaves the journal behind. The next
+    one replays the finished files into the manifest, and continues the part files and the
+    delta writes from their last record. A finished sync clears the journal.
+
+    parts:  relative path -> [size, mtime, offset]
+    deltas: relative path -> [size, mtime, [offset, key of the signature the write compares with]]
+    done:   relative path -> [size, mtime, hash]
+    """
+
+    def __init__(self, root):
+        self.path = os.path.join(root, JOURNAL_NAME)
+        self.parts = {}
+        self.deltas = {}
+        self.done = {}
+        self.file = None
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+        except (OSError, UnicodeDecodeError):
+            return
+        for line in lines:
+            try:
+                op, rel, size, mtime, value = json.loads(line)
+            except (ValueError, TypeError):
+                continue  # torn by a crash while it was written
+            if op == 'part':
+                self.parts[rel] = [size, mtime, value]
+                self.done.pop(rel, None)
+            elif op == 'delta':
+                self.deltas[rel] = [size, mtime, value]
+                self.done.pop(rel, None)
+            elif op == 'done':
+                self.done[rel] = [size, mtime, value]
+                self.parts.pop(rel, None)
+                self.deltas.pop(rel, None)
+
+    def append(self, record, isDurable=False):
+        """ add `record`, and make sure it reached the drive if `isDurable` """
+        with self.lock:
+            try:
+                if self.file is None:
+                    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                    self.file = open(self.path, 'a', encoding='utf-8')
+                self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+                self.file.flush()
+                if isDurable:
+                    os.fsync(self.file.fileno())
+            except OSError:
+                pass
+
+    def checkpoint(self, rel, size, mtime, offset):
+        """ the first `offset` bytes of the part file of `rel` are on the drive """
+        with self.lock:
+            self.parts[rel] = [size, mtime, offset]
+        self.append(['part', rel, size, mtime, offset], True)
+
+    def checkpointDelta(self, rel, size, mtime, offset, key):
+        """ the first `offset` bytes of `rel` on the drive have been updated in place to the source """
+        with self.lock:
+            self.deltas[rel] = [size, mtime, [offset, key]]
+        self.append(['delta', rel, size, mtime, [offset, key]], True)
+
+    def finish(self, rel, size, mtime, hash=None):
+        with self.lock:
+            self.parts.pop(rel, None)
+            self.deltas.pop(rel, None)
+            self.done[rel] = [size, mtime, hash]
+        self.append(['done', rel, size, mtime, hash])
+
+    def getPart(self, rel, size, mtime, path):
+        """ offset the part file `path` of `rel` can be continued from, 0 to start over """
+        record = self.parts.get(rel)
+        if record is None or record[0] != size or record[1] != mtime:
+            return 0
+        try:
+            return record[2] if os.path.getsize(path) >= record[2] else 0
+        except OSError:
+            return 0
+
+    def getDelta(self, rel, size, mtime, key):
+        """ offset a delta write of `rel` against the signature `key` can be continued from, None if none was started """
+        record = self.deltas.get(rel)
+        if record is None or record[0] != size or record[1] != mtime or record[2][1] != key:
+            return None
+        return record[2][0]
+
+    def isResumable(self, rel, size, mtime):
+        record = self.parts.get(rel)
+        return record is not None and record[0] == size and record[1] == mtime
+
+    def recover(self, manifest):
+        """ record the files finished by an interrupted sync in `manifest` """
+        for rel, (size, mtime, hash) in self.done.items():
+            manifest.update(rel, size, mtime, hash)
+
+    def clear(self):
+        """ forget everything, the sync this journal was kept for has finished """
+        with self.lock:
+            self.parts, self.deltas, self.done = {}, {}, {}
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+class Manifest:
+    """ Index of the files synced into a destination folder
+
+    files: relative path -> [size, mtime, hash]
+    dirs:  relative path -> [mtime_ns of the destination folder, names inside it]
+    signatures: relative path -> [size, mtime, block size, block hashes] of large files, for delta writes
+
+    A destination folder whose mtime is unchanged is trusted not to have gained or lost
+    entries, so its listing is taken from the manifest instead of being read from the drive.
+    Source folders are always listed, a scandir returns the sizes and mtimes with the names.
+    The trust expires after `TRUST_PERIOD` and the next sync walks the subject again.
+
+    The journal of the folder is kept alongside, see Journal.
+    """
+
+    def __init__(self, root, source=''):
+        self.root = os.path.normpath(root)
+        self.source = source
+        self.volume = getVolumeId(self.root)
+        self.journal = Journal(self.root)
+        self.files = {}
+        self.dirs = {}
+        self.signatures = {}
+        self.scanTimes = {}
+        self.filter = ''
+        self.isDirty = False
+        self.lock = threading.RLock()
+
+    @property
+    def path(self):
+        return os.path.join(self.root, MANIFEST_NAME)
+
+    @property
+    def mirrorPath(self):
+        key = hashlib.sha1(f'{os.path.normpath(self.source)}|{self.volume}'.encode('utf-8')).hexdigest()
+        return os.path.join(MIRROR_FOLDER, key + '.json')
+
+    @classmethod
+    def load(cls, root, source=''):
+        """ load the manifest of `root`, use the local mirror if the copy on the drive is unusable """
+        manifest = cls(root, source)
+        for path in (manifest.path, manifest.mirrorPath):
+            try:
+                manifest.read(path)
+                break
+            except ManifestError:
+                manifest.files, manifest.dirs, manifest.signatures, manifest.scanTimes = {}, {}, {}, {}
+        manifest.journal.recover(manifest)
+        return manifest
+
+    def read(self, path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            payload = data['payload']
+            if data['version'] != MANIFEST_VERSION or data['checksum'] != self.checksum(payload):
+                raise ManifestError(path)
+            if payload['volume'] != self.volume or os.path.normpath(payload['source']) != os.path.normpath(self.source):
+                raise ManifestError(path)
+            self.files = payload['files']
+            self.dirs = payload['dirs']
+            self.scanTimes = payload['scanTimes']
+            self.signatures = payload.get('signatures', {})
+            self.filter = payload.get('filter', '')
+        except (OSError, ValueError, KeyError, TypeError):
+            raise ManifestError(path)
+
+    def checksum(self, payload):
+        text = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def save(self):
+        """ write the manifest to the drive and to the local mirror """
+        with self.lock:
+            if not self.isDirty:
+                return
+            payload = {'source': self.source, 'volume': self.volume, 'filter': self.filter,
+                       'scanTimes': self.scanTimes, 'files': self.files, 'dirs': self.dirs,
+                       'signatures': self.signatures}
+            data = {'version': MANIFEST_VERSION, 'checksum': self.checksum(payload), 'payload': payload}
+            text = json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+            self.isDirty = False
+        for path in (self.path, self.mirrorPath):
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                    f.write(text)
+                os.replace(path + '.tmp', path)
+            except OSError:
+                pass
+
+    def invalidate(self, prefix=''):
+        """ forget everything below the relative folder `prefix`, or the whole manifest """
+        with self.lock:
+            if not prefix:
+                self.files, self.dirs, self.signatures, self.scanTimes = {}, {}, {}, {}
+            else:
+                prefix = prefix.strip('/')
+                self.scanTimes.pop(prefix, None)
+                for table in (self.files, self.dirs, self.signatures):
+                    for key in [k for k in table if k == prefix or k.startswith(prefix + '/')]:
+                        del table[key]
+                parent, _, name = prefix.rpartition('/')
+                self.dirs.pop(parent, None)
+            self.isDirty = True
+
+    def setFilter(self, key):
+        """ folder listings hold only the entries passing the type filter, drop them when it changes """
+        if key != self.filter:
+            self.invalidate()
+            self.filter = key
+
+    def get(self, rel):
+        return self.files.get(rel)
+
+    def update(self, rel, size, mtime, hash=None):
+        with self.lock:
+            self.files[rel] = [size, mtime, hash]
+            self.isDirty = True
+
+    def getSignature(self, rel):
+        return self.signatures.get(rel)
+
+    def setSignature(self, rel, size, mtime, blockSize, sums):
+        with self.lock:
+            self.signatures[rel] = [size, mtime, blockSize, sums]
+            self.isDirty = True
+
+    def totalSize(self, prefix):
+        """ bytes recorded below the relative folder `prefix` """
+        with self.lock:
+            return sum(record[0] for key, record in self.files.items() if key.startswith(prefix + '/'))
+
+    def remove(self, rel):
+        self.invalidate(rel)
+
+    def isTrusted(self, rel):
+        return time.time() - self.scanTimes.get(rel.split('/')[0], 0) < TRUST_PERIOD
+
+    def markScanned(self, subject):
+        """ record that every folder of `subject` has just been walked """
+        with self.lock:
+            self.scanTimes[subject] = time.time()
+            self.isDirty = True
+
+    def children(self, rel):
+        """ name -> (isDir, size, mtime) recorded for folder `rel`, None if something is missing """
+        result = {}
+        with self.lock:
+            # the planner's walkers list folders while the planning thread updates records
+            for name in self.dirs[rel][1]:
+                childRel = rel + '/' + name
+                record = self.files.get(childRel)
+                if record is not None:
+                    result[name] = (False, record[0], record[1])
+                elif childRel in self.dirs:
+                    result[name] = (True, 0, 0)
+                else:
+                    return None
+        return result
+
+    def listTarget(self, rel):
+        """ entries of the destination folder `rel` if it is unchanged since it was recorded """
+        record = self.dirs.get(rel)
+        if record is None or not self.isTrusted(rel):
+            return None
+        try:
+            if os.stat(self.absPath(rel)).st_mtime_ns != record[0]:
+                return None
+        except OSError:
+            return None
+        return self.children(rel)
+
+    def markDir(self, rel, names):
+        try:
+            mtimeNs = os.stat(self.absPath(rel)).st_mtime_ns
+        except OSError:
+            mtimeNs = None
+        with self.lock:
+            if mtimeNs is None:
+                self.dirs.pop(rel, None)
+            else:
+                self.dirs[rel] = [mtimeNs, sorted(names)]
+            self.isDirty = True
+
+    def absPath(self, rel):
+        return os.path.join(self.root, *rel.split('/')) if rel else self.root
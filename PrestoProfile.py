@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import json
+import threading
+
+
+PROFILE_VERSION = 1
+PROFILE_PATH = os.path.join(os.path.expanduser('~'), '.Presto', 'profiles.json')
+SPEED_WEIGHT = 0.5  # weight of the latest measurement in the stored write speeds
+
+
+class ProfileStore:
+    """ What Presto learned about each drive, kept across runs and keyed by volume serial
+
+    profiles: serial -> {
+        'label', 'fileSystem':                   the volume when it was last synced,
+        'sequentialSpeed', 'smallFileSpeed':     write speeds of a single worker in bytes per second,
+        'chunkSize', 'writeSlots', 'throughput': the best settings the auto tuner found,
+        'lastSync':                              time of the last sync,
+        'manifestPath', 'mirrorPath':            manifest of the last sync on the drive and its local mirror,
+        'updated'}
+    """
+
+    instances = {}
+    instancesLock = threading.Lock()
+
+    def __init__(self, path=PROFILE_PATH):
+        self.path = path
+        self.profiles = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    @classmethod
+    def shared(cls, path=PROFILE_PATH):
+        """ the store of `path` used by every sync of this process """
+        with cls.instancesLock:
+            store = cls.instances.get(path)
+            if store is None:
+                store = cls.instances[path] = cls(path)
+            return store
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data['version'] != PROFILE_VERSION:
+                raise ValueError(data['version'])
+            self.profiles = dict(data['profiles'])
+        except (OSError, ValueError, KeyError, TypeError):
+            self.profiles = {}
+
+    def save(self):
+        with self.lock:
+            text = json.dumps({'version': PROFILE_VERSION, 'profiles': self.profiles}, ensure_ascii=False, indent=2)
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError:
+            pass
+
+    def get(self, serial):
+        """ profile of the volume `serial`, None for a drive never synced """
+        if not serial:
+            return None
+        with self.lock:
+            profile = self.profiles.get(serial)
+            return dict(profile) if profile else None
+
+    def update(self, serial, **values):
+        """ store `values` in the profile of `serial`, values that are None are left out """
+        if not serial:
+            return
+        with self.lock:
+            profile = self.profiles.setdefault(serial, {})
+            profile.update((key, value) for key, value in values.items() if value is not None)
+            profile['updated'] = time.time()
+        self.save()
+
+    def measure(self, serial, **speeds):
+        """ blend freshly measured write speeds into the profile of `serial` """
+        with self.lock:
+            profile = self.profiles.get(serial, {})
+            values = {}
+            for key, speed in speeds.items():
+                if speed is not None and profile.get(key):
+                    speed = SPEED_WEIGHT * speed + (1 - SPEED_WEIGHT) * profile[key]
+                values[key] = speed
+        self.update(serial, **values)
@@ -2,13 +2,18 @@
 
 import os
 import sys
-import time
+import threading
 import subprocess
 import darkdetect
 import portalocker
 import PrestoResource
 from PrestoConfig import cfg
 from psutil import disk_partitions
+from PrestoWatcher import EventWatcher, createWatcher
+from PrestoService import SyncService
+from PrestoCache import CacheWarmer
+from PrestoEngine import MB
+from PrestoJob import Job, JobError, SUBJECTS
 from webbrowser import open as WebOpen
 from win32api import GetVolumeInformation
 from PyQt5.QtCore import Qt, QThread, pyqtSignal, QPropertyAnimation, QEvent, QRunnable, QThreadPool, QObject
@@ -297,71 +302,33 @@ class ScanThread(QThread):
         super().__init__(parent=parent)
         self.drive = ''
         self.isRunning = True
-
         self.cycle = cfg.ScanCycle.value / 10
-        self.local_device = []
-        self.local_letter = []
-        self.local_number = 0
-        self.mobile_device = []
-        self.mobile_letter = []
-        self.mobile_number = 0
-        self.now_number = 0
-        self.before_number = self.update()
-        self.before_letter = self.local_letter + self.mobile_letter
+        self.watcher = createWatcher(self.cycle, isEventSource=sys.platform == 'win32')
 
     def stop(self):
         self.isRunning = False
-
-    def update(self):
-        tmp_local_device, tmp_local_letter = [], []
-        tmp_mobile_device, tmp_mobile_letter = [], []
-        tmp_local_number, tmp_mobile_number = 0, 0
-        try:
-            part = disk_partitions()
-        except:
-            pass
-        else:
-            for i in range(len(part)):
-                tmplist = part[i].opts.split(",")
-                if len(tmplist) > 1:
-                    if tmplist[1] == "fixed":
-                        tmp_local_number = tmp_local_number + 1
-                        tmp_local_letter.append(part[i].device[:2])
-                        tmp_local_device.append(part[i])
-                    else:
-                        tmp_mobile_number = tmp_mobile_number + 1
-                        tmp_mobile_letter.append(part[i].device[:2])
-                        tmp_mobile_device.append(part[i])
-            self.local_device, self.local_letter = tmp_local_device[:], tmp_local_letter[:]
-            self.mobile_device, self.mobile_letter = tmp_mobile_device[:], tmp_mobile_letter[:]
-            self.local_number, self.mobile_number = tmp_local_number, tmp_mobile_number
-        return len(part)
+        self.watcher.stop()
+
+    def notify(self):
+        """ a device was added or removed, called from the window receiving WM_DEVICECHANGE """
+        if isinstance(self.watcher, EventWatcher):
+            self.watcher.notify()
+
+    def onDrivesChanged(self, added, removed):
+        for drive in sorted(added):
+            self.drive = drive
+            if os.path.exists('PrestoUsbService.exe'):
+                subprocess.call(["PrestoUsbService.exe", self.drive], shell=True)
+            else:
+                w = ErrorDialog("错误", "核心文件缺失，请尝试重新安装。Presto 将退出。")
+                w.yesButton.setText("确定")
+                if w.exec():
+                    sys.exit()
+        self.listChanged.emit(True)
 
     def run(self):
-        while self.isRunning:
-            self.now_number = self.update()
-            if self.now_number > self.before_number and len(set(self.local_letter + self.mobile_letter).difference(set(self.before_letter))) == 1:
-                self.drive = ''.join(set(self.local_letter + self.mobile_letter).difference(set(self.before_letter)))
-
-                if os.path.exists('PrestoUsbService.exe'):
-                    subprocess.call(["PrestoUsbService.exe", self.drive], shell=True)
-                else:
-                    w = ErrorDialog("错误", "核心文件缺失，请尝试重新安装。Presto 将退出。")
-                    w.yesButton.setText("确定")
-                    if w.exec():
-                        sys.exit()
-
-                self.before_number = self.now_number
-                self.before_device = self.local_device + self.mobile_letter
-                self.before_letter = self.local_letter + self.mobile_letter
-                self.listChanged.emit(True)
-            elif self.now_number < self.before_number:
-                self.before_number = self.now_number
-                self.before_letter = self.local_letter + self.mobile_letter
-                self.listChanged.emit(True)
-            time.sleep(self.cycle)
-        else:
-            return
+        if self.isRunning:
+            self.watcher.run(self.onDrivesChanged)
 
 
 class EjectSignal(QObject):
@@ -395,11 +362,28 @@ class EjectRunnable(QRunnable):
 
 
 class MainWindow(QMainWindow):
+
+    deviceChanged = pyqtSignal()
+
+    WM_DEVICECHANGE = 0x0219
+    DBT_DEVICEARRIVAL = 0x8000
+    DBT_DEVICEREMOVECOMPLETE = 0x8004
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Presto")
         self.setWindowIcon(QIcon(":/icon.png"))
         self.resize(400, 300)
+        # the window is never shown, a native handle is still needed to receive WM_DEVICECHANGE
+        self.winId()
+
+    def nativeEvent(self, eventType, message):
+        if eventType == "windows_generic_MSG":
+            from ctypes import wintypes
+            msg = wintypes.MSG.from_address(int(message))
+            if msg.message == self.WM_DEVICECHANGE and msg.wParam in (self.DBT_DEVICEARRIVAL, self.DBT_DEVICEREMOVECOMPLETE):
+                self.deviceChanged.emit()
+        return super().nativeEvent(eventType, message)
 
 
 class TrayApp:
@@ -431,8 +415,19 @@ class TrayApp:
 
         self.scanThread = ScanThread()
         self.scanThread.listChanged.connect(self.updateDriveActions)
+        self.main_window.deviceChanged.connect(self.scanThread.notify)
         self.scanThread.start()
 
+        self.syncService = SyncService()
+        try:
+            self.syncService.start()
+        except OSError:
+            self.syncService = None
+
+        self.cacheWarmer = None
+        if cfg.IsCache.value and cfg.IsPrewarm.value:
+            self.startCacheWarmer()
+
     def trayIconActivated(self, reason):
         if reason == QSystemTrayIcon.ActivationReason.Trigger or reason == QSystemTrayIcon.ActivationReason.Context:
             self._tray_icon_menu.exec(QCursor.pos())
@@ -464,8 +459,24 @@ class TrayApp:
         self.tray_icon.deleteLater()
         self.scanThread.stop()
         self.scanThread.wait()
+        if self.syncService:
+            self.syncService.stop()
+        if self.cacheWarmer:
+            self.cacheWarmer.stop()
         QApplication.quit()
 
+    def startCacheWarmer(self):
+        """ warm the source cache in the background, between the syncs run by the service """
+        try:
+            # only the source side of the job is used, the drive does not matter
+            options = Job.fromConfig(cfg, 'C:', range(1, len(SUBJECTS) + 1)).createOptions()
+        except JobError:
+            return
+        folders = [getattr(cfg, subject + 'Folder').value for subject in SUBJECTS]
+        isIdle = self.syncService.isIdle if self.syncService else None
+        self.cacheWarmer = CacheWarmer(options.cache, folders, options, cfg.PrewarmRate.value * MB, isIdle)
+        threading.Thread(target=self.cacheWarmer.run, daemon=True).start()
+
     def openLauncher(self):
         if os.path.exists('PrestoLauncher.exe'):
             subprocess.Popen("PrestoLauncher.exe", shell=True)
@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import secrets
+import threading
+from multiprocessing.connection import Listener, Client
+from PrestoEngine import SyncScheduler, FanOutScheduler, DriveWriter, ProgressTracker, PlanSummary, AutoTuner, \
+    NativeBackend, createBackend, getFreeSpace, packPlans, SMALL_FILE_WORKERS
+from PrestoManifest import Manifest, getVolumeInfo
+from PrestoProfile import ProfileStore
+from PrestoJob import Job
+
+
+SERVICE_FOLDER = os.path.join(os.path.expanduser('~'), '.Presto', 'service')
+if os.name == 'nt':
+    ADDRESS, FAMILY = r'\\.\pipe\PrestoSync', 'AF_PIPE'
+else:
+    ADDRESS, FAMILY = os.path.join(SERVICE_FOLDER, 'sync.sock'), 'AF_UNIX'
+
+
+def getAuthKey():
+    """ random key shared by the processes of the current user """
+    path = os.path.join(SERVICE_FOLDER, 'service.key')
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        os.makedirs(SERVICE_FOLDER, exist_ok=True)
+        key = secrets.token_bytes(32)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(key)
+        return key
+
+
+class SyncJob:
+    """ Run one sync request and report it through `emit(event, data)`
+
+    A request is {'type': 'sync', 'job': Job.toDict(), 'tasks': [task id, ...]}, the
+    tasks default to every subject of the job.
+
+    Events: 'progress' (ProgressEvent fields), 'taskFinished' (task), 'shortage' (PlanSummary
+    fields), 'packed' (PlanSummary fields, sent before anything is written when files are left
+    out to fit the drive), 'paused' (whether the job is now paused) and 'finished'
+    ({'mismatches', 'isStopped'}). The service sends 'error' (message) and a stopped 'finished'
+    when the request cannot be run.
+
+    The tasks are in subject priority order. A sync that does not fit the drive is packed in
+    that order when the job asks for it, and cancelled otherwise.
+
+    A sync whose job asks for it is handed to `fanOut(writer, source)`, which joins it to the
+    other drives syncing the same source.
+
+    A sync that runs to the end clears the journal of the drive, an interrupted one, or one
+    cancelled for lack of space, leaves it for the next sync to continue from.
+
+    The drive's profile supplies the chunk size and the write limit tuned on an earlier sync.
+    With auto tuning the native engine goes on tuning from there and the best settings found
+    are recorded. The measured write speeds, the time and the manifest of every sync are
+    recorded as well.
+    """
+
+    def __init__(self, request, manifest, emit):
+        self.request = request
+        self.job = Job.fromDict(request['job'])
+        self.manifest = manifest
+        self.emit = emit
+        self.options = self.job.createOptions()
+        self.isRunning = True
+        self.isPaused = False
+        self.scheduler = None
+        self.writer = None
+        self.progress = None
+        self.fanOut = None
+        self.tasks = self.request.get('tasks', sorted(self.job.subjects))
+        self.isPlanAccepted = False  # whether planReady let the plan be applied
+
+    def createBackend(self):
+        return createBackend(self.job.engine, self.options)
+
+    def createTuner(self, profile):
+        """ AutoTuner starting from the profile of the drive, None unless the job asks for one """
+        if not self.options.isAutoTune or self.options.isLowIo or not isinstance(self.createBackend(), NativeBackend):
+            return None
+        return AutoTuner(self.options, SMALL_FILE_WORKERS, profile.get('writeSlots'), profile.get('chunkSize'))
+
+    def recordProfile(self, speeds=None, tuned=None):
+        store = ProfileStore.shared()
+        _, label, fileSystem = getVolumeInfo(self.job.destFolder)
+        if speeds:
+            store.measure(self.manifest.volume, sequentialSpeed=speeds['sequential'],
+                          smallFileSpeed=speeds['smallFile'])
+        store.update(self.manifest.volume, label=label, fileSystem=fileSystem, lastSync=time.time(),
+                     manifestPath=self.manifest.path, mirrorPath=self.manifest.mirrorPath, **(tuned or {}))
+
+    def stop(self):
+        self.isRunning = False
+        if self.scheduler:
+            self.scheduler.stop()
+        if self.writer:
+            self.writer.stop()
+
+    def pause(self, isPaused=True):
+        """ park the workers where they are, or let them go on """
+        self.isPaused = isPaused
+        for worker in (self.scheduler, self.writer):
+            if worker is None:
+                continue
+            if isPaused:
+                worker.pause()
+            else:
+                worker.resume()
+        self.emit('paused', isPaused)
+
+    def onPlanReady(self, plans):
+        freeSpace = getFreeSpace(self.job.destFolder)
+        summary = PlanSummary(plans.values(), freeSpace)
+        if not summary.isFitting and self.options.packOrder:
+            packPlans([plans[task] for task in self.tasks if task in plans], freeSpace, self.options.packOrder)
+            summary = PlanSummary(plans.values(), freeSpace)
+            self.emit('packed', vars(summary))
+        if not summary.isFitting:
+            self.emit('shortage', vars(summary))
+        self.isPlanAccepted = summary.isFitting
+        return summary.isFitting
+
+    def onTaskFinished(self, task):
+        self.emit('taskFinished', task)
+        self.progress.emit(True)
+
+    def run(self):
+        try:
+            self.runRequest()
+        finally:
+            if self.options.cache:
+                self.options.cache.save()
+
+    def runRequest(self):
+        typeFilter = self.options.typeFilter
+        self.manifest.setFilter(typeFilter.key if typeFilter else '')
+        self.progress = ProgressTracker(lambda event: self.emit('progress', vars(event)))
+        tasks = self.tasks
+        profile = ProfileStore.shared().get(self.manifest.volume) or {}
+        self.options.tunedChunkSize = profile.get('chunkSize')
+        if self.fanOut and self.job.isFanOut:
+            self.runFanOut(tasks)
+            return
+        self.scheduler = SyncScheduler(self.createBackend, self.options.concurrentProcess,
+                                       writeSlots=profile.get('writeSlots'), progress=self.progress)
+        self.scheduler.taskFinished = self.onTaskFinished
+        self.scheduler.planReady = self.onPlanReady
+        self.scheduler.tuner = self.createTuner(profile)
+        if self.isPaused:
+            self.scheduler.pause()
+        if not self.isRunning:
+            self.scheduler.stop()
+        self.scheduler.run([(task, self.job.subjects[task]) for task in tasks], self.job.destFolder, self.manifest)
+        self.manifest.save()
+        if self.isRunning and self.scheduler.isRunning and self.isPlanAccepted:
+            self.manifest.journal.clear()
+            self.recordProfile(self.scheduler.speeds(), self.scheduler.tuner.best if self.scheduler.tuner else None)
+        self.emit('finished', {'mismatches': self.scheduler.mismatches,
+                               'isStopped': not (self.isRunning and self.scheduler.isRunning)})
+
+    def runFanOut(self, tasks):
+        pairs = [(task, self.job.subjects[task]) for task in tasks]
+        self.writer = DriveWriter(self.options, self.job.destFolder, pairs, self.manifest, self.progress)
+        self.writer.taskFinished = self.onTaskFinished
+        self.writer.planReady = self.onPlanReady
+        if self.isPaused:
+            self.writer.pause()
+        if not self.isRunning:
+            self.writer.stop()
+        self.fanOut(self.writer, self.job.source)
+        self.writer.run()
+        self.manifest.save()
+        if self.isRunning and self.writer.isRunning and self.isPlanAccepted:
+            self.manifest.journal.clear()
+            self.recordProfile()
+        self.emit('finished', {'mismatches': self.writer.mismatches,
+                               'isStopped': not (self.isRunning and self.writer.isRunning)})
+
+
+class SyncService:
+    """ Resident sync service, hosted by the PrestoScan tray process
+
+    Requests arrive over a named pipe (a Unix socket elsewhere) and run in this process, so
+    the engine stays imported and the manifests stay loaded between drives. A client sends a
+    request, receives the events of the job and may send {'type': 'stop'}, {'type': 'pause'} and
+    {'type': 'resume'} meanwhile.
+    """
+
+    def __init__(self, address=ADDRESS, family=FAMILY):
+        self.address = address
+        self.family = family
+        self.listener = None
+        self.isRunning = True
+        self.manifests = {}
+        self.locks = {}
+        self.fanOuts = {}
+        self.activeJobs = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        if self.family == 'AF_UNIX' and os.path.exists(self.address):
+            os.remove(self.address)
+        os.makedirs(SERVICE_FOLDER, exist_ok=True)
+        self.listener = Listener(self.address, self.family, authkey=getAuthKey())
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def stop(self):
+        self.isRunning = False
+        if self.listener:
+            try:
+                self.listener.close()
+            except OSError:
+                pass
+
+    def serve(self):
+        while self.isRunning:
+            try:
+                conn = self.listener.accept()
+            except Exception:
+                if not self.isRunning:
+                    break
+                continue
+            threading.Thread(target=self.handle, args=(conn, ), daemon=True).start()
+
+    def isIdle(self):
+        """ whether no job is running, background work waits for this """
+        return self.activeJobs == 0
+
+    def getManifest(self, dst, source):
+        """ the cached manifest of `dst`, reloaded if the drive copy changed behind our back """
+        key = (os.path.normcase(os.path.normpath(dst)), os.path.normcase(os.path.normpath(source)))
+        with self.lock:
+            manifest, stamp = self.manifests.get(key, (None, None))
+            if manifest is None or self.stamp(manifest) != stamp:
+                manifest = Manifest.load(dst, source)
+            self.locks.setdefault(key, threading.Lock())
+            return manifest, self.locks[key]
+
+    def keepManifest(self, manifest):
+        key = (os.path.normcase(manifest.root), os.path.normcase(os.path.normpath(manifest.source)))
+        with self.lock:
+            self.manifests[key] = (manifest, self.stamp(manifest))
+
+    def joinFanOut(self, writer, source):
+        """ add `writer` to the fan-out reading `source`, a new one is started if it has finished """
+        key = os.path.normcase(os.path.normpath(source))
+        with self.lock:
+            fanOut = self.fanOuts.get(key)
+            if fanOut is None or not fanOut.join(writer):
+                fanOut = FanOutScheduler(writer.options.chunkSize, writer.options.cache)
+                fanOut.join(writer)
+                self.fanOuts[key] = fanOut
+
+    def stamp(self, manifest):
+        try:
+            return os.stat(manifest.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def handle(self, conn):
+        sendLock = threading.Lock()
+        job = None
+
+        def emit(event, data=None):
+            with sendLock:
+                try:
+                    conn.send((event, data))
+                except OSError:
+                    if job:
+                        job.stop()
+
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            conn.close()
+            return
+        try:
+            if request.get('type') == 'ping':
+                emit('pong')
+                return
+            job = SyncJob(request, None, emit)
+            manifest, lock = self.getManifest(job.job.destFolder, job.job.source)
+            job.manifest = manifest
+            job.fanOut = self.joinFanOut
+            watcher = threading.Thread(target=self.watch, args=(conn, job), daemon=True)
+            watcher.start()
+            with self.lock:
+                self.activeJobs += 1
+            try:
+                with lock:
+                    job.run()
+            finally:
+                with self.lock:
+                    self.activeJobs -= 1
+            self.keepManifest(manifest)
+        except Exception as e:
+            # a malformed request or a failed job, the client would otherwise wait for ever
+            emit('error', str(e) or type(e).__name__)
+            emit('finished', {'mismatches': [], 'isStopped': True})
+        finally:
+            conn.close()
+
+    def watch(self, conn, job):
+        """ read the messages a client sends while its job runs """
+        try:
+            while job.isRunning:
+                type = conn.recv().get('type')
+                if type == 'stop':
+                    job.stop()
+                elif type in ('pause', 'resume'):
+                    job.pause(type == 'pause')
+        except (EOFError, OSError):
+            job.stop()
+
+
+class SyncClient:
+    """ Connection of a UI to the sync service """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.isSubmitted = False
+        self.pending = []  # messages sent before the request, the service takes the first one as the request
+
+    @classmethod
+    def connect(cls, address=ADDRESS, family=FAMILY):
+        """ connect to the running service, None if there is none """
+        try:
+            return cls(Client(address, family, authkey=getAuthKey()))
+        except Exception:
+            return None
+
+    def submit(self, request):
+        """ send `request` and yield its (event, data) until the job ends """
+        try:
+            with self.lock:
+                self.conn.send(request)
+                self.isSubmitted = True
+                for type in self.pending:
+                    self.conn.send({'type': type})
+                self.pending = []
+        except OSError:
+            self.conn.close()
+            return
+        try:
+            while True:
+                event, data = self.conn.recv()
+                yield event, data
+                if event in ('finished', 'pong'):
+                    break
+        except (EOFError, OSError):
+            return
+        finally:
+            self.conn.close()
+
+    def send(self, type):
+        with self.lock:
+            if not self.isSubmitted:
+                self.pending.append(type)
+                return
+            try:
+                self.conn.send({'type': type})
+            except OSError:
+                pass
+
+    def stop(self):
+        self.send('stop')
+
+    def pause(self, isPaused=True):
+        self.send('pause' if isPaused else 'resume')
@@ -10,6 +10,8 @@ from enum import Enum
 from typing import Union
 from webbrowser import open as WebOpen
 from PrestoConfig import cfg, BufSize, VERSION, YEAR
+from PrestoEngine import FILE_TYPES
+from PrestoCache import getCacheSize, clearCache
 from pygetwindow import getWindowsWithTitle as GetWindow
 from PyQt5.QtCore import Qt, pyqtSignal, QTimer, QThread, QRectF, QEasingCurve, QEvent
 from PyQt5.QtGui import QColor, QIcon, QPainter, QTextCursor, QPainterPath, QCursor
@@ -20,7 +22,8 @@ from qfluentwidgets import NavigationItemPosition, SubtitleLabel, MessageBox, Ex
     SettingCardGroup, RadioButton, ExpandSettingCard, ComboBox, SwitchButton, IndicatorPosition, qconfig, \
     isDarkTheme, ConfigItem, OptionsConfigItem, FluentStyleSheet, HyperlinkButton, Slider, IconWidget, drawIcon, \
     setThemeColor, ImageLabel, MessageBoxBase, SmoothScrollDelegate, setFont, themeColor, setTheme, Theme, qrouter, \
-    NavigationBar, NavigationBarPushButton, BodyLabel, InfoBadge, SplashScreen, InfoBarIcon, PushButton, TextWrap
+    NavigationBar, NavigationBarPushButton, BodyLabel, InfoBadge, SplashScreen, InfoBarIcon, PushButton, TextWrap, \
+    LineEdit
 from qfluentwidgets.components.widgets.line_edit import EditLayer
 from qfluentwidgets.components.widgets.menu import MenuAnimationType, RoundMenu, CheckableMenu, MenuIndicatorType
 from qfluentwidgets.components.widgets.spin_box import SpinButton, SpinIcon
@@ -911,6 +914,24 @@ class TypeFilterItem(QWidget):
         cfg.set(self.config, self.switchBtn.isChecked())
 
 
+class CustomTypeFilterItem(TypeFilterItem):
+
+    def __init__(self, parent=None):
+        super().__init__(cfg.IsCustom, FIF.EDIT, "自定义", "以分号分隔，文件夹以 \\ 结尾", parent)
+        self.lineEdit = LineEdit(self)
+        self.lineEdit.setText(cfg.CustomTypes.value)
+        self.lineEdit.setPlaceholderText("*.psd; ~$*; 草稿\\")
+        self.lineEdit.setClearButtonEnabled(True)
+        self.lineEdit.setFixedWidth(220)
+        self.lineEdit.editingFinished.connect(self.onEditingFinished)
+
+        self.hBoxLayout.insertWidget(self.hBoxLayout.count() - 1, self.lineEdit, 0, Qt.AlignRight)
+        self.hBoxLayout.insertSpacing(self.hBoxLayout.count() - 1, 16)
+
+    def onEditingFinished(self):
+        cfg.set(cfg.CustomTypes, self.lineEdit.text())
+
+
 class TypeFilterSettingCard(ExpandSettingCard):
 
     def __init__(self, title: str, content: str = None, parent=None):
@@ -920,12 +941,13 @@ class TypeFilterSettingCard(ExpandSettingCard):
         self.switchBtn.setText('开' if cfg.IsTypeFilter.value else '关')
 
         self.typeFilterModeItem = TypeFilterModeItem(self)
-        self.documentItem = TypeFilterItem(cfg.IsDocument, FIF.DOCUMENT, "文档", ".pdf, .doc, .docx, .ppt, .pptx, .txt")
-        self.pictureItem = TypeFilterItem(cfg.IsPicture, FIF.PHOTO, "图片", ".jpg, .jpeg, .png, .gif, .bmp, .svg, .webp")
-        self.audioItem = TypeFilterItem(cfg.IsAudio, FIF.MUSIC, "音频", ".mp3, .wav, .flac, .ape, .acc, .ogg, .wma")
-        self.videoItem = TypeFilterItem(cfg.IsVideo, FIF.VIDEO, "视频", ".mp4, .avi, .mov, .wmv, .mkv")
-        self.applicationItem = TypeFilterItem(cfg.IsApplication, FIF.APPLICATION, "应用", ".exe, .dll, .msi, .bat, .cmd")
-        self.zipFileItem = TypeFilterItem(cfg.IsZipFile, FIF.ZIP_FOLDER, "压缩文件", ".zip, .rar, .7z, .iso")
+        self.documentItem = TypeFilterItem(cfg.IsDocument, FIF.DOCUMENT, "文档", ", ".join(FILE_TYPES['Document']))
+        self.pictureItem = TypeFilterItem(cfg.IsPicture, FIF.PHOTO, "图片", ", ".join(FILE_TYPES['Picture']))
+        self.audioItem = TypeFilterItem(cfg.IsAudio, FIF.MUSIC, "音频", ", ".join(FILE_TYPES['Audio']))
+        self.videoItem = TypeFilterItem(cfg.IsVideo, FIF.VIDEO, "视频", ", ".join(FILE_TYPES['Video']))
+        self.applicationItem = TypeFilterItem(cfg.IsApplication, FIF.APPLICATION, "应用", ", ".join(FILE_TYPES['Application']))
+        self.zipFileItem = TypeFilterItem(cfg.IsZipFile, FIF.ZIP_FOLDER, "压缩文件", ", ".join(FILE_TYPES['ZipFile']))
+        self.customItem = CustomTypeFilterItem(self)
 
         self.__initWidget()
 
@@ -943,6 +965,7 @@ class TypeFilterSettingCard(ExpandSettingCard):
         self.viewLayout.addWidget(self.videoItem)
         self.viewLayout.addWidget(self.applicationItem)
         self.viewLayout.addWidget(self.zipFileItem)
+        self.viewLayout.addWidget(self.customItem)
 
         self.switchBtn.checkedChanged.connect(self.onSwitchBtnChecked)
 
@@ -1229,6 +1252,7 @@ class ClearCache(QThread):
             subprocess.call("del /s /q Log", shell=True)
         if os.path.exists('FastCopy2.ini'):
             subprocess.call("del /q FastCopy2.ini", shell=True)
+        clearCache()
         self.isFinished.emit(True)
 
 
@@ -1301,6 +1325,43 @@ class HomeInterface(SmoothScrollArea):
             '缓冲区大小',
             texts=['32 MB', '64 MB', '128 MB', '256 MB', '512 MB', '1 GB'],
             parent=self.performanceGroup)
+        self.engineCard = ComboBoxSettingCard(
+            cfg.Engine,
+            FIF.SPEED_HIGH,
+            '同步引擎',
+            '选择执行同步/复制任务的引擎',
+            texts=['FastCopy', '内置'],
+            parent=self.performanceGroup)
+        self.verifyCard = ComboBoxSettingCard(
+            cfg.Verify,
+            FIF.CERTIFICATE,
+            '文件校验',
+            '复制后回读目标文件并比对哈希值，不一致时自动重新复制',
+            texts=['关闭', 'xxHash (快速)', 'SHA-256'],
+            parent=self.performanceGroup)
+        self.fanOutCard = SwitchSettingCard(
+            FIF.SYNC,
+            "多盘同步",
+            "多个 U 盘同时同步时只读取一次源文件，由内置引擎写入",
+            configItem=cfg.FanOut,
+            parent=self.performanceGroup)
+        self.deltaCard = SwitchSettingCard(
+            FIF.EDIT,
+            "增量写入",
+            "更新大文件时只写入发生变化的数据块，减少 U 盘写入量。文件在原处改写，中断时新旧内容混合，下次同步从断点继续 (内置引擎)",
+            configItem=cfg.IsDelta,
+            parent=self.performanceGroup)
+        self.autoTuneCard = SwitchSettingCard(
+            FIF.SPEED_MEDIUM,
+            "自动调优",
+            "同步时测量 U 盘速度并自动调整缓冲区与并发写入数，结果按 U 盘记录并在下次沿用 (内置引擎)",
+            configItem=cfg.IsAutoTune,
+            parent=self.performanceGroup)
+        self.lowIoRateCard = RangeSettingCard(
+            cfg.LowIoRate,
+            FIF.SPEED_OFF,
+            '低占用模式写入上限 (MB/s)',
+            parent=self.performanceGroup)
         self.infoBar = InformationBar(title="", content="以下选项会对所有任务产生直接而现实的影响", parent=self.filterGroup)
         self.isSkipEmptyDirCard = SwitchSettingCard(
             FIF.REMOVE_FROM,
@@ -1316,6 +1377,42 @@ class HomeInterface(SmoothScrollArea):
             title='类型过滤',
             content='排除或包含指定类型的文件',
             parent=self.filterGroup)
+        self.packOrderCard = ComboBoxSettingCard(
+            cfg.PackOrder,
+            FIF.ZIP_FOLDER,
+            '空间不足时',
+            'U 盘放不下全部文件时按科目顺序装入，其余文件在写入前列出并跳过',
+            texts=['取消同步', '按科目顺序', '最近的文件优先', '较小的文件优先'],
+            parent=self.filterGroup)
+        self.cacheCard = SwitchSettingCard(
+            FIF.DOWNLOAD,
+            "源文件缓存",
+            "在本地缓存共享文件夹中的文件，未变化的文件直接从本地读取 (内置引擎)",
+            configItem=cfg.IsCache,
+            parent=self.storageGroup)
+        self.cacheSizeCard = RangeSettingCard(
+            cfg.CacheSize,
+            FIF.PIE_SINGLE,
+            '缓存上限 (GB)',
+            '超出时移除最久未使用的文件',
+            parent=self.storageGroup)
+        self.cacheHashCard = SwitchSettingCard(
+            FIF.CERTIFICATE,
+            "缓存哈希校验",
+            "读取缓存前校验其内容，大小与修改时间总会被校验",
+            configItem=cfg.IsCacheHash,
+            parent=self.storageGroup)
+        self.prewarmCard = SwitchSettingCard(
+            FIF.HISTORY,
+            "后台预热缓存",
+            "空闲时以低优先级将源文件夹中的新文件下载到缓存，重启 Presto 后生效",
+            configItem=cfg.IsPrewarm,
+            parent=self.storageGroup)
+        self.prewarmRateCard = RangeSettingCard(
+            cfg.PrewarmRate,
+            FIF.SPEED_OFF,
+            '预热带宽上限 (MB/s)',
+            parent=self.storageGroup)
         self.clearCard = PushSettingCard(
             '清除',
             FIF.BROOM,
@@ -1370,10 +1467,22 @@ class HomeInterface(SmoothScrollArea):
         self.performanceGroup.addSettingCard(self.scanCycleCard)
         self.performanceGroup.addSettingCard(self.concurrentProcessCard)
         self.performanceGroup.addSettingCard(self.bufSizeCard)
+        self.performanceGroup.addSettingCard(self.engineCard)
+        self.performanceGroup.addSettingCard(self.verifyCard)
+        self.performanceGroup.addSettingCard(self.fanOutCard)
+        self.performanceGroup.addSettingCard(self.deltaCard)
+        self.performanceGroup.addSettingCard(self.autoTuneCard)
+        self.performanceGroup.addSettingCard(self.lowIoRateCard)
         self.filterGroup.addSettingCard(self.infoBar)
         self.filterGroup.addSettingCard(self.isSkipEmptyDirCard)
         self.filterGroup.addSettingCard(self.sizeFilterCard)
         self.filterGroup.addSettingCard(self.typeFilterCard)
+        self.filterGroup.addSettingCard(self.packOrderCard)
+        self.storageGroup.addSettingCard(self.cacheCard)
+        self.storageGroup.addSettingCard(self.cacheSizeCard)
+        self.storageGroup.addSettingCard(self.cacheHashCard)
+        self.storageGroup.addSettingCard(self.prewarmCard)
+        self.storageGroup.addSettingCard(self.prewarmRateCard)
         self.storageGroup.addSettingCard(self.clearCard)
         self.advanceGroup.addSettingCard(self.recoverCard)
         self.advanceGroup.addSettingCard(self.devCard)
@@ -1398,6 +1507,7 @@ class HomeInterface(SmoothScrollArea):
                     size += sum([os.path.getsize(os.path.join(root, name)) for name in files])
                 except:
                     pass
+        size += getCacheSize()
         kbSize = float(size / 1024)
         if kbSize >= 1024*1024:
             return str(round(kbSize/1024/1024, 1)) + ' GB'
@@ -1460,7 +1570,7 @@ class HomeInterface(SmoothScrollArea):
     def clearCache(self):
         w = MessageBox(
             '清除缓存',
-            '缓存包含日志文件。点击确定以继续。',
+            '缓存包含日志文件与源文件缓存。点击确定以继续。',
             self.window())
         w.yesButton.setText('确定')
         w.cancelButton.setText('取消')
@@ -1484,6 +1594,18 @@ class HomeInterface(SmoothScrollArea):
             self.scanCycleCard.setValue(10)
             self.concurrentProcessCard.setValue(3)
             self.bufSizeCard.setValue(BufSize._256)
+            self.engineCard.setValue("FastCopy")
+            self.verifyCard.setValue("Off")
+            self.fanOutCard.setChecked(False)
+            self.deltaCard.setChecked(False)
+            self.autoTuneCard.setChecked(False)
+            self.lowIoRateCard.setValue(10)
+            self.cacheCard.setChecked(False)
+            self.cacheSizeCard.setValue(20)
+            self.cacheHashCard.setChecked(False)
+            self.prewarmCard.setChecked(False)
+            self.prewarmRateCard.setValue(10)
+            self.packOrderCard.setValue("Off")
             self.sizeFilterCard.switchBtn.setChecked(False)
             cfg.set(cfg.IsSizeFilter, False)
 
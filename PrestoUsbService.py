@@ -5,6 +5,8 @@ import sys
 import subprocess
 import darkdetect
 import PrestoResource
+from PrestoConfig import cfg
+from PrestoJob import Job, JOB_FOLDER
 from webbrowser import open as WebOpen
 from win32file import GetDiskFreeSpace
 from win32api import GetVolumeInformation
@@ -652,9 +654,9 @@ class OptionInterface(QWidget):
         self.exeBtn.setFixedWidth(145)
         self.exitBtn.setFixedWidth(145)
 
-        self.exeBtn.clicked.connect(lambda: self.onSyncAction("/speed=full", False, '1'))
-        self.syncAction.triggered.connect(lambda: self.onSyncAction("/speed=full", False, '1'))
-        self.lowSyncAction.triggered.connect(lambda: self.onSyncAction("/low_io", False, '2'))
+        self.exeBtn.clicked.connect(lambda: self.onSyncAction(1))
+        self.syncAction.triggered.connect(lambda: self.onSyncAction(1))
+        self.lowSyncAction.triggered.connect(lambda: self.onSyncAction(2))
         self.latelyCopyAction.triggered.connect(self.onLatelyCopyAction)
         self.dateCopyAction.triggered.connect(self.onDateCopyAction)
 
@@ -798,60 +800,18 @@ class OptionInterface(QWidget):
         else:
             self.slectAll.setCheckState(Qt.PartiallyChecked)
 
-    def onSyncAction(self, commandOption, isDelete, mode):
+    def onSyncAction(self, mode, isDelete=False, days=None, fromDate=None, toDate=None):
         self.isClicked = True
 
-        arg = ["PrestoMain.exe"]
-        arg.append(drive)
+        boxes = [self.yuwen, self.shuxue, self.yingyu, self.wuli, self.huaxue, self.shengwu,
+                 self.zhengzhi, self.lishi, self.dili, self.jishu, self.ziliao]
+        tasks = [i + 1 for i, box in enumerate(boxes) if box.isChecked()]
+        job = Job.fromConfig(cfg, drive, tasks, mode, isDelete, days, fromDate, toDate)
+        jobPath = os.path.join(JOB_FOLDER, drive[0] + '.json')
+        os.makedirs(JOB_FOLDER, exist_ok=True)
+        job.dump(jobPath)
 
-        if self.yuwen.isChecked():
-            arg.append("1")
-        else:
-            arg.append("0")
-        if self.shuxue.isChecked():
-            arg.append("1")
-        else:
-            arg.append("0")
-        if self.yingyu.isChecked():
-            arg.append("1")
-        else:
-            arg.append("0")
-        if self.wuli.isChecked():
-            arg.append("1")
-        else:
-            arg.append("0")
-        if self.huaxue.isChecked():
-            arg.append("1")
-        else:
-            arg.append("0")
-        if self.shengwu.isChecked():
-            arg.append("1")
-        else:
-            arg.append("0")
-        if self.zhengzhi.isChecked():
-            arg.append("1")
-        else:
-            arg.append("0")
-        if self.lishi.isChecked():
-            arg.append("1")
-        else:
-            arg.append("0")
-        if self.dili.isChecked():
-            arg.append("1")
-        else:
-            arg.append("0")
-        if self.jishu.isChecked():
-            arg.append("1")
-        else:
-            arg.append("0")
-        if self.ziliao.isChecked():
-            arg.append("1")
-        else:
-            arg.append("0")
-
-        arg.append(mode)
-        arg.append(str(isDelete))
-        arg.append(commandOption)
+        arg = ["PrestoMain.exe", "--job", jobPath]
         if os.path.exists('PrestoMain.exe'):
             subprocess.Popen(arg, shell=True)
             sys.exit()
@@ -865,7 +825,7 @@ class OptionInterface(QWidget):
     def onLatelyCopyAction(self):
         w = LatelyCopyMessageBox(self.window())
         if w.exec():
-            self.onSyncAction(f"/from_date=-{w.spinBox.value()}D", w.deleteCheckBox.isChecked(), '3')
+            self.onSyncAction(3, w.deleteCheckBox.isChecked(), days=w.spinBox.value())
             sys.exit()
 
     def onDateCopyAction(self):
@@ -880,7 +840,8 @@ class OptionInterface(QWidget):
             if w.fromDate.date > w.toDate.date:
                 w.fromDate.setDate(w.toDate.date)
 
-            self.onSyncAction(f"/from_date={w.fromDate.date.toString('yyyyMMdd')} /to_date={w.toDate.date.toString('yyyyMMdd')}", w.deleteCheckBox.isChecked(), '4')
+            self.onSyncAction(4, w.deleteCheckBox.isChecked(), fromDate=w.fromDate.date.toString('yyyyMMdd'),
+                              toDate=w.toDate.date.toString('yyyyMMdd'))
             sys.exit()
 
 
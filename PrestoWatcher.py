@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+import os
+import socket
+import threading
+from psutil import disk_partitions
+
+
+SETTLE_TIME = 3.0  # a volume is mounted a moment after the device event
+SETTLE_STEP = 0.2
+SAFETY_INTERVAL = 60.0  # event watchers still look once a while in case an event was lost
+NETLINK_KOBJECT_UEVENT = 15
+
+
+def listDrives():
+    """ drive letter (mount point outside Windows) -> whether the drive is removable """
+    drives = {}
+    for part in disk_partitions():
+        opts = part.opts.split(',')
+        name = part.device[:2] if os.name == 'nt' else part.mountpoint
+        drives[name] = not (len(opts) > 1 and opts[1] == 'fixed')
+    return drives
+
+
+class DriveWatcher:
+    """ Drive watcher base class
+
+    `run(callback)` blocks until `stop` is called and calls `callback(added, removed)` with the
+    sets of drives that appeared and disappeared since the last look.
+    """
+
+    def __init__(self, enumerate=listDrives):
+        self.enumerate = enumerate
+        self.drives = set()
+        self.drives = self.list()
+        self.callback = None
+        self.isRunning = True
+        self.wakeup = threading.Event()
+
+    def list(self):
+        try:
+            return set(self.enumerate())
+        except Exception:
+            return set(self.drives)
+
+    def refresh(self):
+        """ compare the drives with the last look, returns whether anything changed """
+        drives = self.list()
+        added, removed = drives - self.drives, self.drives - drives
+        self.drives = drives
+        if (added or removed) and self.callback:
+            self.callback(added, removed)
+        return bool(added or removed)
+
+    def run(self, callback):
+        raise NotImplementedError
+
+    def stop(self):
+        self.isRunning = False
+        self.wakeup.set()
+
+
+class PollingWatcher(DriveWatcher):
+    """ Enumerate the drives periodically, the interval doubles while nothing changes """
+
+    def __init__(self, minInterval=1.0, maxInterval=16.0, enumerate=listDrives):
+        super().__init__(enumerate)
+        self.minInterval = minInterval
+        self.maxInterval = max(minInterval, maxInterval)
+        self.interval = minInterval
+
+    def run(self, callback):
+        self.callback = callback
+        while self.isRunning:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            if not self.isRunning:
+                break
+            if self.refresh():
+                self.interval = self.minInterval
+            else:
+                self.interval = min(self.interval * 2, self.maxInterval)
+
+
+class EventWatcher(DriveWatcher):
+    """ Enumerate the drives only when `notify` reports a device change
+
+    On Windows the tray window forwards WM_DEVICECHANGE here. Tests and other platforms can
+    call `notify` directly.
+    """
+
+    def notify(self):
+        self.wakeup.set()
+
+    def settle(self):
+        """ look again for a short while until the change shows up """
+        waited = 0
+        while self.isRunning and waited < SETTLE_TIME:
+            if self.refresh():
+                return
+            self.wakeup.wait(SETTLE_STEP)
+            self.wakeup.clear()
+            waited += SETTLE_STEP
+
+    def run(self, callback):
+        self.callback = callback
+        while self.isRunning:
+            isNotified = self.wakeup.wait(SAFETY_INTERVAL)
+            self.wakeup.clear()
+            if not self.isRunning:
+                break
+            if isNotified:
+                self.settle()
+            else:
+                self.refresh()
+
+
+class NetlinkWatcher(EventWatcher):
+    """ Listen to the kernel uevents of block devices on Linux """
+
+    def __init__(self, enumerate=listDrives):
+        super().__init__(enumerate)
+        self.socket = None
+        self.listener = None
+
+    @classmethod
+    def isAvailable(cls):
+        return hasattr(socket, 'AF_NETLINK')
+
+    def listen(self):
+        while self.isRunning:
+            try:
+                data = self.socket.recv(16384)
+            except OSError:
+                break
+            if b'SUBSYSTEM=block' in data:
+                self.notify()
+
+    def run(self, callback):
+        self.socket = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        self.socket.bind((0, 1))
+        self.listener = threading.Thread(target=self.listen, daemon=True)
+        self.listener.start()
+        try:
+            super().run(callback)
+        finally:
+            self.socket.close()
+
+    def stop(self):
+        super().stop()
+        if self.socket:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def createWatcher(interval=1.0, isEventSource=False):
+    """ pick the best watcher, `isEventSource` tells that the caller will feed device events to `notify` """
+    if isEventSource:
+        return EventWatcher()
+    if NetlinkWatcher.isAvailable():
+        try:
+            probe = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            probe.close()
+            return NetlinkWatcher()
+        except OSError:
+            pass
+    return PollingWatcher(interval, interval * 16)
@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+# the engine modules sit at the top of the repository, next to the Qt front end
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
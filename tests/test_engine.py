@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import hashlib
+import threading
+
+import pytest
+
+import PrestoEngine
+from PrestoEngine import MB, PART_SUFFIX, DriveWriter, FanOutScheduler, NativeBackend, SyncOptions, Verifier
+from PrestoManifest import Manifest
+
+
+def writeFile(path, data, mtime=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+def readFile(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def loadManifest(dst, sourceRoot):
+    manifest = Manifest(dst, sourceRoot)
+    return Manifest.load(dst, sourceRoot) if os.path.exists(manifest.path) else manifest
+
+
+def sync(src, dst, options=None, manifest=None):
+    """ sync `src` into `dst` with a fresh backend, returns it with the bytes it wrote """
+    backend = NativeBackend(options or SyncOptions())
+    backend.setManifest(manifest)
+    written = [0]
+    write = backend.write
+
+    def countWrite(f, data):
+        written[0] += len(data)
+        return write(f, data)
+
+    backend.write = countWrite
+    backend.sync(src, dst)
+    if manifest:
+        manifest.save()
+    return backend, written[0]
+
+
+@pytest.fixture
+def tree(tmp_path):
+    """ (source subject, its parent, destination) with a few files and a nested folder """
+    root = tmp_path / 'source'
+    src = str(root / 'yuwen')
+    writeFile(os.path.join(src, 'a.txt'), b'alpha')
+    writeFile(os.path.join(src, 'sub', 'b.txt'), b'bravo' * 1000)
+    writeFile(os.path.join(src, 'sub', 'deep', 'c.bin'), os.urandom(3 * MB))
+    dst = str(tmp_path / 'drive')
+    os.makedirs(dst)
+    return src, str(root), dst
+
+
+def assertSame(src, dst):
+    for folder, dirs, files in os.walk(src):
+        for name in files:
+            path = os.path.join(folder, name)
+            target = os.path.join(dst, os.path.basename(src), os.path.relpath(path, src))
+            assert readFile(target) == readFile(path)
+
+
+def test_plan_and_sync_then_nothing_to_copy(tree):
+    src, sourceRoot, dst = tree
+    plan = NativeBackend(SyncOptions()).plan(src, dst)
+    assert sorted(copy[2] for copy in plan.copies) == ['yuwen/a.txt', 'yuwen/sub/b.txt', 'yuwen/sub/deep/c.bin']
+    assert plan.bytesTotal == 5 + 5000 + 3 * MB
+
+    backend, written = sync(src, dst, manifest=loadManifest(dst, sourceRoot))
+    assert not backend.errors
+    assert written == plan.bytesTotal
+    assertSame(src, dst)
+
+    backend, written = sync(src, dst, manifest=loadManifest(dst, sourceRoot))
+    assert not backend.errors
+    assert written == 0
+    assert not NativeBackend(SyncOptions()).plan(src, dst).copies
+
+
+def test_in_place_edit_is_copied(tree):
+    src, sourceRoot, dst = tree
+    sync(src, dst, manifest=loadManifest(dst, sourceRoot))
+    path = os.path.join(src, 'sub', 'b.txt')
+    folder = os.stat(os.path.dirname(path))
+    # same size and an untouched folder mtime, only the file mtime tells the edit apart
+    writeFile(path, b'BRAVO' * 1000, time.time() + 10)
+    os.utime(os.path.dirname(path), ns=(folder.st_atime_ns, folder.st_mtime_ns))
+
+    backend, written = sync(src, dst, manifest=loadManifest(dst, sourceRoot))
+    assert not backend.errors
+    assert written == 5000
+    assertSame(src, dst)
+
+
+def test_mirror_removes_what_the_source_lost(tree):
+    src, sourceRoot, dst = tree
+    sync(src, dst, manifest=loadManifest(dst, sourceRoot))
+    os.remove(os.path.join(src, 'sub', 'deep', 'c.bin'))
+    writeFile(os.path.join(dst, 'yuwen', 'stray', 'x.txt'), b'left over')
+
+    backend, _ = sync(src, dst, manifest=loadManifest(dst, sourceRoot))
+    assert not backend.errors
+    assert not os.path.exists(os.path.join(dst, 'yuwen', 'sub', 'deep', 'c.bin'))
+    assert not os.path.exists(os.path.join(dst, 'yuwen', 'stray'))
+    assert os.path.exists(os.path.join(dst, 'yuwen', 'a.txt'))
+
+
+def test_delete_prunes_files_left_out_of_the_selection(tree):
+    src, sourceRoot, dst = tree
+    sync(src, dst)
+    options = SyncOptions(maxSize=MB, isDelete=True)
+    plan = NativeBackend(options).plan(src, dst)
+    assert [delete[2] for delete in plan.deletes] == ['yuwen/sub/deep/c.bin']
+    assert plan.bytesFreed == 3 * MB
+
+    backend, written = sync(src, dst, options)
+    assert not backend.errors
+    assert written == 0
+    assert not os.path.exists(os.path.join(dst, 'yuwen', 'sub', 'deep', 'c.bin'))
+    assert os.path.exists(os.path.join(dst, 'yuwen', 'sub', 'b.txt'))
+
+    # without isDelete a smaller selection leaves the drive alone
+    writeFile(os.path.join(dst, 'yuwen', 'sub', 'deep', 'c.bin'), readFile(os.path.join(src, 'sub', 'deep', 'c.bin')))
+    assert not NativeBackend(SyncOptions(maxSize=MB, isMirror=False)).plan(src, dst).deletes
+
+
+def corruptReadBack(monkeypatch, target, times):
+    """ make the verifier see a wrong hash for the first `times` read backs of `target` """
+    hashFile = PrestoEngine.hashFile
+    left = [times]
+
+    def hashCorrupt(path, *args, **kwargs):
+        if path == target and left[0]:
+            left[0] -= 1
+            return 'bad'
+        return hashFile(path, *args, **kwargs)
+
+    monkeypatch.setattr(PrestoEngine, 'hashFile', hashCorrupt)
+
+
+def test_verify_mismatch_is_copied_again(tree, monkeypatch):
+    src, sourceRoot, dst = tree
+    target = os.path.join(dst, 'yuwen', 'sub', 'b.txt')
+    corruptReadBack(monkeypatch, target, 1)
+    options = SyncOptions(verify='xxHash')
+    backend, written = sync(src, dst, options, loadManifest(dst, sourceRoot))
+    assert not backend.errors and not backend.mismatches
+    assert written == 5 + 2 * 5000 + 3 * MB
+    assertSame(src, dst)
+
+
+def test_verify_mismatch_left_for_the_next_sync(tree, monkeypatch):
+    src, sourceRoot, dst = tree
+    target = os.path.join(dst, 'yuwen', 'sub', 'b.txt')
+    corruptReadBack(monkeypatch, target, 1 + PrestoEngine.RECOPY_ATTEMPTS)
+    options = SyncOptions(verify='xxHash')
+    backend, _ = sync(src, dst, options, loadManifest(dst, sourceRoot))
+    assert [mismatch[0] for mismatch in backend.mismatches] == ['yuwen/sub/b.txt']
+    assert isinstance(backend.errors[0][1], PrestoEngine.VerifyError)
+    assert not os.path.exists(target)
+
+    backend, written = sync(src, dst, options, loadManifest(dst, sourceRoot))
+    assert not backend.errors and not backend.mismatches
+    assert written == 5000
+    assertSame(src, dst)
+
+
+def test_part_file_is_resumed_from_the_journal(tree):
+    src, sourceRoot, dst = tree
+    path = os.path.join(src, 'sub', 'deep', 'c.bin')
+    data = readFile(path)
+    stat = os.stat(path)
+    part = os.path.join(dst, 'yuwen', 'sub', 'deep', 'c.bin' + PART_SUFFIX)
+    writeFile(part, data[:2 * MB])
+    manifest = loadManifest(dst, sourceRoot)
+    manifest.journal.checkpoint('yuwen/sub/deep/c.bin', stat.st_size, stat.st_mtime, 2 * MB)
+
+    options = SyncOptions(bufSize=8 * MB, largeFileSize=MB)
+    backend, written = sync(src, dst, options, manifest)
+    assert not backend.errors
+    assert written == 5 + 5000 + MB
+    assert not os.path.exists(part)
+    assertSame(src, dst)
+
+
+def test_stale_part_file_is_deleted(tree):
+    src, sourceRoot, dst = tree
+    part = os.path.join(dst, 'yuwen', 'sub', 'gone.bin' + PART_SUFFIX)
+    writeFile(part, b'half a file')
+    backend, _ = sync(src, dst, manifest=loadManifest(dst, sourceRoot))
+    assert not backend.errors
+    assert not os.path.exists(part)
+
+
+def test_fan_out_writes_every_drive(tree, tmp_path):
+    src, _, _ = tree
+    options = SyncOptions(bufSize=8 * MB)
+    drives = [str(tmp_path / f'drive{i}') for i in range(3)]
+    fanOut = FanOutScheduler(options.chunkSize)
+    writers = []
+    for drive in drives:
+        os.makedirs(drive)
+        writer = DriveWriter(options, drive, [(1, src)], Manifest(drive, os.path.dirname(src)))
+        fanOut.join(writer)
+        writers.append(writer)
+    threads = [threading.Thread(target=writer.run) for writer in writers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(60)
+    fanOut.reader.join(60)
+    assert not any(thread.is_alive() for thread in threads) and not fanOut.reader.is_alive()
+    for writer, drive in zip(writers, drives):
+        assert not writer.errors
+        assertSame(src, drive)
+
+
+def test_fan_out_survives_a_failing_drive(tree, tmp_path):
+    src, _, _ = tree
+    options = SyncOptions(bufSize=8 * MB)
+    fanOut = FanOutScheduler(options.chunkSize)
+    writers = [DriveWriter(options, str(tmp_path / f'drive{i}'), [(1, src)]) for i in range(2)]
+    for writer in writers:
+        os.makedirs(writer.dst)
+        fanOut.join(writer)
+
+    def fail(*args):
+        raise RuntimeError('drive pulled')
+
+    writers[0].backend.prepare = fail
+    errors = []
+
+    def run(writer):
+        try:
+            writer.run()
+        except RuntimeError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(writer, )) for writer in writers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(60)
+    fanOut.reader.join(60)
+    assert not any(thread.is_alive() for thread in threads) and not fanOut.reader.is_alive()
+    assert len(errors) == 1
+    assertSame(src, writers[1].dst)
+
+
+def test_verifier_concurrent_submits(tmp_path):
+    path = str(tmp_path / 'f')
+    writeFile(path, b'abc')
+    digest = hashlib.sha256(b'abc').hexdigest()
+    for _ in range(50):
+        verifier = Verifier('SHA-256', MB, workers=4)
+        barrier = threading.Barrier(8)
+
+        def submit(item):
+            barrier.wait()
+            verifier.submit(path, digest if item % 2 else 'bad', item)
+
+        threads = [threading.Thread(target=submit, args=(item, )) for item in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        result = []
+        joiner = threading.Thread(target=lambda: result.append(verifier.join()), daemon=True)
+        joiner.start()
+        joiner.join(10)
+        assert not joiner.is_alive(), 'join hung'
+        assert sorted(item for item, _, _ in result[0]) == [0, 2, 4, 6]